@@ -0,0 +1,3 @@
+from .channel import Channel, wait_for, mark_done
+from .ledger import TaskLedger
+from .manifest import GenerationManifest, sample_seed, file_checksum
@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import sqlite3
+
+
+class Channel:
+    """
+    Event log shared by the generator, the segmenter and the trainer of a
+    multi-round run, kept in one SQLite file (WAL mode, so readers never
+    block the writer). Every event is a (topic, key, payload) row with an
+    increasing id; readers remember the last id they saw, so an event is
+    never missed or read twice and a stage can follow another one item by
+    item instead of waiting for its end-of-round marker.
+
+    Only the standard library is used, so all three stages can import it.
+    """
+    def __init__(self, path, poll_interval=0.05):
+        self.path = path
+        self.poll_interval = poll_interval
+        self._conn = None
+        self._pid = None
+        dirname = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dirname, exist_ok=True)
+        conn = self._connect()
+        conn.execute("CREATE TABLE IF NOT EXISTS events ("
+                     "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                     "topic TEXT NOT NULL, key TEXT NOT NULL, payload TEXT, created REAL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS events_topic ON events (topic, key)")
+
+    def _connect(self):
+        # a connection must not be shared across fork(), dataloader workers
+        # open their own
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._pid = os.getpid()
+        return self._conn
+
+    def publish(self, topic, key, payload=None):
+        self._connect().execute(
+            "INSERT INTO events (topic, key, payload, created) VALUES (?, ?, ?, ?)",
+            (topic, str(key), json.dumps(payload), time.time()))
+
+    def find(self, topic, key):
+        """(True, payload) of the last event (topic, key), (False, None) if there is none."""
+        row = self._connect().execute(
+            "SELECT payload FROM events WHERE topic = ? AND key = ? ORDER BY id DESC LIMIT 1",
+            (topic, str(key))).fetchone()
+        if row is None:
+            return False, None
+        return True, json.loads(row[0])
+
+    def read(self, topic, after=0):
+        """Events of `topic` with an id above `after`, as (id, key, payload), oldest first."""
+        rows = self._connect().execute(
+            "SELECT id, key, payload FROM events WHERE topic = ? AND id > ? ORDER BY id",
+            (topic, after)).fetchall()
+        return [(i, k, json.loads(p)) for i, k, p in rows]
+
+    def wait(self, topic, key, fallback_path=None, timeout=None):
+        """
+        Block until (topic, key) is published and return its payload, or
+        return None as soon as `fallback_path` exists, for stages that still
+        only write marker files.
+        """
+        start = time.time()
+        while True:
+            found, payload = self.find(topic, key)
+            if found:
+                return payload
+            if fallback_path is not None and os.path.exists(fallback_path):
+                return None
+            if timeout is not None and time.time() - start > timeout:
+                raise TimeoutError("no event {}/{} in {}".format(topic, key, self.path))
+            time.sleep(self.poll_interval)
+
+    def stream(self, topic, end_topic, num_ends):
+        """
+        Yield (key, payload) of every `topic` event as soon as it is
+        published, until `num_ends` distinct producers published on
+        `end_topic` and everything they published before is yielded.
+        """
+        for batch in self.stream_batches(topic, end_topic, num_ends):
+            for item in batch:
+                yield item
+
+    def stream_batches(self, topic, end_topic, num_ends, max_batch=None):
+        """
+        Same as `stream`, but yields lists of up to `max_batch` (key,
+        payload) pairs: whatever arrived since the last batch, so batches are
+        small while the consumer keeps up and grow when it falls behind.
+        """
+        last = 0
+        while True:
+            # read the end markers first: a producer publishes its items
+            # before its marker, so they are all visible to the read below
+            ended = len(set(k for _, k, _ in self.read(end_topic))) >= num_ends
+            events = self.read(topic, last)
+            if max_batch is not None and len(events) > max_batch:
+                events, ended = events[:max_batch], False
+            if len(events) > 0:
+                last = events[-1][0]
+                yield [(key, payload) for _, key, payload in events]
+            if ended:
+                return
+            if len(events) == 0:
+                time.sleep(self.poll_interval)
+
+
+def wait_for(path, channel=None, topic='done', timeout=None):
+    """
+    Wait for the marker file `path` of another stage. Without a channel this
+    is the one-second polling loop used so far; with one, the stage returns
+    as soon as the matching `mark_done` event is published. Raises
+    TimeoutError after `timeout` seconds, if given.
+    """
+    print("Wait for {}".format(path))
+    if channel is not None:
+        channel.wait(topic, os.path.basename(path), fallback_path=path, timeout=timeout)
+        return
+    start = time.time()
+    while not os.path.exists(path):
+        if timeout is not None and time.time() - start > timeout:
+            raise TimeoutError("no {} after {} s".format(path, timeout))
+        time.sleep(1)
+
+
+def mark_done(path, channel=None, topic='done', payload=None):
+    """Write the marker file `path` and, with a channel, publish it."""
+    open(path, 'a').close()
+    if channel is not None:
+        channel.publish(topic, os.path.basename(path), payload)
@@ -0,0 +1,129 @@
+import os
+import json
+import time
+import sqlite3
+
+
+class TaskLedger:
+    """
+    Generation rows of every round in one SQLite file, shared by any number
+    of generator processes. The first process of a round seeds its rows;
+    from then on every process claims small batches of pending rows until
+    none are left, so a GPU that finishes early simply takes more rows and
+    the skew of the per-class counts does not matter. Rows claimed by a
+    process that stopped reporting for `claim_timeout` seconds go back to
+    the pool; a restarted worker gives back its own claims right away with
+    `release`.
+
+    Row states: 'pending', 'claimed' (by a worker, at a time), 'done'.
+    """
+    def __init__(self, path, claim_timeout=1800, poll_interval=1.0):
+        self.path = path
+        self.claim_timeout = claim_timeout
+        self.poll_interval = poll_interval
+        self._conn = None
+        self._pid = None
+        dirname = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dirname, exist_ok=True)
+        conn = self._connect()
+        conn.execute("CREATE TABLE IF NOT EXISTS tasks ("
+                     "id INTEGER PRIMARY KEY AUTOINCREMENT, rd INTEGER NOT NULL, "
+                     "cls_index INTEGER NOT NULL, inst_index INTEGER NOT NULL, row TEXT, "
+                     "state TEXT NOT NULL DEFAULT 'pending', worker TEXT, claimed REAL, "
+                     "UNIQUE (rd, cls_index, inst_index))")
+        conn.execute("CREATE INDEX IF NOT EXISTS tasks_state ON tasks (rd, state)")
+        conn.execute("CREATE TABLE IF NOT EXISTS rounds ("
+                     "rd INTEGER PRIMARY KEY, total INTEGER, finished INTEGER NOT NULL DEFAULT 0)")
+
+    def _connect(self):
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._pid = os.getpid()
+        return self._conn
+
+    def seed(self, rd, rows):
+        """
+        Insert the rows of round `rd` unless another process already did.
+        Returns True for the process that seeded it. Every row needs
+        'cls_index' and 'inst_index', the whole row is stored.
+        """
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("SELECT 1 FROM rounds WHERE rd = ?", (rd,)).fetchone() is not None:
+                conn.execute("COMMIT")
+                return False
+            conn.executemany(
+                "INSERT OR IGNORE INTO tasks (rd, cls_index, inst_index, row) VALUES (?, ?, ?, ?)",
+                [(rd, row['cls_index'], row['inst_index'], json.dumps(row)) for row in rows])
+            conn.execute("INSERT INTO rounds (rd, total) VALUES (?, ?)", (rd, len(rows)))
+            conn.execute("COMMIT")
+            return True
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def claim(self, rd, worker, num):
+        """Up to `num` pending rows of round `rd`, now claimed by `worker`, as (id, row) pairs."""
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("UPDATE tasks SET state = 'pending', worker = NULL "
+                         "WHERE rd = ? AND state = 'claimed' AND claimed < ?", (rd, now - self.claim_timeout))
+            found = conn.execute("SELECT id, row FROM tasks WHERE rd = ? AND state = 'pending' ORDER BY id LIMIT ?",
+                                 (rd, num)).fetchall()
+            conn.executemany("UPDATE tasks SET state = 'claimed', worker = ?, claimed = ? WHERE id = ?",
+                             [(str(worker), now, i) for i, _ in found])
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return [(i, json.loads(row)) for i, row in found]
+
+    def release(self, worker):
+        """
+        Put the rows still claimed by `worker` back in the pool, left by an
+        earlier process of the same worker that died. Returns their number.
+        """
+        cur = self._connect().execute(
+            "UPDATE tasks SET state = 'pending', worker = NULL WHERE state = 'claimed' AND worker = ?",
+            (str(worker),))
+        return cur.rowcount
+
+    def complete(self, ids):
+        self._connect().executemany("UPDATE tasks SET state = 'done' WHERE id = ?", [(i,) for i in ids])
+
+    def counts(self, rd):
+        """Rows of round `rd` per state."""
+        rows = self._connect().execute("SELECT state, COUNT(*) FROM tasks WHERE rd = ? GROUP BY state", (rd,))
+        return dict(rows.fetchall())
+
+    def claim_or_wait(self, rd, worker, num):
+        """
+        Like `claim`, but while other workers still hold rows of the round,
+        wait for them to finish or time out instead of returning nothing.
+        An empty list means every row of the round is done.
+        """
+        while True:
+            found = self.claim(rd, worker, num)
+            if len(found) > 0 or self.counts(rd).get('claimed', 0) == 0:
+                return found
+            time.sleep(self.poll_interval)
+
+    def finish(self, rd):
+        """True for exactly one caller once all rows of round `rd` are done."""
+        conn = self._connect()
+        if sum(self.counts(rd).values()) != self.counts(rd).get('done', 0):
+            return False
+        cur = conn.execute("UPDATE rounds SET finished = 1 WHERE rd = ? AND finished = 0", (rd,))
+        return cur.rowcount == 1
+
+    def num_per_class(self, rd, num_classes):
+        """Generated images per class (cls_index 1..num_classes) of the done rows of round `rd`."""
+        nums = [0] * num_classes
+        for cls_index, n in self._connect().execute(
+                "SELECT cls_index, COUNT(*) FROM tasks WHERE rd = ? AND state = 'done' GROUP BY cls_index", (rd,)):
+            nums[cls_index - 1] = n
+        return nums
@@ -0,0 +1,76 @@
+import os
+import time
+import hashlib
+import sqlite3
+
+
+def sample_seed(base_seed, rd, cls_index, inst_index):
+    """Seed of one generated sample, independent of batching and worker."""
+    key = "{}/{}/{}/{}".format(base_seed, rd, cls_index, inst_index).encode()
+    return int.from_bytes(hashlib.sha256(key).digest()[:8], 'little') >> 1
+
+
+def file_checksum(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class GenerationManifest:
+    """
+    Append-only record of every finished generated sample: (round, class,
+    instance, seed, path, checksum), one SQLite row written after the image
+    is complete on disk. A restarted generator skips the rows it finds here,
+    and downstream stages read their inputs from it instead of guessing
+    file names, so a file truncated by a crash is never picked up.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._pid = None
+        dirname = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dirname, exist_ok=True)
+        self._connect().execute(
+            "CREATE TABLE IF NOT EXISTS samples ("
+            "rd INTEGER NOT NULL, cls_index INTEGER NOT NULL, inst_index INTEGER NOT NULL, "
+            "seed INTEGER, path TEXT NOT NULL, checksum TEXT, created REAL, "
+            "PRIMARY KEY (rd, cls_index, inst_index))")
+
+    def _connect(self):
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._pid = os.getpid()
+        return self._conn
+
+    def add(self, rd, cls_index, inst_index, seed, path, checksum=None):
+        if checksum is None:
+            checksum = file_checksum(path)
+        self._connect().execute(
+            "INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (rd, cls_index, inst_index, seed, path, checksum, time.time()))
+
+    def completed(self, rd):
+        """(cls_index, inst_index) of the finished samples of round `rd` whose file still exists."""
+        rows = self._connect().execute(
+            "SELECT cls_index, inst_index, path FROM samples WHERE rd = ?", (rd,)).fetchall()
+        return set((c, i) for c, i, p in rows if os.path.exists(p))
+
+    def entries(self, rd, verify=False):
+        """
+        Finished samples of round `rd` as dicts, in class and instance order;
+        with `verify`, entries whose file no longer matches its checksum are
+        dropped.
+        """
+        rows = self._connect().execute(
+            "SELECT cls_index, inst_index, seed, path, checksum FROM samples WHERE rd = ? "
+            "ORDER BY cls_index, inst_index", (rd,)).fetchall()
+        entries = []
+        for cls_index, inst_index, seed, path, checksum in rows:
+            if not os.path.exists(path) or (verify and file_checksum(path) != checksum):
+                continue
+            entries.append({'cls_index': cls_index, 'inst_index': inst_index, 'seed': seed,
+                            'path': path, 'checksum': checksum})
+        return entries
@@ -1,12 +1,21 @@
 import os
 import json
+import hashlib
+import shutil
 import cv2
 import numpy as np
 from tqdm import tqdm
+from multiprocessing import Pool
 
 
 MASK_DIR = "./segmented"
 OUTPUT_JSON = "./annotations"
+# partial annotations written per micro-batch by the streaming segmenter
+SHARD_DIR = OUTPUT_JSON + "/shards"
+# per-round annotations with global ids, and the append-only index of the
+# rounds they hold
+STORE_DIR = OUTPUT_JSON + "/store"
+STORE_INDEX = STORE_DIR + "/index.jsonl"
 
 
 
@@ -42,100 +51,258 @@ def get_annotation_info(mask, image_id, category_id, annotation_id):
         "iscrowd": 0
     }
 
-def create_annotations(rd = 0):
-    images = []
-    annotations = []
-    image_id = 0
-    annotation_id = 0
-    cur_mask_dir = MASK_DIR
-    
-    for file_name in tqdm(os.listdir(cur_mask_dir)):
-        if not file_name.endswith(".png"):
+def annotate_mask(file_name, mask=None):
+    """
+    Image size and annotation (None for an empty mask) of one segmented
+    object, before ids are assigned. `mask` defaults to the file in MASK_DIR.
+    """
+    rdNum, class_id, instance_id = file_name.split("_")
+    if mask is None:
+        mask = cv2.imread(os.path.join(MASK_DIR, file_name), cv2.IMREAD_GRAYSCALE)
+    height, width = mask.shape[:2]
+    return {
+        "file_name": file_name,
+        "height": height,
+        "width": width,
+        "annotation": get_annotation_info(mask, 0, int(class_id), 0)
+    }
+
+
+def write_annotation_shard(rd, shard_idx, records):
+    """Save the annotate_mask records of one segmented micro-batch."""
+    if not os.path.exists(SHARD_DIR):
+        os.makedirs(SHARD_DIR)
+    shard_path = SHARD_DIR + '/rd{}_{:05d}.json'.format(rd, shard_idx)
+    with open(shard_path + '.tmp', "w") as f:
+        json.dump(records, f)
+    os.replace(shard_path + '.tmp', shard_path)
+
+
+def load_annotation_shards(rd=None):
+    """annotate_mask records of the streaming segmenter by file name, of round `rd` only if given."""
+    records = {}
+    if not os.path.exists(SHARD_DIR):
+        return records
+    prefix = 'rd{}_'.format(rd) if rd is not None else ''
+    for shard_name in sorted(os.listdir(SHARD_DIR)):
+        if not shard_name.endswith(".json") or not shard_name.startswith(prefix):
             continue
-        
-        rdNum, class_id, instance_id = file_name.split("_")
-        class_id = int(class_id)
-        
-        mask_path = os.path.join(cur_mask_dir, file_name)
-        mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
-        height, width = mask.shape[:2]
-        images.append(get_image_info(file_name, image_id, height, width))
-        
-
-        
-        annotation = get_annotation_info(mask, image_id, class_id, annotation_id)
-        if annotation:
-            annotations.append(annotation)
-            annotation_id += 1
-        
-        image_id += 1
-    
-    coco_format = {
-        "images": images,
-        "annotations": annotations
+        with open(os.path.join(SHARD_DIR, shard_name)) as f:
+            for record in json.load(f):
+                records[record["file_name"]] = record
+    return records
+
+
+def _annotate_masks(file_names, records, num_workers):
+    # masks already annotated by the streaming segmenter are not read again,
+    # contours of the others are extracted in a process pool
+    missing = [x for x in file_names if x not in records]
+    if len(missing) > 0:
+        with Pool(num_workers) as pool:
+            for record in tqdm(pool.imap(annotate_mask, missing, chunksize=16), total=len(missing)):
+                records[record["file_name"]] = record
+    return [records[x] for x in file_names]
+
+
+def _read_store_index():
+    entries = []
+    if os.path.exists(STORE_INDEX):
+        with open(STORE_INDEX) as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+    return entries
+
+
+def load_store_index():
+    """
+    Committed rounds of the store in commit order, as dicts of counts and
+    first ids. A round committed again replaces its earlier entry.
+    """
+    latest = {}
+    for e in _read_store_index():
+        latest.pop(e["rd"], None)
+        latest[e["rd"]] = e
+    return list(latest.values())
+
+
+def _masks_digest(file_names):
+    return hashlib.md5("\n".join(sorted(file_names)).encode()).hexdigest()
+
+
+def _store_parts(rd):
+    return STORE_DIR + '/rd{}_images.part'.format(rd), STORE_DIR + '/rd{}_annotations.part'.format(rd)
+
+
+def _store_columns(rd):
+    return STORE_DIR + '/rd{}_columns.npz'.format(rd)
+
+
+# columns of the compact annotation format, one row per annotated object;
+# file names are a flat blob sliced by the name offsets; masks are read
+# from the RGBA images, as with the json
+COLUMN_NAMES = ["image_id", "category_id", "bbox", "area", "size", "name_offsets", "names"]
+
+
+def _blob(items, dtype):
+    offsets = np.zeros(len(items) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in items], out=offsets[1:])
+    blob = np.concatenate([np.asarray(x, dtype=dtype) for x in items]) if len(items) else np.zeros(0, dtype=dtype)
+    return offsets, blob
+
+
+def _columns_from_records(records, image_ids):
+    annotated = [(r, i) for r, i in zip(records, image_ids) if r["annotation"]]
+    name_offsets, names = _blob([np.frombuffer(r["file_name"].encode(), dtype=np.uint8) for r, _ in annotated], np.uint8)
+    return {
+        "image_id": np.array([i for _, i in annotated], dtype=np.int64),
+        "category_id": np.array([r["annotation"]["category_id"] for r, _ in annotated], dtype=np.int32),
+        "bbox": np.array([r["annotation"]["bbox"] for r, _ in annotated], dtype=np.float32).reshape(-1, 4),
+        "area": np.array([r["annotation"]["area"] for r, _ in annotated], dtype=np.int64),
+        "size": np.array([[r["height"], r["width"]] for r, _ in annotated], dtype=np.int32).reshape(-1, 2),
+        "name_offsets": name_offsets,
+        "names": names,
     }
 
-    json_rd = OUTPUT_JSON + '/rd' + str(rd) + '_annotations.json'
-    json_done_path = OUTPUT_JSON + '/rd' + str(rd) + 'done.txt'
 
-    if not os.path.exists(OUTPUT_JSON): 
-        os.mkdir(OUTPUT_JSON)
-    
-    with open(json_rd, "w") as f:
-        json.dump(coco_format, f, indent=4)
-    
-    open(json_done_path, 'a').close()
+def add_round_to_store(rd, file_names, num_workers=8):
+    """
+    Annotate the masks of round `rd` and commit them to the store. Image and
+    annotation ids continue past every round committed before, so they never
+    change once written; a round committed again gets new ids. The parts of
+    a round are comma-separated json objects, ready to be spliced into a
+    merged file; the index line is appended last, so an index entry means a
+    complete round. The entry records the mask set it was built from.
+    """
+    entries = _read_store_index()
+    image_id = max([e["image_id"] + e["images"] for e in entries] + [0])
+    annotation_id = max([e["annotation_id"] + e["annotations"] for e in entries] + [0])
+    entry = {"rd": rd, "image_id": image_id, "annotation_id": annotation_id,
+             "masks": len(file_names), "masks_md5": _masks_digest(file_names)}
 
-    
-    print(f"COCO annotations saved to {json_rd}")
-    
-    
-def create_annotations_nocum(rd = 0):
     images = []
     annotations = []
-    image_id = 0
-    annotation_id = 0
-    cur_mask_dir = MASK_DIR
-    
-    for file_name in tqdm(os.listdir(cur_mask_dir)):
-        if not file_name.endswith(".png"):
-            continue
-        
-        rdNum, class_id, instance_id = file_name.split("_")
-        if rdNum != f'{rd:02}':
-            continue
-        class_id = int(class_id)
-        
-        mask_path = os.path.join(cur_mask_dir, file_name)
-        mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
-        height, width = mask.shape[:2]
-        images.append(get_image_info(file_name, image_id, height, width))
-        
-
-        
-        annotation = get_annotation_info(mask, image_id, class_id, annotation_id)
+    records = _annotate_masks(sorted(file_names), load_annotation_shards(rd), num_workers)
+    columns = _columns_from_records(records, range(image_id, image_id + len(records)))
+    for record in records:
+        images.append(json.dumps(get_image_info(record["file_name"], image_id, record["height"], record["width"])))
+        annotation = record["annotation"]
         if annotation:
-            annotations.append(annotation)
+            annotations.append(json.dumps(dict(annotation, id=annotation_id, image_id=image_id)))
             annotation_id += 1
-        
         image_id += 1
-    
-    coco_format = {
-        "images": images,
-        "annotations": annotations
-    }
+    entry.update(images=len(images), annotations=len(annotations))
+
+    if not os.path.exists(STORE_DIR):
+        os.makedirs(STORE_DIR)
+    for path, items in zip(_store_parts(rd), [images, annotations]):
+        with open(path + '.tmp', "w") as f:
+            f.write(", ".join(items))
+        os.replace(path + '.tmp', path)
+    np.savez(_store_columns(rd) + '.tmp.npz', **columns)
+    os.replace(_store_columns(rd) + '.tmp.npz', _store_columns(rd))
+    with open(STORE_INDEX, "a") as f:
+        f.write(json.dumps(entry) + "\n")
+    return entry
+
+
+def update_store(rd, num_workers=8):
+    """
+    Commit every round up to `rd` that has masks in MASK_DIR but is not in
+    the store yet, and commit again the rounds whose masks changed since
+    (masks written after their round was merged).
+    """
+    committed = {e["rd"]: e for e in load_store_index()}
+    per_round = {}
+    with os.scandir(MASK_DIR) as it:
+        for x in it:
+            if x.name.endswith(".png"):
+                per_round.setdefault(int(x.name.split("_")[0]), []).append(x.name)
+    for r in sorted(set(per_round) | set(committed)):
+        file_names = per_round.get(r, [])
+        if r > rd:
+            if r not in committed and len(file_names) > 0:
+                print("Skip {} masks of round {}, after round {}".format(len(file_names), r, rd))
+            continue
+        entry = committed.get(r)
+        if entry is None:
+            add_round_to_store(r, file_names, num_workers)
+        elif ("masks_md5" in entry and entry["masks_md5"] != _masks_digest(file_names)) or \
+                ("masks_md5" not in entry and entry["images"] != len(file_names)):
+            # entries of older stores have no digest, one image per mask
+            print("Round {} has {} masks, {} when committed, commit it again".format(
+                r, len(file_names), entry["images"]))
+            add_round_to_store(r, file_names, num_workers)
+
 
+def _write_annotations(rounds, rd):
+    """
+    Write rdN_annotations.json as the splice of the store parts of `rounds`,
+    without parsing them, then its done marker.
+    """
     json_rd = OUTPUT_JSON + '/rd' + str(rd) + '_annotations.json'
     json_done_path = OUTPUT_JSON + '/rd' + str(rd) + 'done.txt'
 
     if not os.path.exists(OUTPUT_JSON): 
         os.mkdir(OUTPUT_JSON)
-    
-    with open(json_rd, "w") as f:
-        json.dump(coco_format, f, indent=4)
+
+    entries = [e for e in load_store_index() if e["rd"] in rounds]
+    with open(json_rd + '.tmp', "w") as f:
+        for key, part in [("images", 0), ("annotations", 1)]:
+            f.write('{"images": [' if key == "images" else '], "annotations": [')
+            first = True
+            for e in entries:
+                if e[key] == 0:
+                    continue
+                if not first:
+                    f.write(", ")
+                with open(_store_parts(e["rd"])[part]) as src:
+                    shutil.copyfileobj(src, f)
+                first = False
+        f.write(']}')
+    os.replace(json_rd + '.tmp', json_rd)
+    _write_columns(entries, rd)
     
     open(json_done_path, 'a').close()
 
     
     print(f"COCO annotations saved to {json_rd}")
 
+
+def _write_columns(entries, rd):
+    """
+    Write the compact format next to rdN_annotations.json: a directory of
+    .npy columns over the store columns of `entries`, which the trainer
+    memory-maps instead of parsing the json. done.txt is written last.
+    """
+    columns_dir = OUTPUT_JSON + '/rd' + str(rd) + '_columns'
+    if not os.path.exists(columns_dir):
+        os.makedirs(columns_dir)
+    if os.path.exists(columns_dir + '/done.txt'):
+        os.remove(columns_dir + '/done.txt')
+    if not all(os.path.exists(_store_columns(e["rd"])) for e in entries):
+        # rounds stored before the compact format, readers use the json
+        print("No compact annotations for round {}, some rounds have no columns".format(rd))
+        return
+    parts = [np.load(_store_columns(e["rd"])) for e in entries]
+    for name in COLUMN_NAMES:
+        if name.endswith("_offsets"):
+            # shift the offsets of every round past the blobs before it
+            blob = name[:-len("_offsets")] if name != "name_offsets" else "names"
+            starts = np.cumsum([0] + [len(p[blob]) for p in parts[:-1]])
+            column = np.concatenate([[0]] + [p[name][1:] + start for p, start in zip(parts, starts)]).astype(np.int64)
+        elif len(parts):
+            column = np.concatenate([p[name] for p in parts])
+        else:
+            column = np.zeros(0)
+        np.save(columns_dir + '/' + name + '.npy', column)
+    open(columns_dir + '/done.txt', 'a').close()
+
+
+def create_annotations(rd = 0, num_workers = 8):
+    # every round so far; only the masks of new rounds are read
+    update_store(rd, num_workers)
+    _write_annotations(set(e["rd"] for e in load_store_index() if e["rd"] <= rd), rd)
+
+
+def create_annotations_nocum(rd = 0, num_workers = 8):
+    update_store(rd, num_workers)
+    _write_annotations({rd}, rd)
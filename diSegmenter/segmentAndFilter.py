@@ -7,9 +7,13 @@ import os
 import numpy as np
 from torchvision import transforms
 from transformers import CLIPProcessor, CLIPModel
-from create_annotation import create_annotations
+from create_annotation import create_annotations, annotate_mask, write_annotation_shard
+from segment_engine import SegmentEngine
 import argparse
 import ast
+import sys
+sys.path.append('..')
+from coordinator import Channel, GenerationManifest, wait_for
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -19,6 +23,11 @@ def parse_args():
     parser.add_argument("--start", type=int, default=0)
     parser.add_argument("--end", type=int, default=1203)
     parser.add_argument("--div", type=int, default=3)
+    parser.add_argument("--channel", default="", help="if not '', segment images as the generator publishes them on this SQLite channel")
+    parser.add_argument("--micro_batch", type=int, default=16, help="max images per annotation shard when streaming")
+    parser.add_argument("--bsz", type=int, default=16, help="images per BiRefNet / CLIP forward")
+    parser.add_argument("--workers", type=int, default=8, help="threads decoding images ahead of the GPU")
+    parser.add_argument("--manifest", default="", help="generation manifest, '' is manifest.db in the raw dir if it exists")
     args = parser.parse_args()
     return args
 
@@ -69,62 +78,54 @@ if __name__ == "__main__":
         "a photo of {} in a white background"
     ]
 
-    def extract_object(birefnet, imagepath):
-        # Data settings
-        # image_size = (1024, 1024)
-        image_size = (512, 512)
-        transform_image = transforms.Compose([
-            transforms.Resize(image_size),
-            transforms.ToTensor(),
-            transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-        ])
-        while not os.path.exists(imagepath):
-            time.sleep(1)
-
-        image = Image.open(imagepath)
-        input_images = transform_image(image).unsqueeze(0).to(device)
-
-        # Prediction
-        with torch.no_grad():
-            preds = birefnet(input_images)[-1].sigmoid().cpu()
-        pred = preds[0].squeeze()
-        pred_pil = transforms.ToPILImage()(pred)
-        mask = pred_pil.resize(image.size)
-        image.putalpha(mask)
-        return image, mask
-
-    
-    def filter_by_clip(classPrompt, image, clip, clipProcessor, device):
-
-        whiteBackground = Image.new("RGBA", image.size, (255, 255, 255, 255))
-        blackBackground = Image.new("RGBA", image.size, (0, 0, 0, 255))
-
-        image_w = Image.alpha_composite(whiteBackground, image)
-        image_b = Image.alpha_composite(blackBackground, image)
-
-
-        inputs = clipProcessor(text=[classPrompt], images=[image_w, image_b], return_tensors="pt", padding=True).to(device)
-        outputs = clip(**inputs)
-        logits_per_image = outputs.logits_per_image
-
-        if max([logits_per_image[0][0].item(), logits_per_image[1][0].item()]) < 25:
-            return True
-        return False
+    classPrompts = [template[0].format(cls) for cls in lvis_class_list]
+    engine = SegmentEngine(birefnet, clip, clipProcessor, classPrompts, device,
+                           batch_size=args.bsz, num_workers=args.workers)
 
     pathFormat = "/data3/objdet/lvis_feedback_sd3/raw"
     writePathFormat = "/data3/objdet/lvis_feedback_sd3/segmented"
     st_rd = args.st_rd
     numRounds = 30
+    channel = Channel(args.channel) if args.channel else None
+    manifestPath = args.manifest if args.manifest else pathFormat + "/manifest.db"
+    manifest = None
     # for each round segment objects
     for rd in range(st_rd, numRounds):
         numSelected = 0
         rawRoundPath = pathFormat
 
+        if channel is not None:
+            # segment images in micro-batches as soon as they are generated,
+            # annotating each batch into a shard that create_annotations
+            # merges; the round ends when all generator processes published
+            # their metadata
+            if not os.path.exists(writePathFormat):
+                os.mkdir(writePathFormat)
+            numSelList = [[] for x in range(len(lvis_class_list))]
+            numDiv = 1 if args.div == -1 else args.div
+            batches = channel.stream_batches('raw_image/rd{}'.format(rd), 'raw_done/rd{}'.format(rd), numDiv,
+                                             max_batch=args.micro_batch)
+            for shardIdx, batch in enumerate(batches):
+                shard = []
+                items = [(row['path'], writePathFormat + '/' + fileName, row['cls_index'] - 1) for fileName, row in batch]
+                for (imgpath, writePath, numGenIdx), masks in engine.run(items):
+                    if masks is not None:
+                        numSelList[numGenIdx].append(imgpath)
+                        shard.append(annotate_mask(os.path.basename(writePath), np.array(masks)))
+                        numSelected +=1
+                write_annotation_shard(rd, shardIdx, shard)
+            engine.flush()
+
+            f = open(writePathFormat + "/meta{}.txt".format(str(rd)), 'w')
+            f.write(str(numSelList))
+            f.close()
+            create_annotations(rd)
+            channel.publish('done', 'rd{}done.txt'.format(rd))
+            continue
+
         if args.div == -1:
             rawMetaPath = rawRoundPath + "/meta{}.txt".format(str(rd))
-            print("Wait for {}".format(rawMetaPath))
-            while not os.path.exists(rawMetaPath):
-                time.sleep(1)
+            wait_for(rawMetaPath)
             f = open("/data3/objdet/lvis_feedback_sd3/raw/meta{}.txt".format(str(rd)), 'r')
             numGenList = ast.literal_eval(f.read())
             f.close()
@@ -133,9 +134,7 @@ if __name__ == "__main__":
             numGenList = [0]*1203
             for i in range(args.div):
                 rawMetaPath = rawRoundPath + "/{}meta{}.txt".format(str(i), str(rd))
-                print("Wait for {}".format(rawMetaPath))
-                while not os.path.exists(rawMetaPath):
-                    time.sleep(1)
+                wait_for(rawMetaPath)
                 f = open("/data3/objdet/lvis_feedback_sd3/raw/{}meta{}.txt".format(str(i), str(rd)), 'r')
                 tempNumGenList = ast.literal_eval(f.read())
                 f.close()
@@ -148,12 +147,22 @@ if __name__ == "__main__":
 
         numSelList = [[] for x in range(len(numGenList))]
 
+        # the generator creates the manifest with its first sample, so it
+        # is only looked for once the metadata of the round is written
+        if manifest is None and os.path.exists(manifestPath):
+            manifest = GenerationManifest(manifestPath)
+
         # get number of generated object per class
-        for numGenIdx in range(len(numGenList)):
+        items = []
+        if manifest is not None:
+            # only the samples the generator recorded as finished
+            for entry in manifest.entries(rd):
+                writePath = writePathFormat + '/' + os.path.basename(entry['path'])
+                items.append((entry['path'], writePath, entry['cls_index'] - 1))
+        for numGenIdx in range(len(numGenList) if manifest is None else 0):
             
             numGen = numGenList[numGenIdx]
             className = f'{numGenIdx +1:04}'
-            classPrompt = template[0].format(lvis_class_list[numGenIdx])
             # segment images
             for genIdx in range(1,numGen+1):
                 rdNum = f'{rd:02}'
@@ -161,14 +170,14 @@ if __name__ == "__main__":
                 imgpath = rawRoundPath + '/' + rdNum + '_' + className + '_' + classGenNum + ".png"
                 writePath = writePathFormat + '/' + rdNum + '_'  + className + '_' + classGenNum + ".png"
                 # writePath2 = writePathFormat + "/rd" + str(rd) + "/" + className + '_' + classGenNum + 'real' + ".png"
-                image, masks = extract_object(birefnet, imagepath = imgpath)
-
-            # select images with clip
-
-                if not filter_by_clip(classPrompt, image, clip, clipProcessor, device):
-                    numSelList[numGenIdx].append(imgpath)
-                    masks.save(writePath)
-                    numSelected +=1
+                items.append((imgpath, writePath, numGenIdx))
+
+        # batches mix classes, results come back in order
+        for (imgpath, writePath, numGenIdx), masks in engine.run(items):
+            if masks is not None:
+                numSelList[numGenIdx].append(imgpath)
+                numSelected +=1
+        engine.flush()
 
         
         f = open("/data3/objdet/lvis_feedback_sd3/segmented/meta{}.txt".format(str(rd)), 'w')
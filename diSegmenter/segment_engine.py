@@ -0,0 +1,114 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import torch
+from PIL import Image
+from torchvision import transforms
+
+
+def load_image(imagepath):
+    # the generator may still be writing the image
+    while not os.path.exists(imagepath):
+        time.sleep(1)
+    image = Image.open(imagepath)
+    image.load()
+    return image
+
+
+class SegmentEngine:
+    """
+    Batched BiRefNet segmentation and CLIP filtering of generated images.
+
+    - images are decoded by a thread pool, one batch ahead of the GPU;
+    - BiRefNet runs on batches of `batch_size` 512 x 512 images;
+    - the CLIP text embedding of every class prompt is computed once;
+    - the CLIP image tower runs on the white and black composites of a
+      whole batch at once;
+    - masks are written by a background thread, call `flush` before reading
+      them back.
+
+    An object is kept if the larger of its two composite logits reaches
+    `clip_thresh`, the rule of the per-image filter used so far.
+    """
+    def __init__(self, birefnet, clip, clipProcessor, classPrompts, device,
+                 batch_size=16, num_workers=8, image_size=(512, 512), clip_thresh=25):
+        self.birefnet = birefnet
+        self.clip = clip
+        self.clipProcessor = clipProcessor
+        self.device = device
+        self.batch_size = batch_size
+        self.clip_thresh = clip_thresh
+        self.transform_image = transforms.Compose([
+            transforms.Resize(image_size),
+            transforms.ToTensor(),
+            transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+        ])
+        self.loader = ThreadPoolExecutor(num_workers)
+        self.writer = ThreadPoolExecutor(1)
+        self.pending = []
+        self.text_embeds = self.encode_prompts(classPrompts)
+
+    @torch.no_grad()
+    def encode_prompts(self, classPrompts, chunk=256):
+        embeds = []
+        for start in range(0, len(classPrompts), chunk):
+            inputs = self.clipProcessor(text=classPrompts[start:start + chunk], return_tensors="pt", padding=True).to(self.device)
+            embeds.append(self.clip.get_text_features(**inputs))
+        embeds = torch.cat(embeds)
+        return embeds / embeds.norm(p=2, dim=-1, keepdim=True)
+
+    @torch.no_grad()
+    def extract_objects(self, images):
+        input_images = torch.stack([self.transform_image(image) for image in images]).to(self.device)
+        preds = self.birefnet(input_images)[-1].sigmoid().cpu()
+        masks = []
+        for image, pred in zip(images, preds):
+            mask = transforms.ToPILImage()(pred.squeeze()).resize(image.size)
+            image.putalpha(mask)
+            masks.append(mask)
+        return masks
+
+    @torch.no_grad()
+    def select_by_clip(self, images, clsIdxs):
+        composites = []
+        for image in images:
+            whiteBackground = Image.new("RGBA", image.size, (255, 255, 255, 255))
+            blackBackground = Image.new("RGBA", image.size, (0, 0, 0, 255))
+            composites += [Image.alpha_composite(whiteBackground, image), Image.alpha_composite(blackBackground, image)]
+        inputs = self.clipProcessor(images=composites, return_tensors="pt").to(self.device)
+        image_embeds = self.clip.get_image_features(**inputs)
+        image_embeds = image_embeds / image_embeds.norm(p=2, dim=-1, keepdim=True)
+        # logits of each composite against the prompt of its own class
+        text_embeds = self.text_embeds[torch.as_tensor(clsIdxs, device=self.device).repeat_interleave(2)]
+        logits = self.clip.logit_scale.exp() * (image_embeds * text_embeds).sum(-1)
+        return (logits.view(-1, 2).max(dim=1)[0] >= self.clip_thresh).tolist()
+
+    def _write(self, mask, writePath):
+        self.pending.append(self.writer.submit(mask.save, writePath))
+
+    def run(self, items):
+        """
+        Segment and filter (imgpath, writePath, clsIdx) items, clsIdx being
+        the 0-based class of the prompt. Yields (item, mask) in input order,
+        mask being None for objects rejected by CLIP.
+        """
+        batches = [items[i:i + self.batch_size] for i in range(0, len(items), self.batch_size)]
+        if len(batches) == 0:
+            return
+        nextImages = [self.loader.submit(load_image, item[0]) for item in batches[0]]
+        for b, batch in enumerate(batches):
+            images = [f.result() for f in nextImages]
+            if b + 1 < len(batches):
+                nextImages = [self.loader.submit(load_image, item[0]) for item in batches[b + 1]]
+            masks = self.extract_objects(images)
+            keep = self.select_by_clip(images, [item[2] for item in batch])
+            for item, mask, k in zip(batch, masks, keep):
+                if k:
+                    self._write(mask, item[1])
+                yield item, mask if k else None
+
+    def flush(self):
+        """Wait until every mask is written."""
+        for f in self.pending:
+            f.result()
+        self.pending = []
@@ -0,0 +1,89 @@
+"""
+Compare the classifier-feedback modes of the SD3 pipeline on the same
+prompts: throughput (images/hour, including the feedback) and the
+classifier entropy of the finished images, the quantity the 'entropy'
+feedback pushes up.
+
+    python benchmark_guidance.py --ckpt_path ./ckpt_output/model_final.pth --modes full reuse reuse_tiny
+
+'full' runs the extra transformer pass of cond_fn, 'reuse' takes x0 from the
+denoising step, 'reuse_tiny' also swaps the VAE for --tiny_decoder in the
+feedback and 'none' generates without feedback.
+"""
+import time
+import argparse
+import numpy as np
+import torch
+import torchvision
+from diffusers import StableDiffusion3Pipeline, AutoencoderTiny
+from generation_config import GenerationConfig
+from generate import generate_batch, load_feedback_classifier, lvis_class_list
+
+MODES = {
+    'none': ('full', 'vae', 0.),
+    'full': ('full', 'vae', None),
+    'reuse': ('reuse', 'vae', None),
+    'reuse_tiny': ('reuse', 'tiny', None),
+}
+
+
+@torch.no_grad()
+def classifier_entropy(images, fg_classifier, fg_preprocessing):
+    logits = fg_classifier(fg_preprocessing(images.to("cuda", torch.bfloat16))).float()
+    prob = torch.nn.functional.softmax(logits, dim=-1)
+    return -(prob * torch.log(prob + 1e-12)).sum(-1).cpu().numpy()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cfg_path", default="MRCA_R50_feed.yaml")
+    parser.add_argument("--ckpt_path", required=True)
+    parser.add_argument("--modes", nargs='+', default=['full', 'reuse', 'reuse_tiny'], choices=list(MODES))
+    parser.add_argument("--num_images", type=int, default=32)
+    parser.add_argument("--bsz", type=int, default=8)
+    parser.add_argument("--fg_scale", type=float, default=0.03)
+    parser.add_argument("--tiny_decoder", default="madebyollin/taesd3")
+    parser.add_argument("--classes", nargs='+', default=['cat', 'teapot', 'skateboard', 'banana'])
+    args = parser.parse_args()
+
+    access_token = "your_access_token_here"  # Replace with your actual access token
+    pipe = StableDiffusion3Pipeline.from_pretrained("stabilityai/stable-diffusion-3-medium-diffusers",
+                                                    token=access_token, torch_dtype=torch.bfloat16)
+    pipe = pipe.to("cuda")
+    pipe.set_progress_bar_config(disable=True)
+    fgDecoders = {}
+    if any(MODES[m][1] == 'tiny' for m in args.modes):
+        fgDecoders['tiny'] = AutoencoderTiny.from_pretrained(args.tiny_decoder, torch_dtype=torch.bfloat16).to("cuda")
+        fgDecoders['tiny'].requires_grad_(False)
+
+    fg_classifier, _ = load_feedback_classifier(args.cfg_path, args.ckpt_path)
+    fg_classifier.eval()
+    fg_classifier.cuda()
+    fg_classifier.to(torch.bfloat16)
+    fg_preprocessing = torchvision.transforms.Compose(
+        [torchvision.transforms.Normalize(mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225))])
+
+    print("{:>12} {:>12} {:>14} {:>14}".format('mode', 'images/hour', 'entropy mean', 'entropy std'))
+    for mode in args.modes:
+        fg_mode, fg_decoder, fg_scale = MODES[mode]
+        genCfg = GenerationConfig()
+        for i in range(args.num_images):
+            className = args.classes[i % len(args.classes)]
+            genCfg.add_config(prompt="a photo of {}".format(className),
+                              fg_scale=args.fg_scale if fg_scale is None else fg_scale,
+                              cls_index=lvis_class_list.index(className) + 1, inst_index=i + 1,
+                              fg_mode=fg_mode, fg_decoder=fg_decoder)
+
+        # the first batch also warms up
+        entropy = []
+        torch.cuda.synchronize()
+        start = time.time()
+        for rows in genCfg.get_batches(args.bsz):
+            out = generate_batch(rows, pipe, fg_classifier, fg_preprocessing, fg_decoders=fgDecoders)
+            images = torch.stack([torchvision.transforms.functional.to_tensor(im) for im in out[0]])
+            entropy.append(classifier_entropy(images, fg_classifier, fg_preprocessing))
+        torch.cuda.synchronize()
+        elapsed = time.time() - start
+        entropy = np.concatenate(entropy)
+        print("{:>12} {:>12.0f} {:>14.4f} {:>14.4f}".format(
+            mode, args.num_images / elapsed * 3600, entropy.mean(), entropy.std()))
@@ -0,0 +1,104 @@
+import json
+import numpy as np
+
+
+def load_class_counts(path, num_classes):
+    """Training instances per class (1-based ids) from a `class_id: count` file."""
+    table = np.loadtxt(path, delimiter=':', dtype=np.int64, ndmin=2)
+    counts = np.zeros(num_classes, dtype=np.int64)
+    counts[table[:, 0] - 1] = table[:, 1]
+    return counts
+
+
+def load_val_ap(path):
+    """Per-class val AP, in class order, as written by the evaluator (per_class_mAP{idx}.json)."""
+    with open(path) as f:
+        return np.asarray(list(json.load(f).values()), dtype=np.float64)
+
+
+def scale_to_integers(ratios, total):
+    """
+    Integers proportional to `ratios` that sum to `total`: floor the scaled
+    ratios and give the remainder to the largest fractional parts, ties in
+    class order (the allocation of the old scale_ratios_to_integers).
+    """
+    ratios = np.asarray(ratios, dtype=np.float64)
+    scaled = ratios * total / ratios.sum()
+    counts = scaled.astype(np.int64)
+    diff = int(total - counts.sum())
+    order = np.argsort(counts - scaled, kind='stable')
+    counts[order[:diff]] += 1
+    return counts
+
+
+class BudgetPlanner:
+    """
+    Number of images to generate per class each round. The share of a class
+    is inversely proportional to its training instances, times the change
+    of its classifier weights since the last round and its val AP when
+    those are given. The budget is either a number of images or GPU-seconds,
+    converted with the per-image cost measured on the previous rounds.
+    """
+    def __init__(self, num_train, sec_per_image=None):
+        self.num_train = np.asarray(num_train, dtype=np.float64)
+        self.sec_per_image = sec_per_image
+        self._seconds = 0.
+        self._images = 0
+
+    @classmethod
+    def from_file(cls, path, num_classes, sec_per_image=None):
+        return cls(load_class_counts(path, num_classes), sec_per_image)
+
+    @property
+    def num_classes(self):
+        return len(self.num_train)
+
+    def record(self, seconds, num_images):
+        """Add a measurement of generation time, updating the per-image cost."""
+        self._seconds += seconds
+        self._images += num_images
+        if self._images > 0:
+            self.sec_per_image = self._seconds / self._images
+
+    def budget_images(self, gpu_seconds):
+        """Images that fit in `gpu_seconds`, None while the per-image cost is unknown."""
+        if not self.sec_per_image:
+            return None
+        return int(gpu_seconds // self.sec_per_image)
+
+    def ratios(self, cos_dist=None, val_ap=None):
+        ratios = 1. / self.num_train
+        if cos_dist is not None:
+            ratios = ratios * np.asarray(cos_dist, dtype=np.float64)
+        if val_ap is not None:
+            ratios = ratios * np.asarray(val_ap, dtype=np.float64)
+        return ratios
+
+    def plan(self, num_images, cos_dist=None, val_ap=None, mask=None):
+        """
+        Images per class, summing to `num_images` over all classes; classes
+        outside `mask` (a 0/1 vector, e.g. the classes of another --div) get
+        none but still take their share of the budget.
+        """
+        counts = scale_to_integers(self.ratios(cos_dist, val_ap), num_images)
+        if mask is not None:
+            counts = counts * np.asarray(mask, dtype=np.int64)
+        return counts
+
+    def balanced(self, per_class, mask=None):
+        counts = np.full(self.num_classes, per_class, dtype=np.int64)
+        if mask is not None:
+            counts = counts * np.asarray(mask, dtype=np.int64)
+        return counts
+
+    @staticmethod
+    def tasks(counts):
+        """
+        The plan as an (N, 2) array of (cls_index, inst_index), both 1-based,
+        in class order: the rows set_genCfg creates.
+        """
+        counts = np.asarray(counts, dtype=np.int64)
+        cls_index = np.repeat(np.arange(1, len(counts) + 1), counts)
+        starts = np.cumsum(counts) - counts
+        inst_index = np.arange(len(cls_index)) - np.repeat(starts, counts) + 1
+        return np.stack([cls_index, inst_index], axis=1)
@@ -0,0 +1,75 @@
+"""
+Check BudgetPlanner on CPU against the list-based allocation it replaced in
+generate.py, on synthetic class counts, classifier-weight distances and val
+AP vectors, and time both.
+
+    python check_budget_planner.py --trials 20
+"""
+import time
+import argparse
+import numpy as np
+from budget_planner import BudgetPlanner
+
+
+def reference_plan(numTrain, cos_dist, val_acc, numGen, genMaskList):
+    # the allocation of generate.py before BudgetPlanner
+    numGenRatio = [1 / x for x in numTrain]
+    if cos_dist is not None:
+        numGenRatio = [a * b for a, b in zip(cos_dist, numGenRatio)]
+    if val_acc is not None:
+        numGenRatio = [a * b for a, b in zip(val_acc, numGenRatio)]
+    scaled = [r * numGen / sum(numGenRatio) for r in numGenRatio]
+    int_values = [int(x) for x in scaled]
+    diff = numGen - sum(int_values)
+    decimal_parts = [(i, scaled[i] - int_values[i]) for i in range(len(numGenRatio))]
+    decimal_parts.sort(key=lambda x: x[1], reverse=True)
+    for i in range(diff):
+        int_values[decimal_parts[i % len(numGenRatio)][0]] += 1
+    return [a * b for a, b in zip(int_values, genMaskList)]
+
+
+def reference_tasks(numGenList):
+    return [(idx + 1, j + 1) for idx in range(len(numGenList)) for j in range(numGenList[idx])]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--classes", type=int, default=1203)
+    parser.add_argument("--num_gen", type=int, default=1203 * 4)
+    parser.add_argument("--trials", type=int, default=20)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    refTime = planTime = 0.
+    for trial in range(args.trials):
+        numTrain = rng.integers(1, 20000, args.classes)
+        cos_dist = rng.uniform(0.01, 2., args.classes) if trial % 2 else None
+        val_acc = rng.uniform(0., 1., args.classes) if trial % 3 else None
+        mask = np.zeros(args.classes, dtype=np.int64)
+        mask[np.array_split(np.arange(args.classes), 3)[trial % 3]] = 1
+
+        start = time.time()
+        ref = reference_plan(numTrain.tolist(), None if cos_dist is None else cos_dist.tolist(),
+                             None if val_acc is None else val_acc.tolist(), args.num_gen, mask.tolist())
+        refTasks = reference_tasks(ref)
+        refTime += time.time() - start
+
+        start = time.time()
+        planner = BudgetPlanner(numTrain)
+        counts = planner.plan(args.num_gen, cos_dist, val_acc, mask)
+        tasks = planner.tasks(counts)
+        planTime += time.time() - start
+
+        assert counts.tolist() == ref, "allocation differs in trial {}".format(trial)
+        assert [tuple(t) for t in tasks.tolist()] == refTasks, "tasks differ in trial {}".format(trial)
+
+    # GPU-second budget: unknown cost first, then the measured one
+    planner = BudgetPlanner(np.ones(args.classes))
+    assert planner.budget_images(3600.) is None
+    planner.record(100., 40)
+    planner.record(20., 8)
+    assert planner.budget_images(3600.) == 1440
+    assert planner.plan(planner.budget_images(3600.)).sum() == 1440
+
+    print("{} trials equal: reference {:.1f} ms, planner {:.1f} ms per plan".format(
+        args.trials, 1000 * refTime / args.trials, 1000 * planTime / args.trials))
@@ -5,16 +5,21 @@ import json, os
 import numpy as np
 import pandas as pd
 import time
-from diffusers import StableDiffusion3Pipeline
+import socket
+from diffusers import StableDiffusion3Pipeline, AutoencoderTiny
 # from diffusers import StableDiffusionPipeline # for stable diffusion 1.5
 from generation_config import GenerationConfig
-from load_model import load_model
+from prompt_cache import load_prompt_cache
+from budget_planner import BudgetPlanner, load_val_ap
+import sys
+sys.path.append('..')
+from coordinator import Channel, TaskLedger, GenerationManifest, sample_seed, wait_for
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--idx", type=int)
     parser.add_argument("--round", type=int, default=10)
-    parser.add_argument("--bsz", type=int, default=8)
+    parser.add_argument("--bsz", type=int, default=8, help="images per pipeline call, classes are mixed within a batch")
     parser.add_argument("--gpu", type=int, default=4)
     parser.add_argument("--n", type=int, default=40)
     parser.add_argument("--gPerRd", type=int, default=1203)
@@ -25,8 +30,19 @@ def parse_args():
     parser.add_argument("--ckpt_dir", default="./ckpt_output/") # checkpoint directory
     parser.add_argument("--st_rd", type=int, default=0)
     parser.add_argument("--div", type=int, default=-1)
+    parser.add_argument("--num_div", type=int, default=3, help="number of --div class ranges")
+    parser.add_argument("--ledger", default="", help="if not '', SQLite task ledger shared by any number of generators, replaces --div")
     parser.add_argument("--balanced", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0, help="base seed, every sample gets its own seed from it")
+    parser.add_argument("--manifest", default="", help="SQLite manifest of finished samples, '' is raw/manifest.db in --output_dir")
     parser.add_argument("--val_acc", type=int, default=1)
+    parser.add_argument("--gpu_seconds", type=float, default=0, help="if > 0, generation budget of a round in GPU-seconds instead of a fixed number of images")
+    parser.add_argument("--sec_per_image", type=float, default=0, help="generation cost of an image until one is measured, 0 is unknown")
+    parser.add_argument("--channel", default="", help="if not '', SQLite channel shared with the segmenter and the trainer")
+    parser.add_argument("--fg_mode", default="full", choices=["full", "reuse"], help="'reuse' takes the feedback x0 from the denoising step, no extra transformer pass")
+    parser.add_argument("--fg_decoder", default="vae", choices=["vae", "tiny"], help="decoder differentiated by the feedback, 'tiny' loads --tiny_decoder")
+    parser.add_argument("--tiny_decoder", default="madebyollin/taesd3", help="distilled SD3 latent decoder")
+    parser.add_argument("--prompt_cache", default="./prompt_cache/sd3_medium", help="prefix of the prompt-embedding cache, '' encodes prompts at every call")
     args = parser.parse_args()
     if 'PT_DATA_DIR' in os.environ:
         args.output_dir = os.path.join(os.environ['PT_DATA_DIR'], args.output_dir)
@@ -41,163 +57,136 @@ def calc_cos_between_mats(mat1, mat2):
 
     return distances
 
-def get_classifier(ckptDir, ckptPath, cfgPath, ckpt_done_path, rd):
+def feedback_paths(ckptPath):
+    # naming of mrca.modeling.feedback_classifier.feedback_paths, which needs detectron2
+    base = ckptPath[:-len('.pth')] if ckptPath.endswith('.pth') else ckptPath
+    return base + '_feedback.pt', base + '_clw.pt'
+
+
+def load_feedback_classifier(cfgPath, ckptPath):
+    """
+    The feedback classifier the trainer traced next to `ckptPath` and its
+    class-weight matrix. Only checkpoints without this export fall back to
+    building the full detector.
+    """
+    feedbackPath, clwPath = feedback_paths(ckptPath)
+    if os.path.exists(feedbackPath):
+        fg_classifier = torch.jit.load(feedbackPath, map_location='cuda')
+        curWeight = torch.load(clwPath, map_location='cpu')
+    else:
+        from load_model import load_model
+        fg_classifier = load_model(cfgPath, ckptPath)
+        curWeight = fg_classifier.roi_heads.box_predictor[-1].cls_score.weight.detach().cpu()
+    return fg_classifier, curWeight
+
+
+def get_classifier(ckptDir, ckptPath, cfgPath, ckpt_done_path, rd, channel=None):
 
     torch_dtype = torch.float32     
     cos_dist = None
+    clwDir = ckptDir + "clws"
     
     if rd == 0:
         return None, None
 
-    elif rd == 1:
-        print("Wait for {}".format(ckpt_done_path))
-        while not os.path.exists(ckpt_done_path):
-            time.sleep(1)
+    # read classifier at new round
+    wait_for(ckpt_done_path, channel)
 
+    if rd == 1:
         ckptPath = ckptDir  + "0.pth"
-        fg_classifier = load_model(cfgPath, ckptPath)
-        clwDir = ckptDir + "clws"
-
-        if not os.path.exists(clwDir): 
-            os.mkdir(clwDir)
-        
-        curWeight = fg_classifier.roi_heads.box_predictor[-1].cls_score.weight
-        # print(curWeight.shape)
-        clwPath = clwDir + "/clw{}.pt".format(rd)
-        if not os.path.exists(clwPath): 
-            torch.save(curWeight, clwPath)
+    fg_classifier, curWeight = load_feedback_classifier(cfgPath, ckptPath)
 
+    if not os.path.exists(clwDir): 
+        os.mkdir(clwDir)
 
+    clwPath = clwDir + "/clw{}.pt".format(rd)
+    if not os.path.exists(clwPath): 
+        torch.save(curWeight, clwPath)
 
-        fg_classifier.eval()
-        fg_classifier.cuda()
-        fg_classifier.to(torch_dtype)
-
-
-
-    else:
-        # read classifier at new round
-        print("Wait for {}".format(ckpt_done_path))
-        while not os.path.exists(ckpt_done_path):
-            time.sleep(1)
-
-        fg_classifier = load_model(cfgPath, ckptPath)
-        
-        clwPath = clwDir + "/clw{}.pt".format(rd)
+    if rd > 1:
         prevClwPath = clwDir + "/clw{}.pt".format(rd-1)
-
-        curWeight = fg_classifier.roi_heads.box_predictor[-1].cls_score.weight
-        if not os.path.exists(clwPath): 
-            torch.save(curWeight, clwPath)
         prevWeight = torch.load(prevClwPath , map_location=torch.device("cpu"))
-        curWeightCopy  = curWeight.detach().cpu()
+        cos_dist = calc_cos_between_mats(curWeight, prevWeight)
 
-        cos_dist = calc_cos_between_mats(curWeightCopy , prevWeight)
 
-
-        fg_classifier.eval()
-        fg_classifier.cuda()
-        fg_classifier.to(torch_dtype)
+    fg_classifier.eval()
+    fg_classifier.cuda()
+    fg_classifier.to(torch_dtype)
 
 
     return fg_classifier, cos_dist
 
 
-def generate_single_sample(row, pipe, fg_classifier, fg_preprocessing):
-    generator = torch.Generator(device='cuda')
-    generator.seed()
-
+def generate_batch(rows, pipe, fg_classifier, fg_preprocessing, prompt_cache=None, fg_decoders=None, seeds=None):
+    """
+    One pipeline call for rows sharing their guidance settings, any classes.
+    `fg_decoders` maps the fg_decoder names of the rows to loaded decoders,
+    'vae' (or a missing name) is the pipeline's own VAE. With `seeds`, each
+    row draws its initial noise from its own generator, so a sample does
+    not depend on the batch it lands in.
+    """
+    if seeds is not None:
+        generator = [torch.Generator(device='cuda').manual_seed(seed) for seed in seeds]
+    else:
+        generator = torch.Generator(device='cuda')
+        generator.seed()
+
+    prompts = [row['prompt'] for row in rows]
+    prompt_kwargs = {'prompt': prompts}
+    if prompt_cache is not None:
+        prompt_embeds, pooled_prompt_embeds = prompt_cache.get(prompts, pipe._execution_device)
+        negative_prompt_embeds, negative_pooled_prompt_embeds = prompt_cache.negative(len(rows), pipe._execution_device)
+        prompt_kwargs = {
+            'prompt_embeds': prompt_embeds,
+            'pooled_prompt_embeds': pooled_prompt_embeds,
+            'negative_prompt_embeds': negative_prompt_embeds,
+            'negative_pooled_prompt_embeds': negative_pooled_prompt_embeds,
+        }
 
     out = pipe(
-        prompt=row['prompt'],
-        guidance_scale=row['cfg'],
-        fg_criterion=row['fg_criterion'],
-        fg_scale=row['fg_scale'],
+        **prompt_kwargs,
+        guidance_scale=rows[0]['cfg'],
+        fg_criterion=rows[0]['fg_criterion'],
+        fg_scale=rows[0]['fg_scale'],
         fg_classifier=fg_classifier,
         fg_preprocessing=fg_preprocessing,
         generator=generator,
         num_inference_steps=30,
         num_images_per_prompt=1,
-        cls_index=row['cls_index'],
+        cls_index=[row['cls_index'] for row in rows],
+        fg_mode=rows[0]['fg_mode'],
+        fg_decoder=(fg_decoders or {}).get(rows[0]['fg_decoder']),
         guidance_freq=5,
         height=512,
         width=512,)
 
     return out
 
-def set_genCfg(genCfg, template, numGenList):
+def ledger_batches(ledger, rd, worker, bsz):
+    """Batches of rows claimed from the ledger until every row of round `rd` is done."""
+    while True:
+        claimed = ledger.claim_or_wait(rd, worker, bsz)
+        if len(claimed) == 0:
+            return
+        genCfg = GenerationConfig()
+        genCfg.config_list = [dict(row, task_id=taskId) for taskId, row in claimed]
+        for rows in genCfg.get_batches(bsz):
+            yield rows
+
 
+def set_genCfg(genCfg, template, tasks, fg_mode='full', fg_decoder='vae', rng=np.random):
+    """One row per (cls_index, inst_index) of `tasks`, with a random prompt template."""
     genCfg.reset()
 
-    for idx in range(len(lvis_class_list)):
-        for j in range(numGenList[idx]):
-            tmpidx = np.random.choice(range(len(template)))  
-            prompt = template[tmpidx].format(lvis_class_list[idx])
-            genCfg.add_config(prompt = prompt, cls_index = idx+1, inst_index = j+1)
+    tmpidx = rng.choice(len(template), size=len(tasks))
+    for (clsidx, instidx), t in zip(tasks.tolist(), tmpidx.tolist()):
+        prompt = template[t].format(lvis_class_list[clsidx - 1])
+        genCfg.add_config(prompt = prompt, cls_index = clsidx, inst_index = instidx, fg_mode = fg_mode, fg_decoder = fg_decoder)
 
 
     return
 
 
-def create_dict_from_file(file_path):
-    result_dict = {}
-    
-    with open(file_path, 'r') as file:
-        for line in file:
-            # Strip whitespace and split by ':'
-            parts = line.strip().split(':')
-            
-            # Check if the line has exactly two parts
-            if len(parts) == 2:
-                try:
-                    key = int(parts[0].strip())
-                    value = int(parts[1].strip())
-                    result_dict[key] = value
-                except ValueError:
-                    print(f"Skipping invalid line (non-integer values): {line.strip()}")
-            else:
-                print(f"Skipping malformed line: {line.strip()}")
-                
-    return result_dict
-
-
-def scale_ratios_to_integers(ratios, target_sum):
-    # Step 1: Scale ratios to target sum
-
-    scaled = [r * target_sum / sum(ratios) for r in ratios]
-
-    
-    # Step 2: Floor the scaled values to get initial integers
-    int_values = [int(x) for x in scaled]
-    
-    # Step 3: Calculate the rounding error
-    diff = target_sum - sum(int_values)
-    
-    # Step 4: Distribute the remaining difference
-    # Sort the scaled values based on their decimal parts
-    decimal_parts = [(i, scaled[i] - int_values[i]) for i in range(len(ratios))]
-    decimal_parts.sort(key=lambda x: x[1], reverse=True)
-    
-    for i in range(diff):
-        idx = decimal_parts[i % len(ratios)][0]
-        int_values[idx] += 1
-
-    return int_values
-
-
-def get_numTrain():
-    # get num train per class
-    numPerClass = create_dict_from_file("../datasets/metadata/lvisClassInst.txt")
-
-    numTrain = []
-    for i in range(len(lvis_class_list)):
-        numTrain.append(numPerClass[i+1]) 
-
-
-    return numTrain
-
-
-
 if __name__ == "__main__":
     args = parse_args()
 
@@ -209,11 +198,17 @@ if __name__ == "__main__":
    
     access_token = "your_access_token_here"  # Replace with your actual access token
 
-    pipe = StableDiffusion3Pipeline.from_pretrained("stabilityai/stable-diffusion-3-medium-diffusers", token=access_token, torch_dtype=torch.bfloat16)
+    modelId = "stabilityai/stable-diffusion-3-medium-diffusers"
+    pipe = StableDiffusion3Pipeline.from_pretrained(modelId, token=access_token, torch_dtype=torch.bfloat16)
     pipe = pipe.to("cuda")
     
 
 
+    fgDecoders = {}
+    if args.fg_decoder == 'tiny':
+        fgDecoders['tiny'] = AutoencoderTiny.from_pretrained(args.tiny_decoder, torch_dtype=torch.bfloat16).to("cuda")
+        fgDecoders['tiny'].requires_grad_(False)
+
     fg_preprocessing = torchvision.transforms.Compose(
         [torchvision.transforms.Normalize(mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225))])
     
@@ -229,27 +224,27 @@ if __name__ == "__main__":
         "a photo of {} in a white background"
     ]
 
+    # the prompts are the same every round: encode them once, then drop T5
+    promptCache = None
+    if args.prompt_cache:
+        promptCache = load_prompt_cache(pipe, modelId, template, lvis_class_list, args.prompt_cache)
+        pipe.text_encoder_3 = None
+        torch.cuda.empty_cache()
+
     genPerClass = 4
     numGen = 1203*genPerClass 
-    numGenThird = 1203 // 3
-
-    if args.div == -1:
-        genMaskList = [1]*numGen
-    elif args.div == 0:    
-        genMaskList = [1]*numGenThird
-        genMaskList += [0]*numGenThird
-        genMaskList += [0]*numGenThird
-    elif args.div == 1:
-        genMaskList = [0]*numGenThird
-        genMaskList += [1]*numGenThird
-        genMaskList += [0]*numGenThird
-    elif args.div == 2:
-        genMaskList = [0]*numGenThird
-        genMaskList += [0]*numGenThird
-        genMaskList += [1]*numGenThird
-
-
-    numTrain = get_numTrain()
+
+    if args.div == -1 or args.ledger:
+        genMaskList = [1]*1203
+    else:
+        # contiguous class ranges, the last classes included
+        genMaskList = [0]*1203
+        for c in np.array_split(np.arange(1203), args.num_div)[args.div]:
+            genMaskList[c] = 1
+
+
+    planner = BudgetPlanner.from_file("../datasets/metadata/lvisClassInst.txt", len(lvis_class_list),
+                                      args.sec_per_image if args.sec_per_image > 0 else None)
     numRounds = args.round
     ckptDir = args.ckpt_dir # output dir for reading checkpoints
     imgDir = args.output_dir # output dir for creating images
@@ -258,6 +253,16 @@ if __name__ == "__main__":
     period = 10000
     cos_dist = None
     val_acc = None
+    channel = Channel(args.channel) if args.channel else None
+    ledger = TaskLedger(args.ledger) if args.ledger else None
+    manifest = GenerationManifest(args.manifest if args.manifest else imgDir + "raw/manifest.db")
+    # the same name after a restart, so the claims of a crashed run are
+    # given back at once instead of after the claim timeout
+    workerName = "{}:{}".format(socket.gethostname(), args.gpu)
+    if ledger is not None:
+        released = ledger.release(workerName)
+        if released > 0:
+            print("Released {} rows claimed by an earlier run of {}".format(released, workerName))
 
 
     for rd in range(st_rd, numRounds):
@@ -279,34 +284,38 @@ if __name__ == "__main__":
 
 
 
-        fg_classifier, cos_dist = get_classifier(ckptDir, ckptPath, cfgPath, ckpt_done_path, rd)
+        fg_classifier, cos_dist = get_classifier(ckptDir, ckptPath, cfgPath, ckpt_done_path, rd, channel)
 
         # 2. set number of generated images per class
         if args.balanced == 0:
-            numGenRatio = [1 / x for x in numTrain]
-
-            if cos_dist is not None:
-                numGenRatio = [a * b for a, b in zip(cos_dist[1:], numGenRatio)]
-            
             if args.val_acc and rd>1:
                 idxt = (rd-2)*2+1
-                with open(ckptDir + 'inference_lvis_v1_val/per_class_mAP{}.json'.format(idxt)) as f:
-                    val_acc=list(json.load(f).values())
-            
-            if val_acc is not None:
-                numGenRatio = [a * b for a, b in zip(val_acc, numGenRatio)] 
+                val_acc = load_val_ap(ckptDir + 'inference_lvis_v1_val/per_class_mAP{}.json'.format(idxt))
 
-            numGenList= scale_ratios_to_integers(numGenRatio, numGen)
-            
-            numGenList= [a * b for a, b in zip(numGenList, genMaskList)]
+            numImages = numGen
+            if args.gpu_seconds > 0:
+                budgetImages = planner.budget_images(args.gpu_seconds)
+                if budgetImages is None:
+                    print("Round {}: no generation cost measured yet, generating {} images".format(rd, numGen))
+                else:
+                    numImages = budgetImages
+
+            numGenList = planner.plan(numImages,
+                                      cos_dist[1:].float().cpu().numpy() if cos_dist is not None else None,
+                                      val_acc, genMaskList)
 
         else:
-            numGenList = numGenList= [a* genPerClass  for a in genMaskList]
+            numGenList = planner.balanced(genPerClass, genMaskList)
+        numGenList = numGenList.tolist()
             
 
         # 3. set generation config
         genCfg = GenerationConfig()
-        set_genCfg(genCfg, template, numGenList)
+        # the prompts of a round only depend on the seed, so a restart plans the same rows
+        set_genCfg(genCfg, template, planner.tasks(numGenList), args.fg_mode, args.fg_decoder, np.random.default_rng([args.seed, rd]))
+        done = manifest.completed(rd)
+        if len(done) > 0:
+            print("Round {}: {} samples already generated".format(rd, len(done)))
 
 
         # 4. generate according to config
@@ -319,16 +328,57 @@ if __name__ == "__main__":
         if not os.path.exists(imgDir + "raw/rd{}".format(str(0))): 
             os.mkdir(imgDir + "raw/rd{}".format(str(0)))
 
-        for i in range (len(genCfg.config_list)):
-            row = genCfg.get_config(i)
-            image = generate_single_sample(row, pipe, fg_classifier, fg_preprocessing)
-
-            clsidx = row['cls_index']
-            instidx = row['inst_index']
-            rawSavePath = imgDir + "raw/{}_{}_{}.png".format(str(f'{rd:02}'), str(f'{clsidx:04}'), str(f'{instidx:04}'))  
-            image[0][0].save(rawSavePath)
+        if ledger is not None:
+            # every generator plans the round, the first one seeds the ledger
+            # and all of them claim batches from it until it is empty
+            ledger.seed(rd, genCfg.config_list)
+            batches = ledger_batches(ledger, rd, workerName, args.bsz)
+        else:
+            genCfg.config_list = [row for row in genCfg.config_list if (row['cls_index'], row['inst_index']) not in done]
+            batches = genCfg.get_batches(args.bsz)
+
+        roundStart, roundImages = time.time(), 0
+        for rows in batches:
+            if ledger is not None:
+                # rows finished before a restart are only marked complete
+                ledger.complete([row['task_id'] for row in rows if (row['cls_index'], row['inst_index']) in done])
+                rows = [row for row in rows if (row['cls_index'], row['inst_index']) not in done]
+                if len(rows) == 0:
+                    continue
+            seeds = [sample_seed(args.seed, rd, row['cls_index'], row['inst_index']) for row in rows]
+            image = generate_batch(rows, pipe, fg_classifier, fg_preprocessing, promptCache, fgDecoders, seeds)
+            roundImages += len(rows)
+
+            for row, rowImage, seed in zip(rows, image[0], seeds):
+                clsidx = row['cls_index']
+                instidx = row['inst_index']
+                rawSavePath = imgDir + "raw/{}_{}_{}.png".format(str(f'{rd:02}'), str(f'{clsidx:04}'), str(f'{instidx:04}'))  
+                # a crash never leaves a truncated file under the final name
+                rowImage.save(rawSavePath + '.tmp', format='PNG')
+                os.replace(rawSavePath + '.tmp', rawSavePath)
+                manifest.add(rd, clsidx, instidx, seed, rawSavePath)
+                if channel is not None:
+                    # the segmenter picks the image up right away
+                    channel.publish('raw_image/rd{}'.format(rd), os.path.basename(rawSavePath),
+                                    {'path': rawSavePath, 'cls_index': clsidx, 'inst_index': instidx})
+            if ledger is not None:
+                ledger.complete([row['task_id'] for row in rows])
+
+        # waiting on the ledger is counted too, it is part of the cost of an image
+        planner.record(time.time() - roundStart, roundImages)
 
         # 5. write metadata about generated data
+        if ledger is not None:
+            # one manifest for the round, written by the generator that
+            # completed it; the segmenter reads it as with --div -1
+            if ledger.finish(rd):
+                numGenList = ledger.num_per_class(rd, len(lvis_class_list))
+                f = open(imgDir + "raw/meta{}.txt".format(str(rd)), 'w')
+                f.write(str(numGenList))
+                f.close()
+                if channel is not None:
+                    channel.publish('raw_done/rd{}'.format(rd), 'ledger', numGenList)
+            continue
         if args.div == -1:
             f = open(imgDir + "raw/meta{}.txt".format(str(rd)), 'w')
             f.write(str(numGenList))
@@ -337,4 +387,6 @@ if __name__ == "__main__":
             f = open(imgDir + "raw/{}meta{}.txt".format(str(args.div), str(rd)), 'w')
             f.write(str(numGenList))
             f.close()
+        if channel is not None:
+            channel.publish('raw_done/rd{}'.format(rd), args.div, numGenList)
 
@@ -9,7 +9,8 @@ class GenerationConfig:
         self.total_gen = total_gen
         self.config_list = []
 
-    def add_config(self, prompt="", cfg=5.0, fg_criterion='entropy', fg_scale=0.03, cls_index=None, inst_index = None):
+    def add_config(self, prompt="", cfg=5.0, fg_criterion='entropy', fg_scale=0.03, cls_index=None, inst_index = None,
+                   fg_mode='full', fg_decoder='vae'):
         """
         Add a new generation configuration to the list.
 
@@ -19,6 +20,9 @@ class GenerationConfig:
         - fg_criterion (str): Criterion for selecting foreground objects.
         - fg_scale (float): Scale for foreground objects.
         - cls_index (int or None): Class index for generation.
+        - fg_mode (str): 'full' runs an extra transformer pass for the feedback,
+          'reuse' takes the x0 estimate from the denoising step.
+        - fg_decoder (str): 'vae' or 'tiny', the decoder differentiated by the feedback.
         """
         config = {
             "prompt": prompt,
@@ -27,6 +31,8 @@ class GenerationConfig:
             "fg_scale": fg_scale,
             "cls_index": cls_index,
             "inst_index": inst_index,
+            "fg_mode": fg_mode,
+            "fg_decoder": fg_decoder,
         }
         self.config_list.append(config)
 
@@ -47,5 +53,30 @@ class GenerationConfig:
         else:
             raise IndexError("Configuration index out of range.")
 
+    def get_batches(self, batch_size):
+        """
+        Group the configurations into batches for one pipeline call each.
+
+        Rows of different classes and prompts share a batch; only rows with
+        the same guidance settings (cfg, fg_criterion, fg_scale, fg_mode,
+        fg_decoder) do. Order is kept within every group.
+
+        Parameters:
+        - batch_size (int): Maximum number of configurations per batch.
+
+        Returns:
+        - list of list of dict: The batches.
+        """
+        groups = {}
+        for config in self.config_list:
+            key = (config["cfg"], config["fg_criterion"], config["fg_scale"],
+                   config["fg_mode"], config["fg_decoder"])
+            groups.setdefault(key, []).append(config)
+        batches = []
+        for rows in groups.values():
+            for start in range(0, len(rows), batch_size):
+                batches.append(rows[start:start + batch_size])
+        return batches
+
     def reset(self):
         self.config_list = []
\ No newline at end of file
@@ -813,6 +813,8 @@ class StableDiffusion3Pipeline(DiffusionPipeline, SD3LoraLoaderMixin, FromSingle
         guidance_freq=1,
         fg_preprocessing=None,
         cls_index=None,
+        fg_mode='full',
+        fg_decoder=None,
     ):
         r"""
         Function invoked when calling the pipeline for generation.
@@ -1107,7 +1109,20 @@ class StableDiffusion3Pipeline(DiffusionPipeline, SD3LoraLoaderMixin, FromSingle
                         prompt_embeds.chunk(2)[1] if self.do_classifier_free_guidance else prompt_embeds
                     )
 
-                    if i % guidance_freq == 0:
+                    if i % guidance_freq == 0 and fg_mode == 'reuse':
+                        grads = self.cond_fn_reuse(
+                            latents,
+                            i,
+                            noise_pred,
+                            fg_criterion,
+                            fg_scale,
+                            fg_classifier,
+                            fg_preprocessing,
+                            cls_index,
+                            fg_decoder,
+                        )
+                        latents += grads
+                    elif i % guidance_freq == 0:
                         grads = self.cond_fn(
                             latents,
                             timestep,
@@ -1194,12 +1209,16 @@ class StableDiffusion3Pipeline(DiffusionPipeline, SD3LoraLoaderMixin, FromSingle
         pooled_prompt_embeds,
         joint_attention_kwargs
     ):
+        num_samples = latents.shape[0]
         latents = latents.detach().requires_grad_()
 
+        # the unconditional and conditional halves both see the text
+        # embeddings and differ in the pooled projection only (what
+        # broadcasting a single sample against the guidance batch gave)
         noise_pred = self.transformer(
-                    hidden_states=latents,
-                    timestep=timestep,
-                    encoder_hidden_states=txt_embd,
+                    hidden_states=torch.cat([latents] * 2),
+                    timestep=timestep[:1].expand(2 * num_samples),
+                    encoder_hidden_states=torch.cat([txt_embd] * 2),
                     pooled_projections=pooled_prompt_embeds,
                     joint_attention_kwargs=joint_attention_kwargs,
                     return_dict=False,
@@ -1220,30 +1239,70 @@ class StableDiffusion3Pipeline(DiffusionPipeline, SD3LoraLoaderMixin, FromSingle
         image = self.process_image(sample)
         fg_criterion_func = self.compute_classifier_fg_criterion(fg_criterion, fg_classifier, fg_preprocessing, image, cls_index)
 
+        # one backward for the whole batch
         grads = torch.autograd.grad(fg_criterion_func, latents)[0]
-        grads_same_scale = grads / (grads.norm(2).detach() + 1e-8) * latents.norm(2).detach()
-        grads = grads_same_scale * fg_scale
 
-        return grads
+        return self.rescale_grads(grads, latents, fg_scale)
+
+    # cheap classifier feedback, reusing the noise prediction of the denoising step
+    @torch.enable_grad()
+    def cond_fn_reuse(
+        self,
+        latents,
+        index,
+        noise_pred,
+        fg_criterion,
+        fg_scale,
+        fg_classifier,
+        fg_preprocessing,
+        cls_index,
+        fg_decoder=None,
+    ):
+        """
+        The x0 estimate is built from `noise_pred` of the main step instead
+        of a second transformer pass, so only the decoder (`fg_decoder`, e.g.
+        a distilled tiny autoencoder, or the VAE) and the classifier are
+        differentiated. With the noise prediction held fixed, x0 moves one
+        for one with the latents, so its gradient is the latent gradient.
+        """
+        sigma = self.scheduler.sigmas[index]
+        sample = (latents - sigma * noise_pred).detach().requires_grad_()
+
+        image = self.process_image(sample, fg_decoder)
+        fg_criterion_func = self.compute_classifier_fg_criterion(fg_criterion, fg_classifier, fg_preprocessing, image, cls_index)
+
+        grads = torch.autograd.grad(fg_criterion_func, sample)[0]
+
+        return self.rescale_grads(grads, latents, fg_scale)
+
+    def rescale_grads(self, grads, latents, fg_scale):
+        # each sample rescaled on its own
+        dims = tuple(range(1, grads.dim()))
+        grads_same_scale = grads / (grads.norm(2, dim=dims, keepdim=True).detach() + 1e-8) * latents.norm(2, dim=dims, keepdim=True).detach()
+        return grads_same_scale * fg_scale
     
     def compute_classifier_fg_criterion(self, fg_criterion, fg_classifier, fg_preprocessing, image, cls_index):
         image_transformed = fg_preprocessing(image)
         # print(image_transformed.shape)
         logits = fg_classifier(image_transformed)
+        # cls_index is one index or one per sample; samples are independent,
+        # so the summed criterion gives each sample its own gradient
         if fg_criterion == 'loss':
             y = torch.zeros(*logits.shape)
-            y[0, cls_index] = 1
-            fg_criterion_func = torch.nn.functional.cross_entropy(logits, y.cuda(), reduction='none')
+            y[torch.arange(logits.shape[0]), torch.as_tensor(cls_index)] = 1
+            fg_criterion_func = torch.nn.functional.cross_entropy(logits, y.cuda(), reduction='none').sum()
         elif fg_criterion == 'entropy':
             prob = torch.nn.functional.softmax(logits, dim=-1)
-            fg_criterion_func = torch.nn.functional.cross_entropy(logits, prob, reduction='none').mean()
+            fg_criterion_func = torch.nn.functional.cross_entropy(logits, prob, reduction='none').sum()
         return fg_criterion_func
 
 
-    def process_image(self, sample):
+    def process_image(self, sample, decoder=None):
         sample = 1 / self.vae_scale_factor * sample
-        image = self.vae.decode(sample).sample
+        image = (decoder or self.vae).decode(sample).sample
         image = (image / 2 + 0.5)
-        image = image - image.min().detach()
-        image = image / image.max().detach()
+        # normalized per sample
+        dims = tuple(range(1, image.dim()))
+        image = image - image.amin(dim=dims, keepdim=True).detach()
+        image = image / image.amax(dim=dims, keepdim=True).detach()
         return image
\ No newline at end of file
@@ -0,0 +1,146 @@
+import os
+import json
+import fcntl
+import numpy as np
+import torch
+
+# integer type holding the raw bits of each float dtype, numpy has no bfloat16
+_BITS_DTYPE = {2: np.int16, 4: np.int32}
+
+
+def cache_paths(cache_prefix):
+    return cache_prefix + '_embeds.bin', cache_prefix + '_pooled.bin', cache_prefix + '_index.json'
+
+
+def _prompt(template, class_name):
+    # the empty key is the (empty) negative prompt
+    return template.format(class_name) if template else ''
+
+
+@torch.no_grad()
+def build_prompt_cache(pipe, model_id, templates, class_names, cache_prefix,
+                       max_sequence_length=256, batch_size=32):
+    """
+    Encode every template x class prompt, plus the empty negative prompt,
+    with the CLIP and T5 encoders of `pipe` once, into two flat files of
+    raw tensor bits (prompt embeds and pooled embeds, one row per prompt)
+    and a json index of (template, class name) keys. The index is written
+    last, so an existing index means a complete cache. Files are written
+    under per-process tmp names; load_prompt_cache serializes builders.
+
+    At SD3 size (333 x 4096 embeds, bfloat16) this is ~2.7 MB per prompt.
+    """
+    embeds_path, pooled_path, index_path = cache_paths(cache_prefix)
+    dirname = os.path.dirname(os.path.abspath(cache_prefix))
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    keys = [('', '')] + [(t, c) for t in templates for c in class_names]
+    tmp = '.{}.tmp'.format(os.getpid())
+    embeds_file = pooled_file = None
+    for start in range(0, len(keys), batch_size):
+        prompts = [_prompt(t, c) for t, c in keys[start:start + batch_size]]
+        prompt_embeds, _, pooled_prompt_embeds, _ = pipe.encode_prompt(
+            prompt=prompts,
+            prompt_2=None,
+            prompt_3=None,
+            do_classifier_free_guidance=False,
+            device=pipe._execution_device,
+            num_images_per_prompt=1,
+            max_sequence_length=max_sequence_length,
+        )
+        if embeds_file is None:
+            dtype = prompt_embeds.dtype
+            bits = _BITS_DTYPE[prompt_embeds.element_size()]
+            embeds_file = np.memmap(embeds_path + tmp, mode='w+', dtype=bits,
+                                    shape=(len(keys),) + tuple(prompt_embeds.shape[1:]))
+            pooled_file = np.memmap(pooled_path + tmp, mode='w+', dtype=bits,
+                                    shape=(len(keys),) + tuple(pooled_prompt_embeds.shape[1:]))
+        rows = slice(start, start + len(prompts))
+        embeds_file[rows] = prompt_embeds.to(dtype).view(getattr(torch, bits.__name__)).cpu().numpy()
+        pooled_file[rows] = pooled_prompt_embeds.to(dtype).view(getattr(torch, bits.__name__)).cpu().numpy()
+    embeds_file.flush()
+    pooled_file.flush()
+    index = {
+        'model_id': model_id,
+        'max_sequence_length': max_sequence_length,
+        'dtype': str(dtype).replace('torch.', ''),
+        'embeds_shape': list(embeds_file.shape),
+        'pooled_shape': list(pooled_file.shape),
+        'keys': keys,
+    }
+    del embeds_file, pooled_file
+    os.replace(embeds_path + tmp, embeds_path)
+    os.replace(pooled_path + tmp, pooled_path)
+    with open(index_path + tmp, 'w') as f:
+        json.dump(index, f)
+    os.replace(index_path + tmp, index_path)
+    print("Prompt cache with {} prompts saved to {}".format(len(keys), embeds_path))
+
+
+class PromptEmbeddingCache:
+    """
+    Read-only view over a cache written by `build_prompt_cache`. Rows are
+    looked up by prompt text and sliced out of memory maps, so generation
+    never runs the text encoders.
+    """
+    def __init__(self, cache_prefix):
+        embeds_path, pooled_path, index_path = cache_paths(cache_prefix)
+        with open(index_path) as f:
+            self.index = json.load(f)
+        self.dtype = getattr(torch, self.index['dtype'])
+        bits = _BITS_DTYPE[torch.tensor([], dtype=self.dtype).element_size()]
+        self.embeds = np.memmap(embeds_path, mode='r', dtype=bits, shape=tuple(self.index['embeds_shape']))
+        self.pooled = np.memmap(pooled_path, mode='r', dtype=bits, shape=tuple(self.index['pooled_shape']))
+        self.rows = {_prompt(t, c): i for i, (t, c) in enumerate(self.index['keys'])}
+
+    def matches(self, model_id, templates, class_names, max_sequence_length=256):
+        keys = [('', '')] + [(t, c) for t in templates for c in class_names]
+        return (self.index['model_id'] == model_id
+                and self.index['max_sequence_length'] == max_sequence_length
+                and [tuple(k) for k in self.index['keys']] == keys)
+
+    def _rows(self, data, rows, device):
+        bits = torch.from_numpy(np.ascontiguousarray(data[rows]))
+        return bits.view(self.dtype).to(device)
+
+    def get(self, prompts, device):
+        """(prompt_embeds, pooled_prompt_embeds) of a list of cached prompts."""
+        rows = [self.rows[p] for p in prompts]
+        return self._rows(self.embeds, rows, device), self._rows(self.pooled, rows, device)
+
+    def negative(self, num, device):
+        """(negative_prompt_embeds, negative_pooled_prompt_embeds) of the empty prompt, num times."""
+        return self.get([''] * num, device)
+
+
+def _matching_cache(model_id, templates, class_names, cache_prefix, max_sequence_length):
+    if os.path.exists(cache_paths(cache_prefix)[-1]):
+        cache = PromptEmbeddingCache(cache_prefix)
+        if cache.matches(model_id, templates, class_names, max_sequence_length):
+            return cache
+    return None
+
+
+def load_prompt_cache(pipe, model_id, templates, class_names, cache_prefix, max_sequence_length=256):
+    """
+    The cache at `cache_prefix`, (re)built first if missing or made for other
+    prompts or another model. Workers sharing the prefix build it once: the
+    builder holds a lock on `cache_prefix`.lock, the others wait for it and
+    load its cache.
+    """
+    cache = _matching_cache(model_id, templates, class_names, cache_prefix, max_sequence_length)
+    if cache is not None:
+        return cache
+    dirname = os.path.dirname(os.path.abspath(cache_prefix))
+    if not os.path.exists(dirname):
+        os.makedirs(dirname, exist_ok=True)
+    with open(cache_prefix + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            cache = _matching_cache(model_id, templates, class_names, cache_prefix, max_sequence_length)
+            if cache is None:
+                build_prompt_cache(pipe, model_id, templates, class_names, cache_prefix, max_sequence_length)
+                cache = PromptEmbeddingCache(cache_prefix)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return cache
@@ -88,6 +88,7 @@ def add_bsgal_config(cfg):
         _C.MODEL.SWIN = CN()
     _C.MODEL.SWIN.SIZE = 'T' # 'T', 'S', 'B'
     _C.MODEL.SWIN.USE_CHECKPOINT = False
+    _C.MODEL.SWIN.USE_SDPA = False # F.scaled_dot_product_attention in the window attention, torch >= 2.1
     _C.MODEL.SWIN.OUT_FEATURES = (1, 2, 3) # FPN stride 8 - 32
 
     _C.MODEL.TIMM = CN()
@@ -115,6 +116,7 @@ def add_bsgal_config(cfg):
     _C.DATALOADER.TARFILE_PATH = 'datasets/imagenet/metadata-22k/tar_files.npy'
     _C.DATALOADER.TAR_INDEX_DIR = 'datasets/imagenet/metadata-22k/tarindex_npy'
     _C.DATALOADER.PREFETCH_FACTOR = 2
+    _C.DATALOADER.SHARED_DATASET_DIR = '' # tmpfs dir (e.g. /dev/shm) for the serialized self-copy sources of CopyPasteMapper shared by all processes, '' keeps them in-process
     
     _C.SOLVER.USE_CUSTOM_SOLVER = False
     _C.SOLVER.OPTIMIZER = 'SGD'
@@ -175,11 +177,20 @@ def add_bsgal_config(cfg):
     _C.INPUT.INST_POOL_AREA_CERTAINTY = 0.0
     _C.INPUT.INST_POOL_FORMAT = 'RGB'
     _C.INPUT.INST_POOL_MAX_SAMPLES = 20
+    _C.INPUT.INST_POOL_BANK = False # read pasted objects from a per-round memory-mapped bank
+    _C.INPUT.INST_POOL_BANK_CROP = False # crop bank tiles to the thresholded largest part: objects are pasted larger, small masks are dropped
+    _C.INPUT.INST_POOL_BANK_TIMEOUT = 3600 # seconds the other ranks wait for the main process to build the bank
+    _C.INPUT.BATCHED_PASTE = False # composite all pasted objects of an image in one pass
+    _C.INPUT.TILE_PASTE = False # keep pasted objects as cropped tiles, implies BATCHED_PASTE
+    _C.INPUT.PACKED_MASKS = False # return gt_masks bit-packed from dataloader workers
+    _C.INPUT.SYN_COLUMNS = False # memory-map rdN_columns written by diSegmenter instead of parsing rdN_annotations.json
+    _C.INPUT.CHANNEL_PATH = '' # SQLite file shared with generator/diSegmenter (--channel), '' polls marker files
     _C.INPUT.ACTIVE_SELECT = False
     _C.INPUT.ACTIVE_SELECT_TYPE = 'train'
     _C.INPUT.ROUND_RESET = True
     _C.INPUT.INIT_ROUND = False
     _C.INPUT.NUM_ROUNDS = 10
+    _C.INPUT.PERSISTENT_ROUNDS = False # train all rounds in one process, keeping model, optimizer and dataloader workers
     _C.INPUT.SEPARATE_SYN = False
     _C.INPUT.SEPERATE_SUP = False
     _C.INPUT.USE_COLOR_JITTER = False
@@ -188,7 +199,7 @@ def add_bsgal_config(cfg):
     _C.INPUT.COLOR_JITTER_USE_TORCHVISION = False
     _C.INPUT.LIMIT_SRC_LSJ = False
     _C.USE_LARGEST_PART = True
-    _C.INPUT.CP_METHOD= ['basic']
+    _C.INPUT.CP_METHOD= ['basic'] # 'alpha' 'gaussian' 'possion', 'possion_roi' solves only on the object box
     _C.INPUT.RANDOM_ROTATE=False
     _C.INPUT.COLOR_AUG= False
     _C.INPUT.ONLY_RC = False
@@ -0,0 +1,63 @@
+import sys
+import copy
+import numpy as np
+import torch
+
+# bytes of array data copied while mapping the current sample, per worker
+_copied_bytes = 0
+
+
+def array_nbytes(x):
+    """Bytes held by the numpy arrays / tensors reachable from `x`."""
+    if isinstance(x, np.ndarray):
+        return x.nbytes
+    if isinstance(x, torch.Tensor):
+        return x.numel() * x.element_size()
+    if isinstance(x, dict):
+        return sum(array_nbytes(v) for v in x.values())
+    if isinstance(x, (list, tuple)):
+        return sum(array_nbytes(v) for v in x)
+    if hasattr(x, 'get_fields'):
+        return array_nbytes(x.get_fields())
+    if hasattr(x, 'tensor'):
+        return array_nbytes(x.tensor)
+    if hasattr(x, 'bits'):
+        return array_nbytes(x.bits)
+    return 0
+
+
+def object_nbytes(x):
+    """
+    Bytes a deepcopy of `x` allocates: its arrays / tensors and its python
+    containers; immutable scalars and strings are shared, not copied.
+    """
+    if isinstance(x, dict):
+        return sys.getsizeof(x) + sum(object_nbytes(v) for v in x.values())
+    if isinstance(x, (list, tuple)):
+        return sys.getsizeof(x) + sum(object_nbytes(v) for v in x)
+    return array_nbytes(x)
+
+
+def record_copy(x):
+    global _copied_bytes
+    _copied_bytes += array_nbytes(x)
+    return x
+
+
+def copy_array(x):
+    """Copy of a numpy array or tensor that is about to be written in place."""
+    x = x.clone() if isinstance(x, torch.Tensor) else x.copy()
+    return record_copy(x)
+
+
+def counted_deepcopy(x):
+    global _copied_bytes
+    x = copy.deepcopy(x)
+    _copied_bytes += object_nbytes(x)
+    return x
+
+
+def pop_copied_bytes():
+    global _copied_bytes
+    copied, _copied_bytes = _copied_bytes, 0
+    return copied
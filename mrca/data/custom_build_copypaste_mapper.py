@@ -10,8 +10,20 @@ from detectron2.data import transforms as T
 import detectron2.utils.comm as comm
 from detectron2.structures import BitMasks, Boxes, Instances
 from mrca.data.transforms.custom_cp_method import blend_image
+from mrca.data.transforms.custom_mask_ops import PackedMasks, get_bboxes
+from mrca.data.transforms.custom_compositor import composite_instances
+from mrca.data.copy_stats import counted_deepcopy, pop_copied_bytes, record_copy
+from mrca.data.inst_bank import InstBank, bank_paths, build_inst_bank, get_largest_connect_component
+from mrca.data.inst_sampler import InstSampler
+from mrca.data.syn_columns import SynColumns, columns_dir, has_syn_columns
+from mrca.data.shared_dataset import SharedDatasetList, IndexedDataset
+from detectron2.data.common import DatasetFromList
+import atexit
+import hashlib
+import multiprocessing
 import sys
 sys.path.append('tools')
+from coordinator import Channel, wait_for, mark_done
 from mrca.data.dataset_mapper import DatasetMapper
 # from lvis_my.lvis_categories_tr import LVIS_CATEGORIES,RARE_ID_SET,COMMON_ID_SET,FREQ_ID_SET,FULL_ID_SET,\
 #     EMPTY_ID_SET,NAME2ID,ID2NAME,ID2FREQ
@@ -35,7 +47,6 @@ from PIL import Image,ImageFile
 import albumentations 
 import subprocess
 import re
-import time
 
 def get_gpu_memory_usage():
     command = 'nvidia-smi --query-gpu=memory.used,memory.total --format=csv,nounits,noheader'
@@ -46,18 +57,6 @@ def get_gpu_memory_usage():
         memory_used, memory_total = map(int, re.findall(r'\d+', line))
         return memory_total
 ImageFile.LOAD_TRUNCATED_IMAGES = True
-def get_largest_connect_component(img): 
-    contours, _ = cv2.findContours(img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    area = []
-    for i in range(len(contours)):
-        area.append(cv2.contourArea(contours[i]))
-    if len(area) >= 1:
-        max_idx = np.argmax(area)
-        img2=np.zeros_like(img)
-        cv2.fillPoly(img2, [contours[max_idx]], 1)
-        return img2
-    else:
-        return img
 
 def pad_to_hw(data, h, w, y_start, x_start):
     M=np.float32([[1,0,x_start],[0,1,y_start]])
@@ -89,32 +88,48 @@ def start_xy(data_dict,bb,train_size):
     data_dict['gt_bboxes']=get_bboxes(data_dict['gt_masks'])
     return data_dict
 
+def random_start_tile(data_dict,train_size):
+    # same placement draw as random_start_xy, without padding to the canvas
+    h_train, w_train = train_size
+    x_mid=data_dict['gt_bboxes'][:,0::2].mean()
+    y_mid=data_dict['gt_bboxes'][:,1::2].mean()
+    x_start, y_start = np.random.randint(-x_mid, w_train-x_mid), np.random.randint(-y_mid, h_train-y_mid)
+    return start_tile(data_dict,[x_start, y_start],train_size)
+
+def start_tile(data_dict,bb,train_size):
+    """
+    Keep the object as its (H,W,C) crop clipped to the canvas, stored CHW
+    together with 'tile_offset' (x, y) of its top-left corner. Gives the same
+    pixels as start_xy, whose integer warpAffine shift is an exact copy.
+    """
+    h,w = data_dict['image'].shape[:2]
+    h_train, w_train = train_size
+    x_start, y_start = int(bb[0]), int(bb[1])
+    x0, y0 = min(max(x_start,0),w_train), min(max(y_start,0),h_train)
+    x1, y1 = max(min(x_start+w,w_train),x0), max(min(y_start+h,h_train),y0)
+    for k in ['image', 'gt_masks']:
+        data = data_dict[k][y0-y_start:y1-y_start, x0-x_start:x1-x_start]
+        data_dict[k] = np.ascontiguousarray(data.transpose(2, 0, 1))
+    data_dict['tile_offset'] = (x0, y0)
+    box = get_bboxes(data_dict['gt_masks'])
+    if box.any():
+        box += np.array([x0, y0, x0, y0], dtype=np.float32)
+    data_dict['gt_bboxes'] = box
+    return data_dict
+
 def convert_instance_to_dict(x):
     inst = x['instances']
+    masks = inst.get('gt_masks')
+    masks = masks.to_dense() if isinstance(masks, PackedMasks) else masks.tensor.numpy()
     return {'image' : x['image'].numpy(), 'file_name':x['file_name'],
-        'gt_bboxes': inst.get('gt_boxes').tensor.numpy(), 'gt_labels': inst.get('gt_classes').numpy(), 'gt_masks':inst.get('gt_masks').tensor.numpy()}
+        'gt_bboxes': inst.get('gt_boxes').tensor.numpy(), 'gt_labels': inst.get('gt_classes').numpy(), 'gt_masks':masks}
 
 def get_updated_masks(masks, composed_mask):
     assert masks.shape[-2:] == composed_mask.shape[-2:], \
         'Cannot compare two arrays of different size {} {}'.format(masks.shape, composed_mask.shape)
-    masks = np.where(composed_mask, 0, masks)
+    masks = record_copy(np.where(composed_mask, 0, masks))
     return masks
 
-def get_bboxes(masks):
-    num_masks = len(masks)
-    boxes = np.zeros((num_masks, 4), dtype=np.float32)
-    x_any = masks.any(axis=1)
-    y_any = masks.any(axis=2)
-    for idx in range(num_masks):
-        x = np.where(x_any[idx, :])[0]
-        y = np.where(y_any[idx, :])[0]
-        if len(x) > 0 and len(y) > 0:
-            # use +1 for x_max and y_max so that the right and bottom
-            # boundary of instance masks are fully included by the box
-            boxes[idx, :] = np.array([x[0], y[0], x[-1] + 1, y[-1] + 1],
-                                        dtype=np.float32)
-    return boxes
-
 class InstPool:
     def __init__(self, json_file, image_root, train_size, max_samples=20, image_format="BGR",use_largest_part=True,random_rotate=False,cp_method=['basic'],color_aug=False,transition_matrix_path='',active_select=False) -> None:
         self.max_gpu_memory = get_gpu_memory_usage()
@@ -175,6 +190,8 @@ class InstPool:
             self.transition_matrix = self.transition_matrix[1:, 1:]
             self.binary_transition_matrix = np.zeros_like(self.transition_matrix)
             self.binary_transition_matrix[self.transition_matrix > 0] = 1
+        self.sampler = InstSampler(self.per_cat_pool, len(self.dataset),
+            self.transition_matrix if len(self.transition_matrix_path) > 0 else None)
         self.active_select = active_select
         if self.active_select:
             # 根据 self.dataset,生成每个category的pool
@@ -194,7 +211,8 @@ class InstPool:
 
     def get_mix_result(self, sample_type='random', cids=None,data_dict=None,reference=None):
         results_origin=data_dict
-        data_dict=convert_instance_to_dict(copy.deepcopy(data_dict))
+        # arrays of data_dict are only read, the paste builds new ones
+        data_dict=convert_instance_to_dict(data_dict)
         data_dict['instance_source']=np.zeros_like(data_dict['gt_labels'])
         label_dict = data_dict['gt_labels'].copy()
         label_set = set(label_dict)
@@ -205,14 +223,14 @@ class InstPool:
             print("reference not Exist!")
             num_sample = np.random.randint(0, self.max_samples)
             if sample_type == 'random':
-                ids = self._get_random_samples(num_sample)
+                ids = self.sampler.sample(num_sample, 'random').tolist()
             elif sample_type == 'cas_random':
-                ids = self._get_cls_balanced_random_samples(num_sample)
+                ids = self.sampler.sample(num_sample, 'cas_random').tolist()
             elif sample_type == 'cats_random':
                 # assert cids is not None and len(cids)
                 if len(cids) ==0:
                     cids = None
-                ids = self._get_cls_balanced_random_samples(num_sample, cids=cids)
+                ids = self.sampler.sample(num_sample, 'cas_random', cids=cids).tolist()
                 try:
                     results_origin['paste_filename_list'] = results['file_name_list'].tolist()[-results['instance_source'].sum():]
                 except:
@@ -269,126 +287,13 @@ class InstPool:
         results_origin['instances'].instance_source=torch.tensor(data_dict['instance_source'], dtype=torch.int64)
         return results_origin
 
-    def _get_cls_balanced_random_samples(self, nums, cids = None):
-        if cids is None :
-            cats_pool = [self.per_cat_pool[x] for x in self.per_cat_pool if len(self.per_cat_pool[x])>0]
-        else :
-            cats_pool = [self.per_cat_pool[x] for x in cids if len(self.per_cat_pool[x])>0]
-        idxs = []
-        if len(cats_pool)==0:
-            return []
-        for _ in range(nums):
-            cid = np.random.randint(0, len(cats_pool))
-            id_in_cat = np.random.randint(0, len(cats_pool[cid]))
-            id = cats_pool[cid][id_in_cat]
-            idxs.append(id)
-        return idxs
-    
-    def _get_cls_balanced_random_samples(self, nums, cids = None):
-        if cids is None :
-            cats_pool = [self.per_cat_pool[x] for x in self.per_cat_pool if len(self.per_cat_pool[x])>0]
-        else :
-            cats_pool = [self.per_cat_pool[x] for x in cids if len(self.per_cat_pool[x])>0]
-        idxs = []
-        if len(cats_pool)==0:
-            return []
-        for _ in range(nums):
-            cid = np.random.randint(0, len(cats_pool))
-            id_in_cat = np.random.randint(0, len(cats_pool[cid]))
-            id = cats_pool[cid][id_in_cat]
-            idxs.append(id)
-        #assert self.idx_to_cat[id] in cids
-        return idxs
-    
-    def _get_one_class_random_samples(self, nums, cids = None):
-        if cids is None :
-            cats_pool = [self.per_cat_pool[x] for x in self.per_cat_pool if len(self.per_cat_pool[x])>0]
-        else :
-            cats_pool = [self.per_cat_pool[x] for x in cids if len(self.per_cat_pool[x])>0]
-        idxs = []
-        if len(cats_pool)==0:
-            return []
-        cid = np.random.randint(0, len(cats_pool))
-        #print('choose class:',cid)
-        if nums == 0:
-            nums  = 1 # 保证每次至少有一个贴图
-        for _ in range(nums):
-            id_in_cat = np.random.randint(0, len(cats_pool[cid]))
-            id = cats_pool[cid][id_in_cat]
-            idxs.append(id)
-        if cids is not None :
-            assert self.idx_to_cat[id] in cids
-        return idxs
-
-    def _get_cls_prob_random_samples(self, nums,label_list):
-        cats_pool = [self.per_cat_pool[x] for x in self.per_cat_pool  if len(self.per_cat_pool[x])>0]
-        idxs = []
-        # 从distribution中采样
-        distribuion = self.transition_matrix[label_list].sum(axis=0)
-        # if  int(distribuion.sum()) != len(label_list):
-        #     print("distribuion.sum() != len(label_list)", distribuion.sum(), len(label_list))
-        if distribuion.sum() > 0:
-            distribuion = (distribuion) / (distribuion.sum())
-        else:
-            distribuion = np.ones(distribuion.shape[0]) / distribuion.shape[0]
-        for _ in range(nums):
-            cid = np.random.choice(distribuion.shape[0], p=distribuion)
-            id_in_cat = np.random.randint(0, len(cats_pool[cid]))
-            id = cats_pool[cid][id_in_cat]
-            idxs.append(id)
-        return idxs
-    def _get_cls_prob_binary_random_samples(self, nums,label_list):
-        cats_pool = [self.per_cat_pool[x] for x in self.per_cat_pool  if len(self.per_cat_pool[x])>0]
-        assert len(cats_pool) == 1203
-        idxs = []
-        # 从distribution中采样
-        distribuion = self.transition_matrix[label_list].sum(axis=0)
-        distribuion_binary = distribuion.copy()
-        distribuion_binary[distribuion_binary > 0] = 1
-        # rare_sum = distribuion_binary[RARE_LIST].sum()
-        NON_ZERO_ID_SET = set(np.nonzero(distribuion_binary)[0])
-        # NOT_RARE_ID_SET = NON_ZERO_ID_SET - RARE_ID_SET
-        NOT_RARE_ID_SET = NON_ZERO_ID_SET # - RARE_ID_SET
-        NOT_RARE_LIST = list(NOT_RARE_ID_SET)
-        # random mask NOT_RARE_LIST to keep balance of rare and non-rare
-        # mask_num = len(NOT_RARE_LIST) - rare_sum
-        mask_num = len(NOT_RARE_LIST) # - rare_sum
-        MASK_LIST = np.random.choice(NOT_RARE_LIST, int(mask_num), replace=False)
-        try:
-            distribuion_binary[MASK_LIST] = 0
-        except:
-            print("error")
-        if distribuion_binary.sum() == 0:
-            distribuion_binary += 1 
-        distribuion_binary = distribuion_binary / distribuion_binary.sum()
-        for _ in range(nums):
-            cid = np.random.choice(distribuion.shape[0], p=distribuion_binary)
-            id_in_cat = np.random.randint(0, len(cats_pool[cid]))
-            id = cats_pool[cid][id_in_cat]
-            idxs.append(id)
-        return idxs
-
-
-    def _get_random_samples(self, nums):
-        idxs = []
-        for _ in range(nums):
-            idxs.append(np.random.randint(0, len(self.dataset)))
-        return idxs
-
     def _get_sample_from_cids(self, cats, nums):
         '''
         cats : [cid0, cid1, ...]
         nums : [n0, n1, ...]
 
         '''
-        assert len(cats) == len(nums)
-        idxs = []
-        for cat, n in zip(cats, nums):
-            if len(self.per_cat_pool[cat]) == 0:
-                continue
-            inner_ids = [np.random.randint(0, len(self.per_cat_pool[cat])) for _ in range(n)]
-            idxs.extend([self.per_cat_pool[x] for x in inner_ids])
-        return idxs
+        return self.sampler.sample_from_cids(cats, nums).tolist()
 
     def _load_RGBA(self,img_path,train_size,target_WH=None):
         if isinstance(train_size, int):
@@ -484,7 +389,7 @@ class InstPool:
         return res
 
     def _load_dict(self, dataset_dict):
-        dataset_dict = copy.deepcopy(dataset_dict)  # it will be modified by code below
+        dataset_dict = counted_deepcopy(dataset_dict)  # it will be modified by code below
         # USER: Write your own image loading if it's not from a file
         image = utils.read_image(dataset_dict["file_name"], format=self.image_format)
         utils.check_image_size(dataset_dict, image)
@@ -559,7 +464,7 @@ class InstPool:
             return dst_results
 
         # update masks and generate bboxes from updated masks
-        composed_mask = np.where(np.any(src_masks, axis=0), 1, 0)
+        composed_mask = record_copy(np.where(np.any(src_masks, axis=0), 1, 0))
         updated_dst_masks = get_updated_masks(dst_masks, composed_mask)
         # updated_dst_bboxes = updated_dst_masks.get_bboxes()
         updated_dst_bboxes = get_bboxes(updated_dst_masks)
@@ -575,12 +480,12 @@ class InstPool:
         valid_inds = bboxes_inds | masks_inds
 
         # Paste source objects to destination image directly
-        img = blend_image(dst_img,src_img,composed_mask,self.cp_method).astype(dst_img.dtype)
+        img = record_copy(blend_image(dst_img,src_img,composed_mask,self.cp_method).astype(dst_img.dtype))
         bboxes = np.concatenate([updated_dst_bboxes[valid_inds], src_bboxes])
         labels = np.concatenate([dst_labels[valid_inds], src_labels])
         dst_source = np.concatenate([dst_source[valid_inds], [1]])
-        masks = np.concatenate(
-            [updated_dst_masks[valid_inds], src_masks])
+        masks = record_copy(np.concatenate(
+            [updated_dst_masks[valid_inds], src_masks]))
         #file_name_list = dst_results['file_name_list'][valid_inds].append(src_results['file_name'])
         src_file_name = np.array(src_results['file_name']).flatten()
         file_name_list =  np.concatenate([dst_results['file_name_list'][valid_inds], src_file_name])
@@ -637,16 +542,13 @@ class InstPoolFeed:
         elif "oiv5" in image_root:
             oiv5 = True
         
+        self.bank = None
         if image_format=='RGBA':
             
             json_path = json_file + '/rd' + str(rd) + '_annotations.json'
             json_done_path = json_file + '/rd' + str(rd) + 'done.txt'
-            print("Wait for {}".format(json_done_path))
-            while not os.path.exists(json_done_path):
-                time.sleep(1)
-            with open(json_path) as f:
-                self.per_cat_pool=json.load(f)
-            # print(self.per_cat_pool)
+            channel = Channel(cfg.INPUT.CHANNEL_PATH) if cfg.INPUT.CHANNEL_PATH else None
+            wait_for(json_done_path, channel)
             
             with open('datasets/metadata/area_mean_std2.json') as f:
                 self.HWms=json.load(f)
@@ -670,7 +572,23 @@ class InstPoolFeed:
 
 
    
-            self.dataset = load_coco_syn_json(json_path, image_root)
+            if cfg.INPUT.INST_POOL_BANK:
+                # objects packed once per round, sliced from a memory map
+                bank_crop = cfg.INPUT.INST_POOL_BANK_CROP
+                bank_prefix = json_file + '/rd' + str(rd) + ('_bank_crop' if bank_crop else '_bank')
+                bank_done_path = bank_paths(bank_prefix)[-1]
+                if comm.is_main_process() and not os.path.exists(bank_done_path):
+                    build_inst_bank(json_path, image_root, bank_prefix, crop=bank_crop,
+                                    use_largest_part=use_largest_part)
+                    mark_done(bank_done_path, channel)
+                wait_for(bank_done_path, channel, timeout=cfg.INPUT.INST_POOL_BANK_TIMEOUT)
+                self.bank = InstBank(bank_prefix)
+                self.dataset = self.bank.dataset_dicts()
+            elif cfg.INPUT.SYN_COLUMNS and has_syn_columns(columns_dir(json_file, rd)):
+                # shared memory maps, no per-process list of dicts
+                self.dataset = SynColumns(columns_dir(json_file, rd), image_root)
+            else:
+                self.dataset = load_coco_syn_json(json_path, image_root)
             self._get_per_cat_pool()
             self.idx_to_cat = {i:cat for cat in self.per_cat_pool for i in self.per_cat_pool[cat]}
         else:
@@ -707,6 +625,8 @@ class InstPoolFeed:
             self.transition_matrix = self.transition_matrix[1:, 1:]
             self.binary_transition_matrix = np.zeros_like(self.transition_matrix)
             self.binary_transition_matrix[self.transition_matrix > 0] = 1
+        self.sampler = InstSampler(self.per_cat_pool, len(self.dataset),
+            self.transition_matrix if len(self.transition_matrix_path) > 0 else None)
         self.active_select = active_select
         if self.active_select:
 
@@ -745,6 +665,12 @@ class InstPoolFeed:
 
     def _get_per_cat_pool(self, ):
         self.per_cat_pool = defaultdict(list)
+        if isinstance(self.dataset, SynColumns):
+            # one object per row, no dict to build
+            for i, cat in enumerate(self.dataset.category_ids.tolist()):
+                self.per_cat_pool[cat].append(i)
+            self.cats = list(self.per_cat_pool.keys())
+            return
         for i, data in enumerate(self.dataset) :
             assert len(data['annotations']) == 1
             anno = data['annotations'][0]
@@ -768,7 +694,8 @@ class InstPoolFeed:
 
     def get_mix_result(self, sample_type='random', cids=None,data_dict=None,reference=None):
         results_origin=data_dict
-        data_dict=convert_instance_to_dict(copy.deepcopy(data_dict))
+        # arrays of data_dict are only read, the paste builds new ones
+        data_dict=convert_instance_to_dict(data_dict)
         data_dict['instance_source']=np.zeros_like(data_dict['gt_labels'])
         label_dict = data_dict['gt_labels'].copy()
         label_set = set(label_dict)
@@ -787,18 +714,22 @@ class InstPoolFeed:
         else:
             num_sample = np.random.randint(0, self.max_samples)
             if sample_type == 'random':
-                ids = self._get_random_samples(num_sample)
+                ids = self.sampler.sample(num_sample, 'random').tolist()
             elif sample_type == 'cas_random':
-                ids = self._get_cls_balanced_random_samples(num_sample)
+                ids = self.sampler.sample(num_sample, 'cas_random').tolist()
             elif sample_type == 'cats_random':
                 # assert cids is not None and len(cids)
                 if len(cids) ==0:
                     cids = None
-                ids = self._get_cls_balanced_random_samples(num_sample, cids=cids)
+                ids = self.sampler.sample(num_sample, 'cas_random', cids=cids).tolist()
+            elif 'one_class' in sample_type:
+                ids = self.sampler.sample(num_sample, 'one_class').tolist()
+            elif sample_type in ('cls_prob', 'cls_prob_binary'):
+                ids = self.sampler.sample(num_sample, sample_type, labels=data_dict['gt_labels']).tolist()
             elif sample_type == 'one':
                 num_sample = 1
                 num_sample = np.random.randint(1, 3)
-                ids = self._get_random_samples(num_sample)
+                ids = self.sampler.sample(num_sample, 'random').tolist()
             elif sample_type == 'uniform':
                 num_sample = np.random.randint(1, 3)
                 ids = self._get_uniform_samples(num_sample)
@@ -819,7 +750,10 @@ class InstPoolFeed:
             results_origin['instances'] = Instances((h,w))
             results_origin['instances'].gt_boxes = Boxes(results['gt_bboxes'])
             results_origin['instances'].gt_classes = torch.tensor(results['gt_labels'], dtype=torch.int64)
-            results_origin['instances'].gt_masks = BitMasks(results['gt_masks'])
+            if self.cfg.INPUT.PACKED_MASKS:
+                results_origin['instances'].gt_masks = PackedMasks.from_dense(results['gt_masks'])
+            else:
+                results_origin['instances'].gt_masks = BitMasks(results['gt_masks'])
             results_origin['height'], results_origin['width'] = h, w
             results_origin['file_name_list'] = results['file_name_list'] if results is not None else []
 
@@ -874,112 +808,6 @@ class InstPoolFeed:
     # def _get_all_samples(self, nums, cids = None):
 
 
-    def _get_cls_balanced_random_samples(self, nums, cids = None):
-        if cids is None :
-            cats_pool = [self.per_cat_pool[x] for x in self.per_cat_pool if len(self.per_cat_pool[x])>0]
-        else :
-            cats_pool = [self.per_cat_pool[x] for x in cids if len(self.per_cat_pool[x])>0]
-        idxs = []
-        if len(cats_pool)==0:
-            return []
-        for _ in range(nums):
-            cid = np.random.randint(0, len(cats_pool))
-            id_in_cat = np.random.randint(0, len(cats_pool[cid]))
-            id = cats_pool[cid][id_in_cat]
-            idxs.append(id)
-        return idxs
-    
-    def _get_cls_balanced_random_samples(self, nums, cids = None):
-        if cids is None :
-            cats_pool = [self.per_cat_pool[x] for x in self.per_cat_pool if len(self.per_cat_pool[x])>0]
-        else :
-            cats_pool = [self.per_cat_pool[x] for x in cids if len(self.per_cat_pool[x])>0]
-        idxs = []
-        if len(cats_pool)==0:
-            return []
-        for _ in range(nums):
-            cid = np.random.randint(0, len(cats_pool))
-            id_in_cat = np.random.randint(0, len(cats_pool[cid]))
-            id = cats_pool[cid][id_in_cat]
-            idxs.append(id)
-        #assert self.idx_to_cat[id] in cids
-        return idxs
-    
-    def _get_one_class_random_samples(self, nums, cids = None):
-        if cids is None :
-            cats_pool = [self.per_cat_pool[x] for x in self.per_cat_pool if len(self.per_cat_pool[x])>0]
-        else :
-            cats_pool = [self.per_cat_pool[x] for x in cids if len(self.per_cat_pool[x])>0]
-        idxs = []
-        if len(cats_pool)==0:
-            return []
-        cid = np.random.randint(0, len(cats_pool))
-        #print('choose class:',cid)
-        if nums == 0:
-            nums  = 1 # 保证每次至少有一个贴图
-        for _ in range(nums):
-            id_in_cat = np.random.randint(0, len(cats_pool[cid]))
-            id = cats_pool[cid][id_in_cat]
-            idxs.append(id)
-        if cids is not None :
-            assert self.idx_to_cat[id] in cids
-        return idxs
-
-    def _get_cls_prob_random_samples(self, nums,label_list):
-        cats_pool = [self.per_cat_pool[x] for x in self.per_cat_pool  if len(self.per_cat_pool[x])>0]
-        idxs = []
-        # 从distribution中采样
-        distribuion = self.transition_matrix[label_list].sum(axis=0)
-        # if  int(distribuion.sum()) != len(label_list):
-        #     print("distribuion.sum() != len(label_list)", distribuion.sum(), len(label_list))
-        if distribuion.sum() > 0:
-            distribuion = (distribuion) / (distribuion.sum())
-        else:
-            distribuion = np.ones(distribuion.shape[0]) / distribuion.shape[0]
-        for _ in range(nums):
-            cid = np.random.choice(distribuion.shape[0], p=distribuion)
-            id_in_cat = np.random.randint(0, len(cats_pool[cid]))
-            id = cats_pool[cid][id_in_cat]
-            idxs.append(id)
-        return idxs
-    def _get_cls_prob_binary_random_samples(self, nums,label_list):
-        cats_pool = [self.per_cat_pool[x] for x in self.per_cat_pool  if len(self.per_cat_pool[x])>0]
-        assert len(cats_pool) == 1203
-        idxs = []
-        # 从distribution中采样
-        distribuion = self.transition_matrix[label_list].sum(axis=0)
-        distribuion_binary = distribuion.copy()
-        distribuion_binary[distribuion_binary > 0] = 1
-        # rare_sum = distribuion_binary[RARE_LIST].sum()
-        NON_ZERO_ID_SET = set(np.nonzero(distribuion_binary)[0])
-        # NOT_RARE_ID_SET = NON_ZERO_ID_SET - RARE_ID_SET
-        NOT_RARE_ID_SET = NON_ZERO_ID_SET # - RARE_ID_SET
-        NOT_RARE_LIST = list(NOT_RARE_ID_SET)
-        # random mask NOT_RARE_LIST to keep balance of rare and non-rare
-        # mask_num = len(NOT_RARE_LIST) - rare_sum
-        mask_num = len(NOT_RARE_LIST) # - rare_sum
-        MASK_LIST = np.random.choice(NOT_RARE_LIST, int(mask_num), replace=False)
-        try:
-            distribuion_binary[MASK_LIST] = 0
-        except:
-            print("error")
-        if distribuion_binary.sum() == 0:
-            distribuion_binary += 1 
-        distribuion_binary = distribuion_binary / distribuion_binary.sum()
-        for _ in range(nums):
-            cid = np.random.choice(distribuion.shape[0], p=distribuion_binary)
-            id_in_cat = np.random.randint(0, len(cats_pool[cid]))
-            id = cats_pool[cid][id_in_cat]
-            idxs.append(id)
-        return idxs
-        
-
-
-    def _get_random_samples(self, nums):
-        idxs = []
-        for _ in range(nums):
-            idxs.append(np.random.randint(0, len(self.dataset)))
-        return idxs
     
     def _get_uniform_samples(self, nums):
         """
@@ -996,14 +824,7 @@ class InstPoolFeed:
         nums : [n0, n1, ...]
 
         '''
-        assert len(cats) == len(nums)
-        idxs = []
-        for cat, n in zip(cats, nums):
-            if len(self.per_cat_pool[cat]) == 0:
-                continue
-            inner_ids = [np.random.randint(0, len(self.per_cat_pool[cat])) for _ in range(n)]
-            idxs.extend([self.per_cat_pool[x] for x in inner_ids])
-        return idxs
+        return self.sampler.sample_from_cids(cats, nums).tolist()
 
 
     # get generated object
@@ -1064,12 +885,17 @@ class InstPoolFeed:
         label= int(img_path['file_name'][-13:-9]) -1
         # mask_path=None
         # if img_path[0]=='*':
+        bank_index=img_path.get('bank_index')
         img_path=img_path['file_name']
-        mask_path=img_path.replace("raw","segmented")
-        #print(self.max_gpu_memory)
-        
-        img_RGBA=np.array(Image.open(img_path).convert('RGBA'))
-        img_RGBA[:,:,-1]=np.array(Image.open(mask_path))
+        if bank_index is not None:
+            # read-only tile, the image and mask below unless built with INST_POOL_BANK_CROP
+            img_RGBA=self.bank[bank_index]
+        else:
+            mask_path=img_path.replace("raw","segmented")
+            #print(self.max_gpu_memory)
+
+            img_RGBA=np.array(Image.open(img_path).convert('RGBA'))
+            img_RGBA[:,:,-1]=np.array(Image.open(mask_path))
         preprocessed=True
 
         try:
@@ -1153,7 +979,7 @@ class InstPoolFeed:
         return res
 
     def _load_dict(self, dataset_dict):
-        dataset_dict = copy.deepcopy(dataset_dict)  # it will be modified by code below
+        dataset_dict = counted_deepcopy(dataset_dict)  # it will be modified by code below
         # USER: Write your own image loading if it's not from a file
         image = utils.read_image(dataset_dict["file_name"], format=self.image_format)
         utils.check_image_size(dataset_dict, image)
@@ -1191,15 +1017,22 @@ class InstPoolFeed:
         datas=[x for x in  datas if x is not None]
         for x in datas:
             x['image'][:,:,:3]=self.cumstom_augmentations(image=x['image'][:,:,:3])['image']
-        datas = [random_start_xy(x,train_size) for x in datas]
+        if self.cfg.INPUT.TILE_PASTE:
+            datas = [random_start_tile(x,train_size) for x in datas]
+        else:
+            datas = [random_start_xy(x,train_size) for x in datas]
         datas = [x for x in datas if x is not None]
         if len(datas) == 0 :
             return None
         dst_results = data_dict
         dst_results['file_name_list']= np.array(['ori']*len(dst_results['gt_labels']))
         #dst_results['origin_image']=dst_results['image']
-        for x in datas :
-            dst_results = self._copy_paste(dst_results, x)
+        if self.cfg.INPUT.BATCHED_PASTE or self.cfg.INPUT.TILE_PASTE:
+            dst_results = composite_instances(dst_results, datas, self.cp_method,
+                self.bbox_occluded_thr, self.mask_occluded_thr)
+        else:
+            for x in datas :
+                dst_results = self._copy_paste(dst_results, x)
         ##### debug
         # print(ids)
         return dst_results
@@ -1228,7 +1061,7 @@ class InstPoolFeed:
             return dst_results
 
         # update masks and generate bboxes from updated masks
-        composed_mask = np.where(np.any(src_masks, axis=0), 1, 0)
+        composed_mask = record_copy(np.where(np.any(src_masks, axis=0), 1, 0))
         updated_dst_masks = get_updated_masks(dst_masks, composed_mask)
         # updated_dst_bboxes = updated_dst_masks.get_bboxes()
         updated_dst_bboxes = get_bboxes(updated_dst_masks)
@@ -1244,12 +1077,12 @@ class InstPoolFeed:
         valid_inds = bboxes_inds | masks_inds
 
         # Paste source objects to destination image directly
-        img = blend_image(dst_img,src_img,composed_mask,self.cp_method).astype(dst_img.dtype)
+        img = record_copy(blend_image(dst_img,src_img,composed_mask,self.cp_method).astype(dst_img.dtype))
         bboxes = np.concatenate([updated_dst_bboxes[valid_inds], src_bboxes])
         labels = np.concatenate([dst_labels[valid_inds], src_labels])
         dst_source = np.concatenate([dst_source[valid_inds], [1]])
-        masks = np.concatenate(
-            [updated_dst_masks[valid_inds], src_masks])
+        masks = record_copy(np.concatenate(
+            [updated_dst_masks[valid_inds], src_masks]))
         #file_name_list = dst_results['file_name_list'][valid_inds].append(src_results['file_name'])
         src_file_name = np.array(src_results['file_name']).flatten()
         file_name_list =  np.concatenate([dst_results['file_name_list'][valid_inds], src_file_name])
@@ -1331,7 +1164,7 @@ class InstaBoost:
         # img = results['image'].numpy()
         # ori_type = img.dtype
 
-        anns = copy.deepcopy(dataset_dict['annotations'])
+        anns = counted_deepcopy(dataset_dict['annotations'])
         boost_anns = []
         nboost_anns = []
         for ann in anns :
@@ -1392,6 +1225,15 @@ class CopyPasteMapper:
         self.num_scr_image = cfg.INPUT.SCP_NUM_SRC
         self.rfs_choice = cfg.INPUT.SCP_RFS
         self.raw_dataset = None
+        self.rfs_factors = None
+        # the source images live once per machine in shared memory, keyed
+        # by the output dir so that jobs sharing a machine do not collide;
+        # every round replaces the same files, unlinked when the trainer exits
+        self.shared_dir = cfg.DATALOADER.SHARED_DATASET_DIR
+        self.shared_name = 'mrca_scp_{}'.format(
+            hashlib.md5(os.path.abspath(cfg.OUTPUT_DIR).encode()).hexdigest()[:12])
+        self.shared_dataset = None
+        self.shared_owner = None
         self.scp_select_cls = cfg.INPUT.SCP_SELECT_CATS_LIST
         self.limit_src_lsj = cfg.INPUT.LIMIT_SRC_LSJ
         self.use_copy_method= cfg.INPUT.USE_COPY_METHOD
@@ -1445,16 +1287,18 @@ class CopyPasteMapper:
         else :
             self.inst_pool = None
         if cfg.INPUT.INST_POOL_FEED :
-            self.inst_pool = InstPoolFeed(cfg.INPUT.INST_POOL_PATH, cfg.INPUT.INST_POOL_ROOT, cfg.INPUT.TRAIN_SIZE, image_format=cfg.INPUT.INST_POOL_FORMAT, max_samples=cfg.INPUT.INST_POOL_MAX_SAMPLES,
-                                      use_largest_part=cfg.USE_LARGEST_PART,random_rotate=cfg.INPUT.RANDOM_ROTATE,cp_method=cfg.INPUT.CP_METHOD,color_aug=self.src_color, transition_matrix_path = cfg.INPUT.TRANSITION_MATRIX_PATH,
-                                      active_select = cfg.INPUT.ACTIVE_SELECT, cfg = cfg, rd = rd)
-            self.inst_pool.cfg = cfg
+            self.inst_pool = self._build_inst_pool_feed(cfg, rd)
             self.inst_pool_sample_type = cfg.INPUT.INST_POOL_SAMPLE_TYPE
-            self.inst_pool.area_std_thres = cfg.INPUT.INST_POOL_AREA_STD_THRES
-            self.inst_pool.area_certainty = cfg.INPUT.INST_POOL_AREA_CERTAINTY
       
         else :
             self.inst_pool = None
+        # with INPUT.PERSISTENT_ROUNDS the trainer publishes the current round
+        # here, in shared memory, and the dataloader workers swap their
+        # instance pool when it changes
+        self.inst_pool_rd = rd
+        self.round_value = None
+        if cfg.INPUT.PERSISTENT_ROUNDS:
+            self.round_value = multiprocessing.Value('i', rd if rd is not None else 0, lock=False)
         self.scp_type = cfg.INPUT.SCP_TYPE
         if self.scp_type == 'rc_only':
             self.freq_select = ['r', 'c']
@@ -1489,6 +1333,7 @@ class CopyPasteMapper:
             self.img_save_dir = None
         self.counter = 0
         self.active_select = cfg.INPUT.ACTIVE_SELECT
+        self.packed_masks = cfg.INPUT.PACKED_MASKS
     
     # def _filter_in_specific_cls(self, dataset_dict, num_src=3, cas=False):
     def _filter_in_specific_cls(self, dataset_dict, num_src=3, cas=False, specific_cls=False, filter_cls_inst=True):
@@ -1515,7 +1360,8 @@ class CopyPasteMapper:
         for cid_pool in cid_pool_list :
             id_in_cat = np.random.randint(0, len(cid_pool))
             idx = cid_pool[id_in_cat]
-            src_dataset_dict = copy.deepcopy(self.dataset[idx])
+            # self.mapper deep-copies again, only the annotation list is replaced here
+            src_dataset_dict = dict(self.dataset[idx])
             if filter_cls_inst :
                 cls_filter = [(x['category_id'] in cls_list) for x in src_dataset_dict['annotations']]
                 src_dataset_dict['annotations'] = [x for i, x in enumerate(src_dataset_dict['annotations']) if cls_filter[i]]
@@ -1525,45 +1371,101 @@ class CopyPasteMapper:
 
         return mix_results
 
+    def _build_inst_pool_feed(self, cfg, rd):
+        inst_pool = InstPoolFeed(cfg.INPUT.INST_POOL_PATH, cfg.INPUT.INST_POOL_ROOT, cfg.INPUT.TRAIN_SIZE, image_format=cfg.INPUT.INST_POOL_FORMAT, max_samples=cfg.INPUT.INST_POOL_MAX_SAMPLES,
+                                  use_largest_part=cfg.USE_LARGEST_PART,random_rotate=cfg.INPUT.RANDOM_ROTATE,cp_method=cfg.INPUT.CP_METHOD,color_aug=self.src_color, transition_matrix_path = cfg.INPUT.TRANSITION_MATRIX_PATH,
+                                  active_select = cfg.INPUT.ACTIVE_SELECT, cfg = cfg, rd = rd)
+        inst_pool.cfg = cfg
+        inst_pool.area_std_thres = cfg.INPUT.INST_POOL_AREA_STD_THRES
+        inst_pool.area_certainty = cfg.INPUT.INST_POOL_AREA_CERTAINTY
+        return inst_pool
+
+    def _swap_inst_pool(self, rd):
+        old = self.inst_pool
+        self.inst_pool = self._build_inst_pool_feed(self.cfg, rd)
+        if self.active_select and old is not None:
+            # the real-image pools do not change between rounds
+            self.inst_pool.per_cat_pool_real = old.per_cat_pool_real
+            self.inst_pool.non_empty_cat = old.non_empty_cat
+            if hasattr(old, 'total_img'):
+                self.inst_pool.total_img = old.total_img
+        self.inst_pool_rd = rd
+
+    def set_round(self, rd):
+        """
+        Start round `rd` in the running dataloader (INPUT.PERSISTENT_ROUNDS).
+        The instance pool of the round is loaded here first, which waits
+        for its synthetic data and builds its bank, so the workers only
+        open the finished files when they see the new round before their
+        next image. Their images carry the round in 'inst_pool_rd'.
+        """
+        if self.inst_pool is not None:
+            self._swap_inst_pool(rd)
+        self.inst_pool_rd = rd
+        self.round_value.value = rd
+
+    def _freq_filtered(self, dataset):
+        for data in dataset:
+            anno = [x for x in data['annotations'] if self.cid_to_freq[x['category_id']] in self.freq_select]
+            if len(anno):
+                yield dict(data, annotations=anno)
+
+    def _resample_rfs(self):
+        # one RFS epoch of the raw dataset, as indices
+        _int_part = torch.trunc(self.rfs_factors)
+        _frac_part = self.rfs_factors - _int_part
+        rands = torch.rand(len(_frac_part))
+        rep_factors = (_int_part + (rands < _frac_part).float()).long()
+        indices = np.repeat(np.arange(len(rep_factors)), rep_factors.numpy())
+        self.dataset = IndexedDataset(self.raw_dataset, indices)
+
     def set_dataset(self, dataset):
+        """
+        Source images of self-copy. `dataset` is only read: the mapper keeps
+        its own serialized copy, in SHARED_DATASET_DIR when set so that all
+        GPU processes and dataloader workers of a machine share it, and
+        per-category pools and RFS epochs as index arrays into it.
+        """
         rfs_choice = self.rfs_choice
-        self.dataset = dataset
+        source = dataset
         if self.scp_type in ['rc_only', 'f_only']:
-            self.dataset = []
-            for i, data in enumerate(dataset):
-                data = copy.deepcopy(data)
-                anno = data['annotations']
-                anno = [x for x in anno if self.cid_to_freq[x['category_id']] in self.freq_select]
-                data['annotations'] = anno
-                if len(anno):
-                    self.dataset.append(data)
+            source = self._freq_filtered(dataset)
+        if self.shared_dir:
+            SharedDatasetList.remove_stale(self.shared_dir, self.shared_name)
+            self.shared_dataset = SharedDatasetList.create(source, self.shared_dir, self.shared_name)
+            self.dataset = self.shared_dataset
+            if self.shared_owner is None:
+                self.shared_owner = os.getpid()
+                atexit.register(self.close)
+        else:
+            self.dataset = DatasetFromList(list(source), copy=False, serialize=True)
         if self.scp_type in ('in_domain', 'cas', 'the_cls', 'the_cls_img'):
-            self.per_cat_map = defaultdict(list)
+            per_cat_map = defaultdict(list)
             for i, data in enumerate(dataset):
                 cat_ids = set([x['category_id'] for x in data['annotations']])
                 # for anno in data['annotations']:
                 for cid in cat_ids :
-                    self.per_cat_map[cid].append(i) 
+                    per_cat_map[cid].append(i) 
+            self.per_cat_map = defaultdict(list, {cid: np.asarray(v, dtype=np.int64) for cid, v in per_cat_map.items()})
         if rfs_choice :
             repeat_factors = RepeatFactorTrainingSampler.repeat_factors_from_category_frequency(dataset, 0.001)
             if self.rfs_version == 0 :
                 repeat_probs = repeat_factors / repeat_factors.sum(-1, keepdim=True)
-                self.scp_aug.repeat_probs = repeat_probs.numpy()
+                self.scp_aug.set_repeat_probs(repeat_probs.numpy())
             elif self.rfs_version == 1:
-                if self.raw_dataset is None :
-                    self.raw_dataset = self.dataset
-                _int_part = torch.trunc(repeat_factors)
-                _frac_part = repeat_factors - _int_part
-                rands = torch.rand(len(_frac_part))
-                rep_factors = _int_part + (rands < _frac_part).float()
-                indices = []
-                for dataset_index, rep_factor in enumerate(rep_factors):
-                    indices.extend([dataset_index] * int(rep_factor.item()))
-                self.dataset = [self.raw_dataset[x] for x in indices]
-                self.scp_aug.repeat_probs = None
+                self.raw_dataset = self.dataset
+                self.rfs_factors = repeat_factors
+                self._resample_rfs()
+                self.scp_aug.set_repeat_probs(None)
             else :
                 raise NotImplementedError
 
+    def close(self):
+        """Unlink the shared source images; processes that mapped them keep reading."""
+        if self.shared_dataset is not None and os.getpid() == self.shared_owner:
+            self.shared_dataset.remove()
+            self.shared_dataset = None
+
     def set_non_empty_catpool(self, per_cat_pool):
         non_empty_catpool = []
         for select_class in range(0, 1203):
@@ -1613,8 +1515,14 @@ class CopyPasteMapper:
                         self.inst_pool.non_empty_cat = self.set_non_empty_catpool(self.per_cat_pool_real)
     def __call__(self, dataset_dict, cp_idx=None):
         assert self.dataset is not None , 'dataset cant be None in CopyPasteMapper'
+        if self.round_value is not None and self.round_value.value != self.inst_pool_rd:
+            # the trainer started a new round
+            if self.inst_pool is not None:
+                self._swap_inst_pool(self.round_value.value)
+            self.inst_pool_rd = self.round_value.value
 
 
+        pop_copied_bytes()
         if self.instaboost_dst :
             dataset_dict = self.instaboost_mapper(dataset_dict)
         
@@ -1623,9 +1531,10 @@ class CopyPasteMapper:
             if self.inst_pool.active_select :
                 # result['origin_image'] = result['image']
                 # result['origin_instances'] = result['instances']
-                # deep copy
-                result['origin_image'] = copy.deepcopy(result['image'])
-                result['origin_instances'] = copy.deepcopy(result['instances'])
+                # later steps replace image/fields instead of writing into
+                # them, so the tensors can be shared
+                result['origin_image'] = result['image']
+                result['origin_instances'] = Instances(result['instances'].image_size, **result['instances'].get_fields())
 
         if not 'instances' in result or not result['instances'].has('gt_masks'):
             print('no instance found ',result['file_name'])
@@ -1642,12 +1551,12 @@ class CopyPasteMapper:
             if cp_idx is not None :
                 idxs = [cp_idx]
             else :
-                idxs = [self.scp_aug.get_indexes(self.dataset) for _ in range(self.num_scr_image)]
+                idxs = self.scp_aug.get_indexes(self.dataset, self.num_scr_image).tolist()
                 # idx = self.scp_aug.get_indexes(self.dataset)
                 self.counter += self.num_scr_image
                 if self.counter > len(self.dataset) and self.rfs_version == 1:
                     self.counter = 0
-                    self.set_dataset(self.raw_dataset, rfs_choice=self.rfs_choice)
+                    self._resample_rfs()
             mix_results = []
             if self.use_copy_method=='both':
                 copy_paste_method=['self_copy','syn_copy']
@@ -1742,8 +1651,13 @@ class CopyPasteMapper:
 
        
   
+        if self.packed_masks and 'instances' in result and isinstance(result['instances'].get('gt_masks'), BitMasks):
+            # 8x smaller to pickle back to the main process, see unpack_instance_masks
+            result['instances'].gt_masks = PackedMasks.from_bitmasks(result['instances'].gt_masks)
         result['counter'] = self.counter
         result['rank'] = self.rank
+        result['inst_pool_rd'] = self.inst_pool_rd
+        result['copied_bytes'] = pop_copied_bytes()
 
 
 
@@ -1,5 +1,4 @@
 # Copyright (c) Facebook, Inc. and its affiliates.
-import copy
 import logging
 import numpy as np
 import cv2
@@ -20,6 +19,8 @@ from detectron2.config import configurable
 from detectron2.data import detection_utils as utils
 from detectron2.data import transforms as T
 
+from .copy_stats import counted_deepcopy
+
 """
 This file contains the default mapping that's applied to "dataset dicts".
 """
@@ -132,7 +133,7 @@ class DatasetMapper:
         Returns:
             dict: a format that builtin models in detectron2 accept
         """
-        dataset_dict = copy.deepcopy(dataset_dict)  # it will be modified by code below
+        dataset_dict = counted_deepcopy(dataset_dict)  # it will be modified by code below
         # USER: Write your own image loading if it's not from a file
         mask_=None
         if 'mask_cat' in dataset_dict:
@@ -0,0 +1,149 @@
+import os
+import json
+import argparse
+import numpy as np
+import cv2
+from PIL import Image, ImageFile
+
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+
+def get_largest_connect_component(img):
+    contours, _ = cv2.findContours(img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    area = []
+    for i in range(len(contours)):
+        area.append(cv2.contourArea(contours[i]))
+    if len(area) >= 1:
+        max_idx = np.argmax(area)
+        img2=np.zeros_like(img)
+        cv2.fillPoly(img2, [contours[max_idx]], 1)
+        return img2
+    else:
+        return img
+
+
+def crop_instance(img_RGBA, mask_threshold=128, use_largest_part=True,
+                  instance_filter_min=0.01, instance_filter_max=1.0):
+    """
+    Cut the object out of a generated RGBA image: threshold the alpha,
+    keep the largest connected part and crop to its bounding box.
+    Returns None for objects that would be rejected at paste time.
+    """
+    alpha=img_RGBA[...,3:]
+    seg_mask=(alpha>mask_threshold).astype('uint8')
+    if use_largest_part:
+        seg_mask=get_largest_connect_component(seg_mask)
+    seg_mask_ = np.where(seg_mask)
+    instance_area=len(seg_mask_[0])
+    instance_area_percent=instance_area/(seg_mask.shape[0]*seg_mask.shape[1])
+    if instance_area_percent<=instance_filter_min or instance_area_percent>=instance_filter_max:
+        return None
+    y_min,y_max,x_min,x_max = np.min(seg_mask_[0]), np.max(seg_mask_[0]), np.min(seg_mask_[1]), np.max(seg_mask_[1])
+    if y_max<=y_min or x_max<=x_min:
+        return None
+    img_RGBA[:,:,3:]*=seg_mask
+    return np.ascontiguousarray(img_RGBA[y_min:y_max+1,x_min:x_max+1])
+
+
+def bank_paths(bank_prefix):
+    return bank_prefix + '.bin', bank_prefix + '_index.npz', bank_prefix + '_done.txt'
+
+
+def build_inst_bank(json_path, image_root, bank_prefix, crop=False, mask_threshold=128, use_largest_part=True,
+                    instance_filter_min=0.01, instance_filter_max=1.0):
+    """
+    Pack every annotated synthetic object of `json_path` into one flat uint8
+    file of HxWx4 RGBA tiles, plus an index with the byte offset, shape,
+    0-based label and source file of each tile.
+
+    By default a tile is the whole generated image with the segmenter mask
+    as alpha, what InstPoolFeed reads from the PNGs, so the bank only saves
+    the decoding. With `crop`, tiles go through `crop_instance`: the target
+    size then applies to the object's box instead of the whole image, and
+    objects it rejects are left out of the pool.
+
+    Run once per round, after diSegmenter wrote rdN_annotations.json.
+    """
+    data_path, index_path, done_path = bank_paths(bank_prefix)
+    with open(json_path) as f:
+        anno = json.load(f)
+    annotated = set(x['image_id'] for x in anno['annotations'])
+
+    offsets, shapes, labels, file_names = [], [], [], []
+    offset = 0
+    with open(data_path + '.tmp', 'wb') as f:
+        for img in anno['images']:
+            if img['id'] not in annotated:
+                continue
+            img_path = os.path.join(image_root, img['file_name'])
+            mask_path = img_path.replace("raw","segmented")
+            try:
+                img_RGBA=np.array(Image.open(img_path).convert('RGBA'))
+                img_RGBA[:,:,-1]=np.array(Image.open(mask_path))
+            except:
+                print("-----------image is None----------",img_path)
+                continue
+            tile = img_RGBA
+            if crop:
+                tile = crop_instance(img_RGBA, mask_threshold, use_largest_part,
+                                     instance_filter_min, instance_filter_max)
+                if tile is None:
+                    continue
+            f.write(tile.tobytes())
+            offsets.append(offset)
+            shapes.append(tile.shape[:2])
+            labels.append(int(img_path[-13:-9]) - 1)
+            file_names.append(img_path)
+            offset += tile.nbytes
+
+    np.savez(index_path + '.tmp.npz',
+        offsets=np.array(offsets, dtype=np.int64),
+        shapes=np.array(shapes, dtype=np.int32).reshape(-1, 2),
+        labels=np.array(labels, dtype=np.int64),
+        file_names=np.array(file_names))
+    os.replace(data_path + '.tmp', data_path)
+    os.replace(index_path + '.tmp.npz', index_path)
+    open(done_path, 'a').close()
+    print("Instance bank with {} objects ({:.1f} MB) saved to {}".format(
+        len(offsets), offset / 2**20, data_path))
+
+
+class InstBank:
+    """
+    Read-only view over a bank written by `build_inst_bank`. Tiles are sliced
+    straight out of a memory map, so dataloader workers share the page cache
+    instead of decoding PNGs. The map is opened lazily in each worker.
+    """
+    def __init__(self, bank_prefix):
+        self.data_path, index_path, _ = bank_paths(bank_prefix)
+        index = np.load(index_path)
+        self.offsets = index['offsets']
+        self.shapes = index['shapes']
+        self.labels = index['labels']
+        self.file_names = index['file_names']
+        self.data = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, idx):
+        if self.data is None:
+            self.data = np.memmap(self.data_path, mode='r', dtype='uint8')
+        h, w = self.shapes[idx]
+        ofs = self.offsets[idx]
+        return np.ndarray((h, w, 4), dtype=np.uint8, buffer=self.data, offset=ofs)
+
+    def dataset_dicts(self):
+        return [{'file_name': str(fn), 'bank_index': i, 'annotations': [{'category_id': int(label)}]}
+                for i, (fn, label) in enumerate(zip(self.file_names, self.labels))]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--json", required=True, help="rdN_annotations.json written by diSegmenter")
+    parser.add_argument("--image_root", required=True)
+    parser.add_argument("--output", required=True, help="bank prefix, e.g. annotations/rd3_bank")
+    parser.add_argument("--crop", action='store_true', help="crop tiles to the thresholded object, as INPUT.INST_POOL_BANK_CROP")
+    parser.add_argument("--keep_all_parts", action='store_true')
+    args = parser.parse_args()
+    build_inst_bank(args.json, args.image_root, args.output, crop=args.crop, use_largest_part=not args.keep_all_parts)
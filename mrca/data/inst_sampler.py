@@ -0,0 +1,163 @@
+import numpy as np
+
+
+def build_alias_tables(weights):
+    """
+    Vose alias tables for every row of a non-negative N x K matrix, stored
+    CSR-style over the non-zero entries of each row: row r draws one of
+    cols[offsets[r]:offsets[r + 1]] in O(1). Rows without mass get no entry.
+    Returns (offsets, cols, prob, alias) with `alias` local to the row.
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    nnz = np.count_nonzero(weights, axis=1)
+    offsets = np.zeros(len(weights) + 1, dtype=np.int64)
+    np.cumsum(nnz, out=offsets[1:])
+    cols = np.nonzero(weights)[1].astype(np.int64)
+    prob = np.ones(len(cols), dtype=np.float64)
+    alias = np.zeros(len(cols), dtype=np.int64)
+    for r in np.nonzero(nnz)[0]:
+        start, end = offsets[r], offsets[r + 1]
+        w = weights[r, cols[start:end]]
+        scaled = w * (len(w) / w.sum())
+        small = [i for i in range(len(w)) if scaled[i] < 1]
+        large = [i for i in range(len(w)) if scaled[i] >= 1]
+        p, a = prob[start:end], alias[start:end]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            p[s], a[s] = scaled[s], l
+            scaled[l] -= 1 - scaled[s]
+            (small if scaled[l] < 1 else large).append(l)
+        # leftovers are 1 up to rounding
+        for i in small + large:
+            p[i] = 1.
+    return offsets, cols, prob, alias
+
+
+class AliasSampler:
+    """
+    Indices 0..N-1 drawn with probability proportional to `weights`, in
+    O(1) per draw from one alias table; the draws of a call are vectorized
+    and use the global numpy RNG.
+    """
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        self.num = len(weights)
+        _, self.cols, self.prob, self.alias = build_alias_tables(weights[None])
+
+    def __len__(self):
+        return self.num
+
+    def sample(self, nums):
+        k = np.random.randint(0, len(self.cols), nums)
+        keep = np.random.random(nums) < self.prob[k]
+        return np.where(keep, self.cols[k], self.cols[self.alias[k]])
+
+
+class InstSampler:
+    """
+    Dataset indices of pasted objects, drawn with the strategies of
+    InstPoolFeed. Built once per round from `per_cat_pool`:
+
+    - the pools are flattened into (cat_offsets, cat_indices), category
+      `cats[i]` owning cat_indices[cat_offsets[i]:cat_offsets[i + 1]];
+    - the rows of the transition matrix get alias tables, so sampling the
+      classes co-occurring with an image's labels is O(1) per draw instead
+      of renormalizing a num_classes distribution.
+
+    Every draw of a call is vectorized and uses the global numpy RNG, which
+    detectron2 seeds per dataloader worker.
+    """
+    def __init__(self, per_cat_pool, num_samples, transition_matrix=None):
+        self.num_samples = num_samples
+        self.cats = np.array([c for c in per_cat_pool if len(per_cat_pool[c]) > 0], dtype=np.int64)
+        pools = [np.asarray(per_cat_pool[c], dtype=np.int64) for c in self.cats]
+        self.cat_counts = np.array([len(p) for p in pools], dtype=np.int64)
+        self.cat_offsets = np.zeros(len(pools) + 1, dtype=np.int64)
+        np.cumsum(self.cat_counts, out=self.cat_offsets[1:])
+        self.cat_indices = np.concatenate(pools) if len(pools) else np.zeros(0, dtype=np.int64)
+        # category id -> position in self.cats, -1 for empty or unknown ones
+        self.cat_to_row = np.full(max(self.cats.max() + 1 if len(self.cats) else 0, 1), -1, dtype=np.int64)
+        self.cat_to_row[self.cats] = np.arange(len(self.cats))
+
+        self.transition = None
+        if transition_matrix is not None:
+            # column c of the transition matrix is category c; empty
+            # categories can not be drawn
+            weights = np.asarray(transition_matrix, dtype=np.float64).copy()
+            num_cols = weights.shape[1]
+            has_pool = np.zeros(num_cols, dtype=bool)
+            known = self.cats[self.cats < num_cols]
+            has_pool[known] = True
+            weights[:, ~has_pool] = 0
+            self.row_mass = weights.sum(axis=1)
+            self.transition = build_alias_tables(weights)
+
+    def __len__(self):
+        return len(self.cats)
+
+    def _draw_in_rows(self, rows):
+        return self.cat_indices[self.cat_offsets[rows] + np.random.randint(0, self.cat_counts[rows])]
+
+    def _rows_of(self, cids):
+        if cids is None:
+            return np.arange(len(self.cats))
+        cids = np.asarray(cids, dtype=np.int64)
+        cids = cids[(cids >= 0) & (cids < len(self.cat_to_row))]
+        rows = self.cat_to_row[cids]
+        return rows[rows >= 0]
+
+    def _draw_transition(self, nums, labels):
+        offsets, cols, prob, alias = self.transition
+        labels = np.asarray(labels, dtype=np.int64)
+        labels = labels[(labels >= 0) & (labels < len(self.row_mass))]
+        mass = self.row_mass[labels]
+        if mass.sum() <= 0:
+            return self._draw_in_rows(np.random.randint(0, len(self.cats), nums))
+        # the normalized sum of the label rows is a mixture of the rows,
+        # each weighted by its mass
+        src = labels[np.random.choice(len(labels), nums, p=mass / mass.sum())]
+        k = offsets[src] + (np.random.random(nums) * (offsets[src + 1] - offsets[src])).astype(np.int64)
+        k = np.minimum(k, offsets[src + 1] - 1)
+        keep = np.random.random(nums) < prob[k]
+        col = np.where(keep, cols[k], cols[offsets[src] + alias[k]])
+        return self._draw_in_rows(self.cat_to_row[col])
+
+    def sample(self, nums, strategy='random', labels=None, cids=None):
+        """
+        nums dataset indices drawn with `strategy`:
+
+        - 'random': uniform over objects;
+        - 'cas_random': uniform class, then uniform object of the class,
+          restricted to `cids` when given;
+        - 'one_class': `nums` (at least one) objects of a single class;
+        - 'cls_prob': classes drawn from the transition rows of `labels`;
+        - 'cls_prob_binary': uniform over classes. The original variant
+          masked every non-zero class of the binarized rows before
+          falling back to all ones, so this is the distribution it drew.
+        """
+        if strategy == 'random':
+            return np.random.randint(0, self.num_samples, nums)
+        rows = self._rows_of(cids)
+        if len(rows) == 0:
+            return np.zeros(0, dtype=np.int64)
+        if strategy == 'cas_random':
+            return self._draw_in_rows(rows[np.random.randint(0, len(rows), nums)])
+        if strategy == 'one_class':
+            return self._draw_in_rows(np.full(max(nums, 1), rows[np.random.randint(0, len(rows))]))
+        if strategy == 'cls_prob':
+            assert self.transition is not None, 'cls_prob sampling needs a transition matrix'
+            return self._draw_transition(nums, labels)
+        if strategy == 'cls_prob_binary':
+            return self._draw_in_rows(np.random.randint(0, len(self.cats), nums))
+        raise NotImplementedError(strategy)
+
+    def sample_from_cids(self, cats, nums):
+        """nums[i] objects of category cats[i]; empty categories are skipped."""
+        assert len(cats) == len(nums)
+        cats = np.asarray(cats, dtype=np.int64)
+        nums = np.asarray(nums, dtype=np.int64)
+        known = (cats >= 0) & (cats < len(self.cat_to_row))
+        rows = np.full(len(cats), -1, dtype=np.int64)
+        rows[known] = self.cat_to_row[cats[known]]
+        rows = np.repeat(rows, nums)
+        return self._draw_in_rows(rows[rows >= 0])
@@ -0,0 +1,110 @@
+import os
+import glob
+import pickle
+import numpy as np
+import detectron2.utils.comm as comm
+
+
+def serialize_dataset(dataset):
+    """
+    Pickle every dataset dict of an iterable into one flat uint8 buffer, as
+    DatasetFromList(serialize=True) does. Returns (data, addr), addr[i]
+    being the end of item i in data.
+    """
+    buffers = [np.frombuffer(pickle.dumps(x, protocol=-1), dtype=np.uint8) for x in dataset]
+    addr = np.cumsum([len(x) for x in buffers], dtype=np.int64)
+    data = np.concatenate(buffers) if len(buffers) else np.zeros(0, dtype=np.uint8)
+    return data, addr
+
+
+class SharedDatasetList:
+    """
+    Serialized dataset dicts in two .npy files under a tmpfs directory
+    (/dev/shm), memory-mapped by every process that reads them: the GPU
+    processes of a machine and all of their dataloader workers share the
+    same pages instead of each holding a copy of the list. The maps are
+    reopened lazily after pickling. Items are unpickled on access, so a
+    caller can modify them freely.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._data = None
+        self._addr = None
+
+    @classmethod
+    def create(cls, dataset, shm_dir, name):
+        """
+        Serialize `dataset` (any iterable of dicts, only consumed by the
+        local main process) to `shm_dir`/`name`; a collective call.
+        """
+        path = os.path.join(shm_dir, name)
+        if comm.get_local_rank() == 0:
+            data, addr = serialize_dataset(dataset)
+            for key, array in (('data', data), ('addr', addr)):
+                tmp = '{}_{}.tmp.npy'.format(path, key)
+                np.save(tmp, array)
+                os.replace(tmp, '{}_{}.npy'.format(path, key))
+        comm.synchronize()
+        return cls(path)
+
+    @staticmethod
+    def remove_stale(shm_dir, name):
+        """
+        Unlink the files under `shm_dir` starting with `name`_ other than the
+        ones create(..., name) writes, e.g. left by a killed job.
+        """
+        if comm.get_local_rank() != 0:
+            return
+        path = os.path.join(shm_dir, name)
+        keep = ('{}_data.npy'.format(path), '{}_addr.npy'.format(path))
+        for stale in glob.glob(path + '_*'):
+            if stale not in keep:
+                os.remove(stale)
+
+    def remove(self):
+        """Unlink the files; processes that already mapped them keep reading."""
+        if comm.get_local_rank() == 0:
+            for key in ('data', 'addr'):
+                if os.path.exists('{}_{}.npy'.format(self.path, key)):
+                    os.remove('{}_{}.npy'.format(self.path, key))
+
+    def _open(self):
+        if self._addr is None:
+            self._data = np.load(self.path + '_data.npy', mmap_mode='r')
+            self._addr = np.load(self.path + '_addr.npy', mmap_mode='r')
+        return self._data, self._addr
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = None
+        state['_addr'] = None
+        return state
+
+    def __len__(self):
+        return len(self._open()[1])
+
+    def __getitem__(self, idx):
+        data, addr = self._open()
+        start = 0 if idx == 0 else int(addr[idx - 1])
+        return pickle.loads(memoryview(data[start:int(addr[idx])]))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class IndexedDataset:
+    """Read-only view of `dataset` at `indices`, e.g. an RFS-expanded epoch."""
+    def __init__(self, dataset, indices):
+        self.dataset = dataset
+        self.indices = np.asarray(indices, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, idx):
+        return self.dataset[int(self.indices[idx])]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
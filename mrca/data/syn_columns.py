@@ -0,0 +1,71 @@
+import os
+import numpy as np
+from detectron2.structures import BoxMode
+
+COLUMN_NAMES = ["image_id", "category_id", "bbox", "area", "size", "name_offsets", "names"]
+
+
+def columns_dir(json_file, rd):
+    """Compact annotations diSegmenter writes next to rdN_annotations.json."""
+    return json_file + '/rd' + str(rd) + '_columns'
+
+
+def has_syn_columns(path):
+    return os.path.exists(os.path.join(path, 'done.txt'))
+
+
+class SynColumns:
+    """
+    Read-only view over the compact synthetic annotations: one row per
+    annotated object, every column a .npy file opened as a memory map, so
+    the dataloader workers of all processes share the same pages instead of
+    each holding the list of dicts of load_coco_syn_json. The maps are
+    reopened lazily after pickling.
+
+    Indexing returns the dataset dict of one object, with a 0-based
+    category id; its mask is the alpha channel of the image, as with the json.
+    """
+    def __init__(self, path, image_root=''):
+        self.path = path
+        self.image_root = image_root
+        self.columns = None
+
+    def _open(self):
+        if self.columns is None:
+            self.columns = {name: np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+                            for name in COLUMN_NAMES}
+        return self.columns
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['columns'] = None
+        return state
+
+    def __len__(self):
+        return len(self._open()['image_id'])
+
+    @property
+    def category_ids(self):
+        """0-based category of every object."""
+        return np.asarray(self._open()['category_id'], dtype=np.int64) - 1
+
+    def file_name(self, idx):
+        c = self._open()
+        name = c['names'][c['name_offsets'][idx]:c['name_offsets'][idx + 1]].tobytes().decode()
+        return os.path.join(self.image_root, name)
+
+    def __getitem__(self, idx):
+        c = self._open()
+        height, width = c['size'][idx]
+        return {
+            'file_name': self.file_name(idx),
+            'image_id': int(c['image_id'][idx]),
+            'height': int(height),
+            'width': int(width),
+            'annotations': [{
+                'category_id': int(c['category_id'][idx]) - 1,
+                'bbox': c['bbox'][idx].tolist(),
+                'bbox_mode': BoxMode.XYWH_ABS,
+                'area': int(c['area'][idx]),
+            }],
+        }
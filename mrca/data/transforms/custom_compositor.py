@@ -0,0 +1,186 @@
+import random
+import numpy as np
+
+from .custom_cp_method import blend_image_by_method
+from .custom_mask_ops import get_bboxes
+from ..copy_stats import copy_array
+
+# half size of the 5x5 blur used by the 'gaussian' blend, plus one so the
+# reflected border of an ROI never mirrors mask pixels back in
+_BLEND_MARGIN = 3
+
+
+def _mask_roi(box):
+    x0, y0, x1, y1 = [int(v) for v in box]
+    return slice(y0, y1), slice(x0, x1)
+
+
+def _boxes_overlap(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def _as_tile(src_results):
+    """
+    (image, mask, roi box) of a source. Sources placed by `start_tile` are
+    already tiles, full-canvas ones are cropped to their mask box plus the
+    blend margin, outside of which blending never reads the source.
+    """
+    mask = np.any(src_results['gt_masks'], axis=0)
+    if 'tile_offset' in src_results:
+        x0, y0 = src_results['tile_offset']
+        h, w = mask.shape
+        return src_results['image'], mask, np.array([x0, y0, x0 + w, y0 + h])
+    h, w = mask.shape
+    box = get_bboxes(mask[None])[0].astype(np.int64)
+    if box.any():
+        box = np.clip(box + [-_BLEND_MARGIN, -_BLEND_MARGIN, _BLEND_MARGIN, _BLEND_MARGIN], 0, [w, h, w, h])
+    roi = _mask_roi(box)
+    return src_results['image'][:, roi[0], roi[1]], mask[roi], box
+
+
+def _crop_tight(mask, x0, y0):
+    # an empty mask (e.g. fully occluded) crops to 0 x 0 at (x0, y0), its box
+    # stays all-zero as in the sequential path
+    box = get_bboxes(mask[None])[0].astype(np.int64)
+    roi = _mask_roi(box)
+    return mask[roi].copy(), x0 + box[0], y0 + box[1]
+
+
+def _survives_pastes(cur, x0, y0, prev_box, paste_masks, paste_boxes, force_first,
+                     bbox_occluded_thr, mask_occluded_thr):
+    """
+    Replay the per-paste occlusion filter of `_copy_paste` for one instance,
+    given as a mask tile at (x0, y0). Only pastes overlapping the tile are
+    looked at, since an untouched mask keeps its box.
+    """
+    h, w = cur.shape
+    box = np.array([x0, y0, x0 + w, y0 + h])
+    for k, (m, b) in enumerate(zip(paste_masks, paste_boxes)):
+        changed = False
+        if _boxes_overlap(box, b):
+            ix0, iy0 = max(box[0], b[0]), max(box[1], b[1])
+            ix1, iy1 = min(box[2], b[2]), min(box[3], b[3])
+            sub = cur[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0]
+            hit = sub & m[iy0 - b[1]:iy1 - b[1], ix0 - b[0]:ix1 - b[0]]
+            changed = hit.any()
+            if changed:
+                sub &= ~hit
+        # the first paste is always checked, against the annotated boxes
+        if not changed and not (k == 0 and force_first):
+            continue
+        area = cur.sum()
+        cur_box = get_bboxes(cur[None])[0]
+        if area > 0:
+            cur_box += np.array([x0, y0, x0, y0], dtype=np.float32)
+        if not (np.all(np.abs(cur_box - prev_box) <= bbox_occluded_thr) or area > mask_occluded_thr):
+            return False
+        prev_box = cur_box
+    return True
+
+
+def _blend_tile(img, tile_img, tile_mask, box, method):
+    """
+    Blend one source into `img` in place, touching only its ROI grown by the
+    blur margin. 'possion' still solves on the full canvas, 'possion_roi'
+    only needs the mask box plus one pixel and takes the ROI path.
+    """
+    h, w = img.shape[-2:]
+    if method == 'possion':
+        full_img = np.zeros((tile_img.shape[0], h, w), dtype=tile_img.dtype)
+        full_mask = np.zeros((h, w), dtype=np.int64)
+        roi = _mask_roi(box)
+        full_img[:, roi[0], roi[1]] = tile_img
+        full_mask[roi] = tile_mask
+        img[:] = blend_image_by_method(img, full_img, full_mask, method).astype(img.dtype)
+        return
+    x0, y0 = max(box[0] - _BLEND_MARGIN, 0), max(box[1] - _BLEND_MARGIN, 0)
+    x1, y1 = min(box[2] + _BLEND_MARGIN, w), min(box[3] + _BLEND_MARGIN, h)
+    roi_img = np.zeros((tile_img.shape[0], y1 - y0, x1 - x0), dtype=tile_img.dtype)
+    roi_mask = np.zeros((y1 - y0, x1 - x0), dtype=np.int64)
+    inner = _mask_roi([box[0] - x0, box[1] - y0, box[2] - x0, box[3] - y0])
+    roi_img[:, inner[0], inner[1]] = tile_img
+    roi_mask[inner] = tile_mask
+    dst = img[:, y0:y1, x0:x1]
+    dst[:] = blend_image_by_method(dst, roi_img, roi_mask, method).astype(img.dtype)
+
+
+def composite_instances(dst_results, src_results_list, cp_method,
+                        bbox_occluded_thr=10, mask_occluded_thr=300):
+    """
+    Paste all single-object sources onto the destination in one pass. Same
+    output as calling `_copy_paste` once per source in order, under the same
+    seed:
+
+    - a label map holding the index of the last source covering each pixel
+      gives every final mask at once (later pastes occlude earlier ones);
+    - instances whose final area is above `mask_occluded_thr` can never be
+      filtered, the rest replay the per-paste box test on their own ROI;
+    - 'basic' blending is a per-pixel copy from the covering source, other
+      methods are still applied paste by paste on the source ROI.
+
+    Sources may be full-canvas (`start_xy`) or tiles with an offset
+    (`start_tile`); full-size masks are only built for the output.
+    """
+    src_results_list = [x for x in src_results_list if len(x['gt_bboxes']) > 0]
+    assert all(len(x['gt_bboxes']) == 1 for x in src_results_list), 'expects one object per source'
+    # blend_image draws one method per paste, keep the python RNG in step
+    methods = [random.sample(cp_method, 1)[0] for _ in src_results_list]
+    if len(src_results_list) == 0:
+        return dst_results
+
+    dst_img = dst_results['image']
+    dst_masks = dst_results['gt_masks']
+    h, w = dst_masks.shape[-2:]
+    num_dst = len(dst_masks)
+
+    tiles = [_as_tile(x) for x in src_results_list]
+    paste_masks = [t[1] for t in tiles]
+    paste_boxes = [t[2] for t in tiles]
+    label_map = np.full((h, w), -1, dtype=np.int32)
+    for j, (m, b) in enumerate(zip(paste_masks, paste_boxes)):
+        label_map[_mask_roi(b)][m] = j
+
+    uncovered = label_map < 0
+    masks = np.empty((num_dst + len(tiles), h, w), dtype=bool)
+    np.logical_and(dst_masks, uncovered, out=masks[:num_dst])
+    masks[num_dst:] = False
+    for j, b in enumerate(paste_boxes):
+        roi = _mask_roi(b)
+        masks[num_dst + j][roi] = label_map[roi] == j
+
+    areas = np.count_nonzero(masks, axis=(1, 2))
+    valid = areas > mask_occluded_thr
+    for i in np.nonzero(~valid)[0]:
+        if i < num_dst:
+            cur, x0, y0 = _crop_tight(dst_masks[i].astype(bool), 0, 0)
+            valid[i] = _survives_pastes(cur, x0, y0, dst_results['gt_bboxes'][i],
+                paste_masks, paste_boxes, True, bbox_occluded_thr, mask_occluded_thr)
+        else:
+            j = i - num_dst
+            cur, x0, y0 = _crop_tight(paste_masks[j], paste_boxes[j][0], paste_boxes[j][1])
+            valid[i] = _survives_pastes(cur, x0, y0, src_results_list[j]['gt_bboxes'][0],
+                paste_masks[j + 1:], paste_boxes[j + 1:], False, bbox_occluded_thr, mask_occluded_thr)
+
+    img = copy_array(dst_img)
+    if all(x == 'basic' for x in methods):
+        for j, (tile_img, _, b) in enumerate(tiles):
+            roi = _mask_roi(b)
+            sel = label_map[roi] == j
+            img[:, roi[0], roi[1]][:, sel] = tile_img[:3, sel]
+    else:
+        for (tile_img, m, b), method in zip(tiles, methods):
+            _blend_tile(img, tile_img, m, b, method)
+
+    masks = masks[valid]
+    bboxes = get_bboxes(masks)
+    src_file_names = np.concatenate([np.array(x['file_name']).flatten() for x in src_results_list])
+    dst_results['image'] = img
+    dst_results['gt_bboxes'] = bboxes
+    dst_results['gt_labels'] = np.concatenate(
+        [dst_results['gt_labels']] + [x['gt_labels'] for x in src_results_list])[valid]
+    dst_results['gt_masks'] = masks
+    dst_results['instance_source'] = np.concatenate(
+        [dst_results['instance_source'], np.ones(len(src_results_list), dtype=np.int64)])[valid]
+    dst_results['file_name_list'] = np.concatenate(
+        [dst_results['file_name_list'], src_file_names])[valid]
+    return dst_results
@@ -8,7 +8,10 @@ from detectron2.data.transforms.augmentation_impl import RandomRotation
 from detectron2.structures import Boxes, ImageList, Instances, pairwise_iou, BoxMode
 from detectron2.evaluation.coco_evaluation import instances_to_coco_json
 import detectron2.utils.comm as comm
-from odod.data.transforms.custom_cp_method import blend_image
+from .custom_cp_method import blend_image
+from .custom_mask_ops import PackedMasks, get_bboxes
+from ..copy_stats import counted_deepcopy, record_copy
+from ..inst_sampler import AliasSampler
 import math
 import json
 import cv2
@@ -19,8 +22,10 @@ def convert_instance_to_dict(x):
         return x
     inst = x['instances']
     try :
+        masks = inst.get('gt_masks')
+        masks = masks.to_dense() if isinstance(masks, PackedMasks) else masks.tensor.numpy()
         result = {'img' : x['image'].numpy(), 'file_name':x['file_name'],
-            'gt_bboxes': inst.get('gt_boxes').tensor.numpy(), 'gt_labels': inst.get('gt_classes').numpy(), 'gt_masks':inst.get('gt_masks').tensor.numpy()}
+            'gt_bboxes': inst.get('gt_boxes').tensor.numpy(), 'gt_labels': inst.get('gt_classes').numpy(), 'gt_masks':masks}
         print('convert success')
         return result
     except :
@@ -81,7 +86,7 @@ class CopyPaste:
         self.mask_occluded_thr = mask_occluded_thr
         self.selected = selected
         self.dataset = dataset
-        self.repeat_probs = repeat_probs
+        self.set_repeat_probs(repeat_probs)
         self.blank_ratio = blank_ratio
         self.cid_filter = cid_filter
         self.cp_method= cp_method
@@ -90,18 +95,26 @@ class CopyPaste:
         self.limit_inp_trans = limit_inp_trans
         self.rotate_src = rotate_src
 
-    def get_indexes(self, dataset):
+    def set_repeat_probs(self, repeat_probs):
+        """Source image probabilities, None for uniform; tabled once for O(1) draws."""
+        self.repeat_probs = repeat_probs
+        self.sampler = AliasSampler(repeat_probs) if repeat_probs is not None else None
+
+    def get_indexes(self, dataset, num=None):
         """Call function to collect indexes.s.
         Args:
             dataset (:obj:`MultiImageMixDataset`): The dataset.
+            num (int): Number of indexes, None for a single one.
         Returns:
-            list: Indexes.
+            int, or an array of `num` indexes.
         """
-        if self.repeat_probs is not None :
-            assert len(self.repeat_probs) == len(dataset)
-            # return random.choices(list(range(dataset)), weight=self.repeat_probs)
-            return random.choice(list(range(len(dataset))), p=self.repeat_probs)
-        return random.randint(0, len(dataset))
+        size = 1 if num is None else num
+        if self.sampler is not None :
+            assert len(self.sampler) == len(dataset)
+            idxs = self.sampler.sample(size)
+        else :
+            idxs = random.randint(0, len(dataset), size)
+        return int(idxs[0]) if num is None else idxs
 
     def remove_background(self, results):
         img = results['image']
@@ -200,7 +213,7 @@ class CopyPaste:
         mask_new = np.stack(mask_new_list)
         bboxes_new = self.get_bboxes(mask_new)
 
-        results_origin = copy.deepcopy(results)
+        results_origin = counted_deepcopy(results)
         file_name = results['file_name']
         results_origin['instances'] = results_origin['instances'][~cls_filter]
         if inp and 'inp_image' in results:
@@ -260,7 +273,8 @@ class CopyPaste:
             print("rotate inp")
             if np.random.randint(0, 3) :
                 return self._inp_rotate(results)
-        results_origin = copy.deepcopy(results)
+        # results itself is never written to, a new dict is enough
+        results_origin = dict(results)
         assert 'mix_results' in results
         num_images = len(results['mix_results'])
         # when mix results is empty, jump scp
@@ -333,7 +347,7 @@ class CopyPaste:
         print("3")
         if save_img_dir is not None :
 
-            insta_save = copy.deepcopy(results_origin['instances'])
+            insta_save = counted_deepcopy(results_origin['instances'])
             insta_save.gt_classes +=1 # convert 0-index to 1-index
 
             boxes = insta_save.gt_boxes.tensor.numpy()
@@ -370,7 +384,7 @@ class CopyPaste:
 
         scale = 1
         if not is_tmp_dst and self.blank_ratio > 0 :
-            composed_mask = np.where(np.any(src_results['gt_masks'], axis=0), 1, 0)
+            composed_mask = record_copy(np.where(np.any(src_results['gt_masks'], axis=0), 1, 0))
             ratio = (h2 * w2 - composed_mask.sum() - h1 * w1) / (h * w)
             if ratio > self.blank_ratio :
                 h2_new = np.random.randint(int(0.5*h1), int(1.1*h1))
@@ -391,7 +405,9 @@ class CopyPaste:
                 h2, w2 = h2_new, w2_new
                 h, w = max(h1,h2), max(w1,w2)
         def pad_to_hw(data, h, w):
-            new_data = np.zeros((data.shape[0], h, w), dtype=data.dtype)
+            if data.shape[1:] == (h, w):
+                return data
+            new_data = record_copy(np.zeros((data.shape[0], h, w), dtype=data.dtype))
             d_h, d_w = min(h, data.shape[1]), min(w, data.shape[2])
             new_data[:,:d_h,:d_w] = data[:,:d_h,:d_w]
             # new_data[:,:data.shape[1],:data.shape[2]] = data
@@ -425,19 +441,7 @@ class CopyPaste:
         return results
     
     def get_bboxes(self, masks):
-        num_masks = len(masks)
-        boxes = np.zeros((num_masks, 4), dtype=np.float32)
-        x_any = masks.any(axis=1)
-        y_any = masks.any(axis=2)
-        for idx in range(num_masks):
-            x = np.where(x_any[idx, :])[0]
-            y = np.where(y_any[idx, :])[0]
-            if len(x) > 0 and len(y) > 0:
-                # use +1 for x_max and y_max so that the right and bottom
-                # boundary of instance masks are fully included by the box
-                boxes[idx, :] = np.array([x[0], y[0], x[-1] + 1, y[-1] + 1],
-                                         dtype=np.float32)
-        return boxes
+        return get_bboxes(masks)
 
     def _copy_paste(self, dst_results, src_results, ret_valid_idx=False):
         """CopyPaste transform function.
@@ -462,7 +466,7 @@ class CopyPaste:
             return dst_results
 
         # update masks and generate bboxes from updated masks
-        composed_mask = np.where(np.any(src_masks, axis=0), 1, 0)
+        composed_mask = record_copy(np.where(np.any(src_masks, axis=0), 1, 0))
         updated_dst_masks = self.get_updated_masks(dst_masks, composed_mask)
         # updated_dst_bboxes = updated_dst_masks.get_bboxes()
         updated_dst_bboxes = self.get_bboxes(updated_dst_masks)
@@ -478,12 +482,12 @@ class CopyPaste:
         valid_inds = bboxes_inds | masks_inds
 
         # Paste source objects to destination image directly
-        img = blend_image(dst_img,src_img,composed_mask,self.cp_method).astype(dst_img.dtype)
+        img = record_copy(blend_image(dst_img,src_img,composed_mask,self.cp_method).astype(dst_img.dtype))
 
         bboxes = np.concatenate([updated_dst_bboxes[valid_inds], src_bboxes])
         labels = np.concatenate([dst_labels[valid_inds], src_labels])
-        masks = np.concatenate(
-            [updated_dst_masks[valid_inds], src_masks])
+        masks = record_copy(np.concatenate(
+            [updated_dst_masks[valid_inds], src_masks]))
 
         dst_results['img'] = img
         dst_results['gt_bboxes'] = bboxes
@@ -497,7 +501,7 @@ class CopyPaste:
     def get_updated_masks(self, masks, composed_mask):
         assert masks.shape[-2:] == composed_mask.shape[-2:], \
             'Cannot compare two arrays of different size {} {}'.format(masks.shape, composed_mask.shape)
-        masks = np.where(composed_mask, 0, masks)
+        masks = record_copy(np.where(composed_mask, 0, masks))
         return masks
 
     def __repr__(self):
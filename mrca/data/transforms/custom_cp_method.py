@@ -1,9 +1,12 @@
 import numpy as np
-from odod.data.transforms.possion_blending import poisson_edit
+from .possion_blending import poisson_edit, poisson_edit_roi
 import random
 import cv2
 def blend_image(dst_img,src_img,composed_mask,cp_method):
     cp_method=random.sample(cp_method,1)[0]
+    return blend_image_by_method(dst_img,src_img,composed_mask,cp_method)
+
+def blend_image_by_method(dst_img,src_img,composed_mask,cp_method):
     if cp_method=='basic':
         src_img=src_img[:3]
         return dst_img*(1-composed_mask)+src_img*composed_mask
@@ -19,4 +22,8 @@ def blend_image(dst_img,src_img,composed_mask,cp_method):
     if cp_method=='possion':
         src_img=src_img[:3].transpose(1,2,0)
         dst_img=dst_img.transpose(1,2,0)
-        return poisson_edit(src_img,dst_img,composed_mask).transpose(2,0,1)
\ No newline at end of file
+        return poisson_edit(src_img,dst_img,composed_mask).transpose(2,0,1)
+    if cp_method=='possion_roi':
+        src_img=src_img[:3].transpose(1,2,0)
+        dst_img=dst_img.transpose(1,2,0)
+        return poisson_edit_roi(src_img,dst_img,composed_mask).transpose(2,0,1)
\ No newline at end of file
@@ -1,7 +1,7 @@
 import numpy as np
 import cv2
 import scipy.sparse
-from scipy.sparse.linalg import spsolve
+from scipy.sparse.linalg import spsolve, splu
 from copy import deepcopy
 from os import path
 
@@ -63,6 +63,53 @@ def poisson_edit(source, target, mask):
 
     return target
 
+def poisson_edit_roi(source, target, mask):
+    """
+    Same guided interpolation as `poisson_edit`, but only the mask pixels are
+    unknowns: the system is built on the mask box plus a one-pixel border of
+    fixed target values, factorized once and solved for all channels
+    together. Matches `poisson_edit` for masks at least two pixels away from
+    the image border (`poisson_edit` also re-solves the outermost rows and
+    columns of the target).
+    """
+    target = target.copy()
+    ys, xs = np.nonzero(mask)
+    if len(ys) == 0:
+        return target
+    h, w = mask.shape
+    y0, y1 = max(ys.min() - 1, 0), min(ys.max() + 2, h)
+    x0, x1 = max(xs.min() - 1, 0), min(xs.max() + 2, w)
+    roi_mask = mask[y0:y1, x0:x1] != 0
+    src = source[y0:y1, x0:x1].reshape(y1 - y0, x1 - x0, -1).astype(np.float64)
+    dst = target[y0:y1, x0:x1].reshape(y1 - y0, x1 - x0, -1).astype(np.float64)
+
+    py, px = np.nonzero(roi_mask)
+    num = len(py)
+    index = np.full(roi_mask.shape, -1, dtype=np.int64)
+    index[py, px] = np.arange(num)
+    rows, cols, vals = [np.arange(num)], [np.arange(num)], [np.full(num, 4.)]
+    mat_b = 4 * src[py, px]
+    for dy, dx in ((-1, 0), (1, 0), (0, -1), (0, 1)):
+        qy, qx = py + dy, px + dx
+        # the roi only ends before a neighbour at the image border, where
+        # poisson_edit has no neighbour either
+        inside = (qy >= 0) & (qy < y1 - y0) & (qx >= 0) & (qx < x1 - x0)
+        k, qy, qx = np.nonzero(inside)[0], qy[inside], qx[inside]
+        mat_b[k] -= src[qy, qx]
+        unknown = roi_mask[qy, qx]
+        rows.append(k[unknown])
+        cols.append(index[qy[unknown], qx[unknown]])
+        vals.append(np.full(unknown.sum(), -1.))
+        mat_b[k[~unknown]] += dst[qy[~unknown], qx[~unknown]]
+    mat_A = scipy.sparse.csc_matrix(
+        (np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))), shape=(num, num))
+
+    x = splu(mat_A).solve(mat_b)
+    x = np.clip(x, 0, 255).astype('uint8')
+    target[y0 + py, x0 + px] = x.reshape(target[y0 + py, x0 + px].shape)
+    return target
+
+
 def main():    
     scr_dir = 'figs/example1'
     out_dir = scr_dir
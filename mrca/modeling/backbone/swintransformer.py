@@ -9,6 +9,7 @@
 # Modified by Xingyi Zhou from https://github.com/SwinTransformer/Swin-Transformer-Object-Detection/blob/master/mmdet/models/backbones/swin_transformer.py
 
 
+from collections import OrderedDict
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -87,14 +88,21 @@ class WindowAttention(nn.Module):
         qk_scale (float | None, optional): Override default qk scale of head_dim ** -0.5 if set
         attn_drop (float, optional): Dropout ratio of attention weight. Default: 0.0
         proj_drop (float, optional): Dropout ratio of output. Default: 0.0
+        use_sdpa (bool, optional): If True, use F.scaled_dot_product_attention with the relative position
+            bias and the mask as one additive mask. Default: False
     """
 
-    def __init__(self, dim, window_size, num_heads, qkv_bias=True, qk_scale=None, attn_drop=0., proj_drop=0.):
+    def __init__(self, dim, window_size, num_heads, qkv_bias=True, qk_scale=None, attn_drop=0., proj_drop=0.,
+                 use_sdpa=False):
 
         super().__init__()
         self.dim = dim
         self.window_size = window_size  # Wh, Ww
         self.num_heads = num_heads
+        self.use_sdpa = use_sdpa
+        # the scale argument of F.scaled_dot_product_attention is new in 2.1
+        assert not use_sdpa or tuple(int(v) for v in torch.__version__.split('.')[:2]) >= (2, 1), \
+            "use_sdpa needs torch >= 2.1"
         head_dim = dim // num_heads
         self.scale = qk_scale or head_dim ** -0.5
 
@@ -133,12 +141,18 @@ class WindowAttention(nn.Module):
         qkv = self.qkv(x).reshape(B_, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]  # make torchscript happy (cannot use tensor as tuple)
 
-        q = q * self.scale
-        attn = (q @ k.transpose(-2, -1))
-
         relative_position_bias = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
             self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
         relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
+
+        if self.use_sdpa:
+            x = self.sdpa(q, k, v, relative_position_bias, mask)
+            x = self.proj(x)
+            x = self.proj_drop(x)
+            return x
+
+        q = q * self.scale
+        attn = (q @ k.transpose(-2, -1))
         attn = attn + relative_position_bias.unsqueeze(0)
 
         if mask is not None:
@@ -156,6 +170,27 @@ class WindowAttention(nn.Module):
         x = self.proj_drop(x)
         return x
 
+    def sdpa(self, q, k, v, relative_position_bias, mask=None):
+        """ Attention of forward with F.scaled_dot_product_attention.
+        Args:
+            q, k, v: (num_windows*B, nH, N, C/nH)
+            relative_position_bias: (nH, N, N)
+            mask: (0/-inf) mask with shape of (num_windows, N, N) or None
+        Returns:
+            x: (num_windows*B, N, C)
+        """
+        B_, nH, N, _ = q.shape
+        attn_mask = relative_position_bias.unsqueeze(0)  # 1, nH, N, N
+        if mask is not None:
+            # windows of an image along the head dim, so that the mask broadcasts over images
+            nW = mask.shape[0]
+            attn_mask = (attn_mask + mask.unsqueeze(1)).view(1, nW * nH, N, N)
+            q, k, v = [t.reshape(B_ // nW, nW * nH, N, -1) for t in (q, k, v)]
+        x = F.scaled_dot_product_attention(
+            q, k, v, attn_mask=attn_mask.to(q.dtype),
+            dropout_p=self.attn_drop.p if self.training else 0., scale=self.scale)
+        return x.reshape(B_, nH, N, -1).transpose(1, 2).reshape(B_, N, -1)
+
 
 class SwinTransformerBlock(nn.Module):
     """ Swin Transformer Block.
@@ -172,11 +207,12 @@ class SwinTransformerBlock(nn.Module):
         drop_path (float, optional): Stochastic depth rate. Default: 0.0
         act_layer (nn.Module, optional): Activation layer. Default: nn.GELU
         norm_layer (nn.Module, optional): Normalization layer.  Default: nn.LayerNorm
+        use_sdpa (bool, optional): If True, compute attention with F.scaled_dot_product_attention. Default: False
     """
 
     def __init__(self, dim, num_heads, window_size=7, shift_size=0,
                  mlp_ratio=4., qkv_bias=True, qk_scale=None, drop=0., attn_drop=0., drop_path=0.,
-                 act_layer=nn.GELU, norm_layer=nn.LayerNorm):
+                 act_layer=nn.GELU, norm_layer=nn.LayerNorm, use_sdpa=False):
         super().__init__()
         self.dim = dim
         self.num_heads = num_heads
@@ -188,7 +224,7 @@ class SwinTransformerBlock(nn.Module):
         self.norm1 = norm_layer(dim)
         self.attn = WindowAttention(
             dim, window_size=to_2tuple(self.window_size), num_heads=num_heads,
-            qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop)
+            qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop, use_sdpa=use_sdpa)
 
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
         self.norm2 = norm_layer(dim)
@@ -314,6 +350,8 @@ class BasicLayer(nn.Module):
         norm_layer (nn.Module, optional): Normalization layer. Default: nn.LayerNorm
         downsample (nn.Module | None, optional): Downsample layer at the end of the layer. Default: None
         use_checkpoint (bool): Whether to use checkpointing to save memory. Default: False.
+        use_sdpa (bool): Whether to compute attention with F.scaled_dot_product_attention. Default: False.
+        attn_mask_cache_size (int): Number of padded input shapes whose SW-MSA masks are kept. Default: 8.
     """
 
     def __init__(self,
@@ -329,12 +367,16 @@ class BasicLayer(nn.Module):
                  drop_path=0.,
                  norm_layer=nn.LayerNorm,
                  downsample=None,
-                 use_checkpoint=False):
+                 use_checkpoint=False,
+                 use_sdpa=False,
+                 attn_mask_cache_size=8):
         super().__init__()
         self.window_size = window_size
         self.shift_size = window_size // 2
         self.depth = depth
         self.use_checkpoint = use_checkpoint
+        self.attn_mask_cache_size = attn_mask_cache_size
+        self.attn_masks = OrderedDict()  # (Hp, Wp, device) -> attn_mask, least recently used first
 
         # build blocks
         self.blocks = nn.ModuleList([
@@ -349,7 +391,8 @@ class BasicLayer(nn.Module):
                 drop=drop,
                 attn_drop=attn_drop,
                 drop_path=drop_path[i] if isinstance(drop_path, list) else drop_path,
-                norm_layer=norm_layer)
+                norm_layer=norm_layer,
+                use_sdpa=use_sdpa)
             for i in range(depth)])
 
         # patch merging layer
@@ -358,17 +401,16 @@ class BasicLayer(nn.Module):
         else:
             self.downsample = None
 
-    def forward(self, x, H, W):
-        """ Forward function.
-        Args:
-            x: Input feature, tensor size (B, H*W, C).
-            H, W: Spatial resolution of the input feature.
+    def get_attn_mask(self, Hp, Wp, device):
+        """ Attention mask for SW-MSA of a padded Hp x Wp feature map. It only depends on the
+        shape, of which multi-scale training sees a few, so the last attn_mask_cache_size are kept.
         """
+        key = (Hp, Wp, device)
+        if key in self.attn_masks:
+            self.attn_masks.move_to_end(key)
+            return self.attn_masks[key]
 
-        # calculate attention mask for SW-MSA
-        Hp = int(np.ceil(H / self.window_size)) * self.window_size
-        Wp = int(np.ceil(W / self.window_size)) * self.window_size
-        img_mask = torch.zeros((1, Hp, Wp, 1), device=x.device)  # 1 Hp Wp 1
+        img_mask = torch.zeros((1, Hp, Wp, 1), device=device)  # 1 Hp Wp 1
         h_slices = (slice(0, -self.window_size),
                     slice(-self.window_size, -self.shift_size),
                     slice(-self.shift_size, None))
@@ -386,6 +428,24 @@ class BasicLayer(nn.Module):
         attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
         attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(attn_mask == 0, float(0.0))
 
+        if self.attn_mask_cache_size > 0:
+            self.attn_masks[key] = attn_mask
+            if len(self.attn_masks) > self.attn_mask_cache_size:
+                self.attn_masks.popitem(last=False)
+        return attn_mask
+
+    def forward(self, x, H, W):
+        """ Forward function.
+        Args:
+            x: Input feature, tensor size (B, H*W, C).
+            H, W: Spatial resolution of the input feature.
+        """
+
+        # calculate attention mask for SW-MSA
+        Hp = int(np.ceil(H / self.window_size)) * self.window_size
+        Wp = int(np.ceil(W / self.window_size)) * self.window_size
+        attn_mask = self.get_attn_mask(Hp, Wp, x.device)
+
         for blk in self.blocks:
             blk.H, blk.W = H, W
             if self.use_checkpoint:
@@ -468,6 +528,7 @@ class SwinTransformer(Backbone):
         frozen_stages (int): Stages to be frozen (stop grad and set eval mode).
             -1 means not freezing any parameters.
         use_checkpoint (bool): Whether to use checkpointing to save memory. Default: False.
+        use_sdpa (bool): Whether to compute attention with F.scaled_dot_product_attention. Default: False.
     """
 
     def __init__(self,
@@ -489,7 +550,8 @@ class SwinTransformer(Backbone):
                  patch_norm=True,
                  out_indices=(0, 1, 2, 3),
                  frozen_stages=-1,
-                 use_checkpoint=False):
+                 use_checkpoint=False,
+                 use_sdpa=False):
         super().__init__()
 
         self.pretrain_img_size = pretrain_img_size
@@ -535,7 +597,8 @@ class SwinTransformer(Backbone):
                 drop_path=dpr[sum(depths[:i_layer]):sum(depths[:i_layer + 1])],
                 norm_layer=norm_layer,
                 downsample=PatchMerging if (i_layer < self.num_layers - 1) else None,
-                use_checkpoint=use_checkpoint)
+                use_checkpoint=use_checkpoint,
+                use_sdpa=use_sdpa)
             self.layers.append(layer)
 
         num_features = [int(embed_dim * 2 ** i) for i in range(self.num_layers)]
@@ -706,7 +769,8 @@ def build_swintransformer_backbone(cfg, input_shape):
         drop_path_rate=config['drop_path_rate'],
         out_indices=out_indices,
         frozen_stages=-1,
-        use_checkpoint=cfg.MODEL.SWIN.USE_CHECKPOINT
+        use_checkpoint=cfg.MODEL.SWIN.USE_CHECKPOINT,
+        use_sdpa=cfg.MODEL.SWIN.USE_SDPA
     )
     # print('Initializing', config['pretrained'])
     model.init_weights(config['pretrained'])
@@ -0,0 +1,87 @@
+import os
+import copy
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from detectron2.structures import Boxes
+from detectron2.modeling.poolers import assign_boxes_to_levels
+
+
+def feedback_paths(ckpt_path):
+    """(traced classifier, class-weight matrix) exported next to a checkpoint."""
+    base = ckpt_path[:-len('.pth')] if ckpt_path.endswith('.pth') else ckpt_path
+    return base + '_feedback.pt', base + '_clw.pt'
+
+
+class FeedbackClassifier(nn.Module):
+    """
+    The part of FeedbackRCNN.inference the generator uses as `fg_classifier`:
+    normalize and pad the images, run the backbone, pool one full-image box
+    per image and score it with the last cascade stage. Returns the B x C'
+    class logits, without the proposal generator, the earlier cascade
+    stages and the mask head.
+
+    The pyramid level of a full-image box only depends on the image size,
+    so it is picked once per size and the module can be traced with any
+    batch size.
+    """
+    def __init__(self, model):
+        super().__init__()
+        roi_heads = model.roi_heads
+        self.backbone = model.backbone
+        self.in_features = list(roi_heads.box_in_features)
+        self.box_pooler = roi_heads.box_pooler
+        self.box_head = roi_heads.box_head[-1]
+        self.cls_score = roi_heads.box_predictor[-1].cls_score
+        self.size_divisibility = model.backbone.size_divisibility
+        self.register_buffer('pixel_mean', model.pixel_mean.clone(), False)
+        self.register_buffer('pixel_std', model.pixel_std.clone(), False)
+
+    def _level(self, height, width):
+        pooler = self.box_pooler
+        if len(pooler.level_poolers) == 1:
+            return 0
+        box = Boxes(torch.tensor([[0., 0., width, height]]))
+        return int(assign_boxes_to_levels(
+            [box], pooler.min_level, pooler.max_level,
+            pooler.canonical_box_size, pooler.canonical_level)[0])
+
+    def forward(self, images):
+        height, width = images.shape[-2:]
+        x = (images - self.pixel_mean) / self.pixel_std
+        if self.size_divisibility > 1:
+            # same zero padding as ImageList.from_tensors
+            pad_h = -height % self.size_divisibility
+            pad_w = -width % self.size_divisibility
+            x = F.pad(x, (0, pad_w, 0, pad_h))
+        features = self.backbone(x)
+        level = self._level(int(height), int(width))
+        # rows (batch index, x1, y1, x2, y2), built from the input so that a
+        # traced module keeps the batch size dynamic
+        ones = torch.ones_like(images[:, 0, 0, 0])
+        rois = torch.stack([ones.cumsum(0) - 1, ones * 0, ones * 0, ones * width, ones * height], dim=1)
+        box_features = self.box_pooler.level_poolers[level](features[self.in_features[level]], rois)
+        box_features = self.box_head(box_features)
+        return self.cls_score(torch.flatten(box_features, start_dim=1))
+
+
+@torch.no_grad()
+def export_feedback_classifier(model, ckpt_path, image_size=512):
+    """
+    Trace the FeedbackClassifier of `model` (a FeedbackRCNN, possibly
+    wrapped in DistributedDataParallel) and save it with the class-weight
+    matrix of the last cascade stage next to `ckpt_path`. The generator
+    loads these instead of rebuilding the detector from the config.
+    """
+    model = getattr(model, 'module', model)
+    classifier = copy.deepcopy(FeedbackClassifier(model)).float().eval()
+    example = torch.rand(2, 3, image_size, image_size, device=model.pixel_mean.device) * 255
+    traced = torch.jit.trace(classifier, example)
+    feedback_path, clw_path = feedback_paths(ckpt_path)
+    torch.jit.save(traced, feedback_path + '.tmp')
+    torch.save(classifier.cls_score.weight.detach().cpu(), clw_path + '.tmp')
+    # the classifier is renamed last, its existence means a complete export
+    os.replace(clw_path + '.tmp', clw_path)
+    os.replace(feedback_path + '.tmp', feedback_path)
+    return feedback_path, clw_path
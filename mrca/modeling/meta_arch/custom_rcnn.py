@@ -971,12 +971,15 @@ class FeedbackRCNN(GeneralizedRCNN):
         return ret
 
     def create_simple_proposals(self, images):
-        proposal = [Instances(image_size = images.image_sizes[0])]
-
-        proposal[0].set(name = 'scores', value = torch.tensor([0.5]).to(images.device))
-        proposal[0].set(name = 'pred_classes', value = torch.tensor([0]).to(images.device))
-        proposal[0].set(name = 'proposal_boxes', value = Boxes(torch.tensor([[0,0, images.image_sizes[0][0], images.image_sizes[0][1] ]]).to(images.device)))
-        proposal[0].set(name = 'objectness_logits', value = torch.tensor([1.0]).to(images.device))
+        # one full-image box per image, so a batch gives one row of logits per image
+        proposal = []
+        for h, w in images.image_sizes:
+            p = Instances(image_size = (h, w))
+            p.set(name = 'scores', value = torch.tensor([0.5]).to(images.device))
+            p.set(name = 'pred_classes', value = torch.tensor([0]).to(images.device))
+            p.set(name = 'proposal_boxes', value = Boxes(torch.tensor([[0, 0, w, h]], dtype=torch.float32).to(images.device)))
+            p.set(name = 'objectness_logits', value = torch.tensor([1.0]).to(images.device))
+            proposal.append(p)
 
 
         # proposal.fields['scores']= torch.tensor([0.5]).to(images.device)
@@ -39,6 +39,7 @@ def add_centernet_config(cfg):
     _C.MODEL.CENTERNET.MORE_POS = False
     _C.MODEL.CENTERNET.MORE_POS_THRESH = 0.2
     _C.MODEL.CENTERNET.MORE_POS_TOPK = 9
+    _C.MODEL.CENTERNET.SPARSE_GT = False
     _C.MODEL.CENTERNET.NOT_NORM_REG = True
     _C.MODEL.CENTERNET.NOT_NMS = False
     _C.MODEL.CENTERNET.NO_REDUCE = False
@@ -59,6 +59,7 @@ class CenterNet(nn.Module):
         more_pos=False,
         more_pos_thresh=0.2,
         more_pos_topk=9,
+        sparse_gt=False,
         pre_nms_topk_train=1000,
         pre_nms_topk_test=1000,
         post_nms_topk_train=100,
@@ -97,6 +98,7 @@ class CenterNet(nn.Module):
         self.more_pos = more_pos
         self.more_pos_thresh = more_pos_thresh
         self.more_pos_topk = more_pos_topk
+        self.sparse_gt = sparse_gt
         self.pre_nms_topk_train = pre_nms_topk_train
         self.pre_nms_topk_test = pre_nms_topk_test
         self.post_nms_topk_train = post_nms_topk_train
@@ -158,6 +160,7 @@ class CenterNet(nn.Module):
             'more_pos': cfg.MODEL.CENTERNET.MORE_POS,
             'more_pos_thresh': cfg.MODEL.CENTERNET.MORE_POS_THRESH,
             'more_pos_topk': cfg.MODEL.CENTERNET.MORE_POS_TOPK,
+            'sparse_gt': cfg.MODEL.CENTERNET.SPARSE_GT,
             'pre_nms_topk_train': cfg.MODEL.CENTERNET.PRE_NMS_TOPK_TRAIN,
             'pre_nms_topk_test': cfg.MODEL.CENTERNET.PRE_NMS_TOPK_TEST,
             'post_nms_topk_train': cfg.MODEL.CENTERNET.POST_NMS_TOPK_TRAIN,
@@ -382,6 +385,14 @@ class CenterNet(nn.Module):
                     grids.new_zeros((
                         M, 1 if self.only_proposal else heatmap_channels)))
                 continue
+
+            if self.sparse_gt:
+                reg_target, flattened_hm = self._get_sparse_targets(
+                    grids, strides, reg_size_ranges, shapes_per_level,
+                    num_loc_list, boxes, area, gt_classes, heatmap_channels)
+                reg_targets.append(reg_target)
+                flattened_hms.append(flattened_hm)
+                continue
             
             l = grids[:, 0].view(M, 1) - boxes[:, 0].view(1, N) # M x N
             t = grids[:, 1].view(M, 1) - boxes[:, 1].view(1, N) # M x N
@@ -436,6 +447,132 @@ class CenterNet(nn.Module):
         return pos_inds, labels, reg_targets, flattened_hms
 
 
+    def _get_sparse_targets(self, grids, strides, reg_size_ranges,
+        shapes_per_level, num_loc_list, boxes, area, gt_classes, channels):
+        '''
+        The targets of the dense assignment in _get_ground_truth for one image,
+        computed only at the (location, object) pairs of _get_candidates
+        instead of on M x N (x 4) tensors; the heatmap is a segment-min over
+        the (location, class) pairs of the classes present.
+        Inputs:
+            grids: M x 2
+            strides: M
+            reg_size_ranges: M x 2
+            boxes: N x 4
+            area: N
+            gt_classes: N
+        Return:
+            reg_target: M x 4
+            flattened_hm: M x C or M x 1
+        '''
+        M = grids.shape[0]
+        radius2 = torch.clamp(
+            self.delta ** 2 * 2 * area, min=self.min_radius ** 2) # N
+        m, n = self._get_candidates(
+            boxes, radius2, shapes_per_level, num_loc_list) # P, P
+        P = m.shape[0]
+        locations = grids[m] # P x 2
+        boxes_p = boxes[n] # P x 4
+        reg_target = torch.stack([
+            locations[:, 0] - boxes_p[:, 0], locations[:, 1] - boxes_p[:, 1],
+            boxes_p[:, 2] - locations[:, 0], boxes_p[:, 3] - locations[:, 1]],
+            dim=1) # P x 4
+
+        centers = ((boxes_p[:, [0, 1]] + boxes_p[:, [2, 3]]) / 2) # P x 2
+        strides_p = strides[m].view(P, 1).expand(P, 2) # P x 2
+        centers_discret = ((centers / strides_p).int() * \
+            strides_p).float() + strides_p / 2 # P x 2
+        is_peak = (((locations - centers_discret) ** 2).sum(dim=1) == 0) # P
+        is_in_boxes = reg_target.min(dim=1)[0] > 0 # P
+        is_center3x3 = ((locations - centers_discret).abs() <= \
+            strides_p).all(dim=1) & is_in_boxes # P
+        is_cared_in_the_level = self.assign_reg_fpn(
+            reg_target.view(P, 1, 4), reg_size_ranges[m]).view(P) # P
+        reg_mask = is_center3x3 & is_cared_in_the_level # P
+
+        dist2 = ((locations - centers) ** 2).sum(dim=1) # P
+        dist2[is_peak] = 0
+        weighted_dist2 = dist2 / radius2[n] # P
+
+        # the closest object among the positive ones, the lowest index on ties
+        reg_inds = torch.nonzero(reg_mask).squeeze(1)
+        reg_inds = reg_inds[self._segment_argmin(
+            m[reg_inds], weighted_dist2[reg_inds])]
+        reg_targets_per_im = grids.new_full((M, 4), -INF)
+        reg_targets_per_im[m[reg_inds]] = reg_target[reg_inds]
+
+        if self.only_proposal:
+            heatmaps = grids.new_zeros((M, 1))
+            hm_keys = m
+        else:
+            heatmaps = grids.new_zeros((M, channels))
+            hm_keys = m * channels + gt_classes[n].long()
+        hm_inds = self._segment_argmin(hm_keys, weighted_dist2)
+        heatmap = torch.exp(-weighted_dist2[hm_inds])
+        heatmap[heatmap < 1e-4] = 0
+        heatmaps.view(-1)[hm_keys[hm_inds]] = heatmap
+        return reg_targets_per_im, heatmaps
+
+
+    def _get_candidates(self, boxes, radius2, shapes_per_level, num_loc_list):
+        '''
+        The locations that can get a target from each object: on every level,
+        the 3x3 cells around its center cell and the cells within
+        sqrt(10 * radius2) of its center (exp(-10) < 1e-4, beyond that its
+        heatmap is zeroed). A superset of the nonzero pairs of the dense
+        assignment, the exact tests are left to _get_sparse_targets.
+        Inputs:
+            boxes: N x 4
+            radius2: N
+            shapes_per_level: L x 2 [(h_l, w_l)]_L
+        Return:
+            m: P location indices in the M locations of all levels
+            n: P object indices, increasing within a level
+        '''
+        N = boxes.shape[0]
+        centers = ((boxes[:, [0, 1]] + boxes[:, [2, 3]]) / 2) # N x 2
+        reach = (radius2 * 10.).sqrt().view(N, 1) # N x 1
+        sizes = shapes_per_level.long()[:, [1, 0]] # L x 2, (w_l, h_l)
+        m, n = [], []
+        level_base = 0
+        for l in range(len(num_loc_list)):
+            stride = self.strides[l]
+            cells = (centers / stride).int().long() # N x 2
+            low = torch.min(cells - 1, torch.floor(
+                (centers - reach - stride // 2) / stride).long())
+            high = torch.max(cells + 1, torch.ceil(
+                (centers + reach - stride // 2) / stride).long())
+            low = low.clamp(min=0)
+            high = torch.min(high, sizes[l].view(1, 2) - 1)
+            extent = (high - low + 1).clamp(min=0) # N x 2
+            counts = extent[:, 0] * extent[:, 1] # N
+            n_l = torch.repeat_interleave(
+                torch.arange(N, device=boxes.device), counts) # P_l
+            offsets = torch.arange(counts.sum().item(), device=boxes.device) - \
+                torch.repeat_interleave(counts.cumsum(dim=0) - counts, counts)
+            x = low[n_l, 0] + offsets % extent[n_l, 0]
+            y = low[n_l, 1] + torch.div(
+                offsets, extent[n_l, 0], rounding_mode='floor')
+            m.append(level_base + y * sizes[l, 0] + x)
+            n.append(n_l)
+            level_base += num_loc_list[l]
+        return torch.cat(m), torch.cat(n)
+
+
+    @staticmethod
+    def _segment_argmin(keys, values):
+        '''
+        For every distinct key, the index of its smallest value, the first one
+        on ties (as min(dim=1) on the dense M x N tensor).
+        '''
+        order = torch.sort(values, stable=True)[1]
+        order = order[torch.sort(keys[order], stable=True)[1]]
+        keys = keys[order]
+        is_first = torch.ones_like(keys, dtype=torch.bool)
+        is_first[1:] = keys[1:] != keys[:-1]
+        return order[is_first]
+
+
     def _get_label_inds(self, gt_instances, shapes_per_level):
         '''
         Inputs:
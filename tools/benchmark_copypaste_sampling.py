@@ -0,0 +1,75 @@
+"""
+Per-sample latency of choosing the self-copy source images of CopyPaste at
+LVIS scale: the old weighted np.random.choice over a fresh list of every
+index against the alias table CopyPasteMapper.set_dataset now builds from
+the RFS repeat factors. Also checks that both draw the same distribution.
+
+    python tools/benchmark_copypaste_sampling.py --images 100170 --num_src 1 3
+"""
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, '.')
+from mrca.data.inst_sampler import AliasSampler
+
+
+def lvis_like_repeat_probs(num_images, num_classes, rng, thresh=0.001):
+    # long-tailed class frequencies, a few classes per image, RFS factors
+    # max over the classes of an image of max(1, sqrt(thresh / freq))
+    class_weights = 1. / np.arange(1, num_classes + 1) ** 1.1
+    num_cats = rng.integers(1, 8, num_images)
+    cats = rng.choice(num_classes, num_cats.sum(), p=class_weights / class_weights.sum())
+    image_of = np.repeat(np.arange(num_images), num_cats)
+    present = np.zeros((num_images, num_classes), dtype=bool)
+    present[image_of, cats] = True
+    freq = present.sum(axis=0) / num_images
+    cat_factor = np.maximum(1., np.sqrt(thresh / np.maximum(freq, 1e-12)))
+    factors = np.zeros(num_images)
+    np.maximum.at(factors, image_of, cat_factor[cats])
+    return factors / factors.sum()
+
+
+def old_get_indexes(repeat_probs, num):
+    return [np.random.choice(list(range(len(repeat_probs))), p=repeat_probs) for _ in range(num)]
+
+
+def time_per_sample(fn, samples):
+    start = time.time()
+    for _ in range(samples):
+        fn()
+    return (time.time() - start) / samples
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=100170)
+    parser.add_argument("--classes", type=int, default=1203)
+    parser.add_argument("--num_src", type=int, nargs='+', default=[1, 3])
+    parser.add_argument("--samples", type=int, default=200, help="training samples timed with the old sampler")
+    parser.add_argument("--draws", type=int, default=2000000, help="draws of the distribution check")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    np.random.seed(0)
+    repeat_probs = lvis_like_repeat_probs(args.images, args.classes, rng)
+
+    start = time.time()
+    sampler = AliasSampler(repeat_probs)
+    print("alias table of {} images built in {:.0f} ms (once per set_dataset)".format(
+        args.images, 1000 * (time.time() - start)))
+
+    print("{:>8} {:>16} {:>16} {:>9}".format('num_src', 'old us/sample', 'alias us/sample', 'speedup'))
+    for num_src in args.num_src:
+        old = time_per_sample(lambda: old_get_indexes(repeat_probs, num_src), args.samples)
+        new = time_per_sample(lambda: sampler.sample(num_src).tolist(), args.samples * 100)
+        print("{:>8} {:>16.1f} {:>16.2f} {:>8.0f}x".format(num_src, 1e6 * old, 1e6 * new, old / new))
+
+    # total variation distance of the empirical draws to repeat_probs, the
+    # old sampler (vectorized here, it is the same distribution) as the noise floor
+    counts_alias = np.bincount(sampler.sample(args.draws), minlength=args.images)
+    counts_old = np.bincount(np.random.choice(args.images, args.draws, p=repeat_probs), minlength=args.images)
+    tv_alias = 0.5 * np.abs(counts_alias / args.draws - repeat_probs).sum()
+    tv_old = 0.5 * np.abs(counts_old / args.draws - repeat_probs).sum()
+    print("TV distance over {} draws: alias {:.4f}, np.random.choice {:.4f}".format(args.draws, tv_alias, tv_old))
@@ -0,0 +1,79 @@
+"""
+Micro-benchmark for the mask -> box kernel used after every paste in the
+copy-paste path. Compares the old per-mask np.where loop with the batched
+numpy kernel (and the torch path, on GPU if available).
+
+    python tools/benchmark_mask_bboxes.py --sizes 640 1024 --counts 10 40 100
+"""
+import sys
+import time
+import argparse
+import numpy as np
+import torch
+
+sys.path.insert(0, '.')
+from mrca.data.transforms.custom_mask_ops import get_bboxes
+
+
+def get_bboxes_loop(masks):
+    num_masks = len(masks)
+    boxes = np.zeros((num_masks, 4), dtype=np.float32)
+    x_any = masks.any(axis=1)
+    y_any = masks.any(axis=2)
+    for idx in range(num_masks):
+        x = np.where(x_any[idx, :])[0]
+        y = np.where(y_any[idx, :])[0]
+        if len(x) > 0 and len(y) > 0:
+            boxes[idx, :] = np.array([x[0], y[0], x[-1] + 1, y[-1] + 1],
+                                     dtype=np.float32)
+    return boxes
+
+
+def random_masks(num, size, rng):
+    # LVIS-like mix: mostly small objects, a few large ones, some empty
+    # (fully occluded) masks
+    masks = np.zeros((num, size, size), dtype=np.uint8)
+    for i in range(num):
+        if rng.random() < 0.05:
+            continue
+        w, h = (rng.beta(1.2, 6, size=2) * size).astype(int) + 1
+        x, y = rng.integers(0, size - w + 1), rng.integers(0, size - h + 1)
+        masks[i, y:y + h, x:x + w] = rng.random((h, w)) < 0.8
+    return masks
+
+
+def timeit(fn, masks, iters):
+    fn(masks)
+    if isinstance(masks, torch.Tensor) and masks.is_cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn(masks)
+    if isinstance(masks, torch.Tensor) and masks.is_cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs='+', default=[640, 1024])
+    parser.add_argument("--counts", type=int, nargs='+', default=[10, 40, 100, 300])
+    parser.add_argument("--iters", type=int, default=20)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    print("{:>6} {:>6} {:>14} {:>14} {:>14}".format(
+        'size', 'masks', 'loop box/s', 'numpy box/s', 'torch box/s'))
+    for size in args.sizes:
+        for num in args.counts:
+            masks = random_masks(num, size, rng)
+            masks_t = torch.from_numpy(masks).to(device).bool()
+            ref = get_bboxes_loop(masks)
+            assert np.array_equal(ref, get_bboxes(masks))
+            assert np.array_equal(ref, get_bboxes(masks_t).cpu().numpy())
+            t_loop = timeit(get_bboxes_loop, masks, args.iters)
+            t_np = timeit(get_bboxes, masks, args.iters)
+            t_torch = timeit(get_bboxes, masks_t, args.iters)
+            print("{:>6} {:>6} {:>14.0f} {:>14.0f} {:>14.0f}".format(
+                size, num, num / t_loop, num / t_np, num / t_torch))
@@ -0,0 +1,51 @@
+"""
+Per-sample payload of gt_masks sent from dataloader workers: pickled size and
+pack / pickle / unpack time of bool masks (what BitMasks carries) against
+PackedMasks, for crowded LVIS-like images.
+
+    python tools/benchmark_packed_masks.py --sizes 640 1024 --counts 50 200 500
+"""
+import sys
+import time
+import pickle
+import argparse
+import numpy as np
+
+sys.path.insert(0, '.')
+from mrca.data.transforms.custom_mask_ops import PackedMasks
+
+
+def random_masks(num, size, rng):
+    masks = np.zeros((num, size, size), dtype=bool)
+    for i in range(num):
+        w, h = (rng.beta(1.2, 6, size=2) * size).astype(int) + 1
+        x, y = rng.integers(0, size - w + 1), rng.integers(0, size - h + 1)
+        masks[i, y:y + h, x:x + w] = rng.random((h, w)) < 0.8
+    return masks
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs='+', default=[640, 1024])
+    parser.add_argument("--counts", type=int, nargs='+', default=[50, 200, 500])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print("{:>6} {:>6} {:>12} {:>12} {:>12} {:>12}".format(
+        'size', 'masks', 'bool MB', 'packed MB', 'bool ms', 'packed ms'))
+    for size in args.sizes:
+        for num in args.counts:
+            masks = random_masks(num, size, rng)
+            start = time.perf_counter()
+            dense_payload = pickle.dumps(masks, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.loads(dense_payload)
+            t_dense = time.perf_counter() - start
+
+            start = time.perf_counter()
+            packed_payload = pickle.dumps(PackedMasks.from_dense(masks), protocol=pickle.HIGHEST_PROTOCOL)
+            unpacked = pickle.loads(packed_payload).to_dense()
+            t_packed = time.perf_counter() - start
+            assert np.array_equal(unpacked, masks)
+            print("{:>6} {:>6} {:>12.1f} {:>12.1f} {:>12.1f} {:>12.1f}".format(
+                size, num, len(dense_payload) / 2**20, len(packed_payload) / 2**20,
+                1000 * t_dense, 1000 * t_packed))
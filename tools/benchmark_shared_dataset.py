@@ -0,0 +1,150 @@
+"""
+Host memory of the self-copy source images of CopyPasteMapper with
+--gpus training processes of --workers dataloader workers each:
+
+- 'deepcopy': every GPU process deep-copies the serialized train set of its
+  loader into the mapper and keeps per-category pools as lists, the old
+  set_dataset;
+- 'shared': the local main process serializes it once to /dev/shm, every
+  process memory-maps it, per-category pools are index arrays.
+
+Each GPU process also holds the serialized loader dataset itself, as in
+training. LVIS-like dataset dicts with polygons are generated. Host memory
+is the sum of the PSS of all processes once every worker has drawn
+--draws source images (shared pages counted once overall).
+
+    python tools/benchmark_shared_dataset.py --images 100170 --gpus 8 --workers 8
+"""
+import os
+import sys
+import copy
+import pickle
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+from collections import defaultdict
+import numpy as np
+
+sys.path.insert(0, '.')
+from mrca.data.shared_dataset import SharedDatasetList, serialize_dataset
+
+
+def memory_mb():
+    """PSS of this process in MB: its private pages plus its share of the shared ones."""
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            if line.startswith('Pss:'):
+                return (int(line.split()[1]) / 1024,)
+
+
+def lvis_like_dicts(num_images, seed=0):
+    rng = np.random.default_rng(seed)
+    dataset = []
+    for i in range(num_images):
+        annotations = []
+        for _ in range(int(rng.integers(1, 24))):
+            points = rng.uniform(0, 640, int(rng.integers(8, 40)) * 2).round(2).tolist()
+            annotations.append({'bbox': rng.uniform(0, 640, 4).round(2).tolist(), 'bbox_mode': 1,
+                                'category_id': int(rng.zipf(1.3) % 1203), 'segmentation': [points]})
+        dataset.append({'file_name': 'datasets/coco/train2017/{:012d}.jpg'.format(i), 'height': 480,
+                        'width': 640, 'image_id': i, 'not_exhaustive_category_ids': [],
+                        'neg_category_ids': rng.integers(0, 1203, 5).tolist(), 'annotations': annotations})
+    return dataset
+
+
+class SerializedList:
+    # the loader's DatasetFromList(serialize=True)
+    def __init__(self, lst):
+        self._lst, self._addr = serialize_dataset(lst)
+
+    def __len__(self):
+        return len(self._addr)
+
+    def __getitem__(self, idx):
+        start = 0 if idx == 0 else int(self._addr[idx - 1])
+        return pickle.loads(memoryview(self._lst[start:int(self._addr[idx])]))
+
+
+def per_cat_pools(dataset, as_arrays):
+    per_cat_map = defaultdict(list)
+    for i in range(len(dataset)):
+        for cid in set(x['category_id'] for x in dataset[i]['annotations']):
+            per_cat_map[cid].append(i)
+    if as_arrays:
+        per_cat_map = defaultdict(list, {cid: np.asarray(v, dtype=np.int64) for cid, v in per_cat_map.items()})
+    return per_cat_map
+
+
+def worker(dataset, per_cat_map, draws, queue, barrier):
+    cats = list(per_cat_map.keys())
+    for _ in range(draws):
+        pool = per_cat_map[cats[np.random.randint(0, len(cats))]]
+        data = dataset[int(pool[np.random.randint(0, len(pool))])]
+        data = dataset[np.random.randint(0, len(dataset))]
+    queue.put(('worker',) + memory_mb())
+    barrier.wait()
+
+
+def gpu_process(rank, mode, args, path, queue, ready, barrier):
+    loader_dataset = SerializedList(lvis_like_dicts(args.images))
+    if mode == 'deepcopy':
+        dataset = copy.deepcopy(loader_dataset)
+        per_cat_map = per_cat_pools(dataset, False)
+    else:
+        if rank == 0:
+            data, addr = serialize_dataset(loader_dataset[i] for i in range(len(loader_dataset)))
+            np.save(path + '_data.npy', data)
+            np.save(path + '_addr.npy', addr)
+            del data, addr
+        ready.wait()
+        dataset = SharedDatasetList(path)
+        per_cat_map = per_cat_pools(dataset, True)
+    ctx = multiprocessing.get_context('fork')
+    procs = [ctx.Process(target=worker, args=(dataset, per_cat_map, args.draws, queue, barrier))
+             for _ in range(args.workers)]
+    for p in procs:
+        p.start()
+    queue.put(('gpu',) + memory_mb())
+    barrier.wait()
+    for p in procs:
+        p.join()
+
+
+def measure(mode, args, shm_dir):
+    ctx = multiprocessing.get_context('fork')
+    queue = ctx.Queue()
+    ready = ctx.Barrier(args.gpus)
+    barrier = ctx.Barrier(args.gpus * (args.workers + 1) + 1)
+    path = os.path.join(shm_dir, 'dataset')
+    procs = [ctx.Process(target=gpu_process, args=(r, mode, args, path, queue, ready, barrier))
+             for r in range(args.gpus)]
+    for p in procs:
+        p.start()
+    stats = [queue.get() for _ in range(args.gpus * (args.workers + 1))]
+    barrier.wait()
+    for p in procs:
+        p.join()
+    gpu = [s for s in stats if s[0] == 'gpu']
+    workers = [s for s in stats if s[0] == 'worker']
+    print("{:>9} {:>12.0f} {:>15.1f} {:>15.1f}".format(
+        mode, sum(s[1] for s in stats), np.mean([s[1] for s in gpu]), np.mean([s[1] for s in workers])))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=100170)
+    parser.add_argument("--gpus", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--draws", type=int, default=2000)
+    args = parser.parse_args()
+
+    shm_dir = tempfile.mkdtemp(dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    try:
+        print("{} images, {} GPU processes x {} workers".format(args.images, args.gpus, args.workers))
+        print("{:>9} {:>12} {:>15} {:>15}".format('mode', 'host PSS MB', 'GPU proc PSS MB', 'worker PSS MB'))
+        measure('deepcopy', args, shm_dir)
+        measure('shared', args, shm_dir)
+        print("serialized dataset {:.0f} MB".format(os.path.getsize(os.path.join(shm_dir, 'dataset_data.npy')) / 2**20))
+    finally:
+        shutil.rmtree(shm_dir)
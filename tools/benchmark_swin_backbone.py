@@ -0,0 +1,93 @@
+"""
+CPU forward time of the Swin backbone of configs/MRCA_SwinL.yaml (L-22k-384,
+window 12, out features swin1-3) over the input shapes it sees, cycled as
+in multi-scale training:
+
+- 'rebuild': the SW-MSA masks of every stage built on every forward, as
+  before (attn_mask_cache_size 0);
+- 'cache': masks from the per-stage LRU cache;
+- 'sdpa': the cache and MODEL.SWIN.USE_SDPA.
+
+The outputs of 'cache' must equal those of 'rebuild', the 'sdpa' ones are
+compared with a tolerance. The mask construction alone is timed too.
+
+    python tools/benchmark_swin_backbone.py --shapes 896x896 896x640 640x640 640x480 --iters 2
+"""
+import sys
+import time
+import argparse
+import torch
+
+sys.path.insert(0, '.')
+sys.path.insert(0, 'third_party/CenterNet2/projects/CenterNet2/')
+from mrca.modeling.backbone.swintransformer import SwinTransformer, WindowAttention, size2config
+
+
+def set_mode(model, mode):
+    for layer in model.layers:
+        layer.attn_mask_cache_size = 0 if mode == 'rebuild' else 8
+        layer.attn_masks.clear()
+    for m in model.modules():
+        if isinstance(m, WindowAttention):
+            m.use_sdpa = mode == 'sdpa'
+
+
+def mask_time(model, shapes, reps):
+    # get_attn_mask of every stage for every shape, as one forward calls it,
+    # after a first pass that fills the caches
+    for rep in range(reps + 1):
+        if rep == 1:
+            start = time.time()
+        for h, w in shapes:
+            H, W = -(-h // 4), -(-w // 4)
+            for layer in model.layers:
+                ws = layer.window_size
+                layer.get_attn_mask(-(-H // ws) * ws, -(-W // ws) * ws, torch.device('cpu'))
+                H, W = (H + 1) // 2, (W + 1) // 2
+    return (time.time() - start) / reps / len(shapes)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", default='L-22k-384')
+    parser.add_argument("--depths", type=int, nargs='+', default=None, help="override the stage depths for a quick run")
+    parser.add_argument("--shapes", nargs='+', default=['896x896', '896x640', '640x640', '640x480'],
+                        help="HxW inputs: TRAIN_SIZE crops of MRCA_SwinL and TEST_SIZE images")
+    parser.add_argument("--batch", type=int, default=1)
+    parser.add_argument("--iters", type=int, default=2)
+    args = parser.parse_args()
+
+    config = size2config[args.size]
+    model = SwinTransformer(
+        embed_dim=config['embed_dim'], window_size=config['window_size'],
+        depths=args.depths or config['depth'], num_heads=config['num_heads'],
+        drop_path_rate=config['drop_path_rate'], out_indices=(1, 2, 3))
+    model.init_weights()
+    model.eval()
+    shapes = [tuple(int(v) for v in s.split('x')) for s in args.shapes]
+    inputs = [torch.randn(args.batch, 3, h, w) for h, w in shapes]
+    print("Swin {} depths {}, shapes {}, batch {}".format(
+        args.size, args.depths or config['depth'], ' '.join(args.shapes), args.batch))
+
+    for mode in ('rebuild', 'cache'):
+        set_mode(model, mode)
+        print("{:>8} SW-MSA masks {:.3f} ms per forward".format(mode, 1000 * mask_time(model, shapes, 20)))
+
+    print("{:>8} {:>14} {:>14}".format('mode', 'ms / forward', 'max abs diff'))
+    reference = None
+    with torch.no_grad():
+        for mode in ('rebuild', 'cache', 'sdpa'):
+            set_mode(model, mode)
+            outputs = [model(x) for x in inputs]  # warm-up, fills the mask caches
+            start = time.time()
+            for _ in range(args.iters):
+                for x in inputs:
+                    model(x)
+            seconds = (time.time() - start) / args.iters / len(inputs)
+            if reference is None:
+                reference = outputs
+            diff = max((out[k] - ref[k]).abs().max().item()
+                       for out, ref in zip(outputs, reference) for k in ref)
+            if mode == 'cache':
+                assert diff == 0, "cached masks change the output"
+            print("{:>8} {:>14.0f} {:>14.2e}".format(mode, 1000 * seconds, diff))
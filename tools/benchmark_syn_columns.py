@@ -0,0 +1,136 @@
+"""
+Load time and per-worker memory of the synthetic pool: rdN_annotations.json
+through load_coco_syn_json against the memory-mapped rdN_columns, both
+written by diSegmenter/create_annotation.py for a pool of --rounds rounds.
+
+Like the dataloader, the pool is loaded once and --workers processes are
+forked that each read every object once (file name and category, what
+InstPoolFeed samples from). Private MB is what a worker does not share with
+the others; with the json, touching the dicts copies their pages.
+
+    python tools/benchmark_syn_columns.py --rounds 20 --per_round 4812
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+import numpy as np
+import cv2
+
+sys.path.insert(0, '.')
+sys.path.insert(0, 'diSegmenter')
+import create_annotation
+from mrca.data.syn_columns import SynColumns
+from detectron2.data.datasets.coco import load_coco_syn_json
+
+
+def memory_mb():
+    """(rss, private) of this process in MB."""
+    rss = private = 0
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            key, value = line.split(':')[0], line.split()[1:2]
+            if key == 'Rss':
+                rss = int(value[0])
+            elif key in ('Private_Clean', 'Private_Dirty'):
+                private += int(value[0])
+    return rss / 1024, private / 1024
+
+
+def random_records(num_masks, size, rng):
+    # a few real masks, reused under many file names
+    records = []
+    for k in range(num_masks):
+        mask = np.zeros((size, size), dtype=np.uint8)
+        center = tuple(int(x) for x in rng.integers(size // 4, 3 * size // 4, 2))
+        axes = tuple(int(x) for x in rng.integers(size // 10, size // 4, 2))
+        cv2.ellipse(mask, center, axes, float(rng.uniform(0, 180)), 0, 360, 255, -1)
+        records.append(create_annotation.annotate_mask('00_0001_{:04d}.png'.format(k + 1), mask))
+    return records
+
+
+def build_pool(out_dir, rounds, per_round, size):
+    rng = np.random.default_rng(0)
+    masks = random_records(64, size, rng)
+    create_annotation.OUTPUT_JSON = out_dir
+    create_annotation.STORE_DIR = out_dir + '/store'
+    create_annotation.STORE_INDEX = create_annotation.STORE_DIR + '/index.jsonl'
+    os.makedirs(create_annotation.STORE_DIR)
+    image_id = annotation_id = 0
+    for rd in range(rounds):
+        records = []
+        for k in range(per_round):
+            cls = int(rng.integers(1, 1204))
+            record = dict(masks[k % len(masks)], file_name='{:02d}_{:04d}_{:04d}.png'.format(rd, cls, k + 1))
+            record['annotation'] = dict(record['annotation'], category_id=cls)
+            records.append(record)
+        # the same steps as add_round_to_store, from records instead of mask files
+        columns = create_annotation._columns_from_records(records, range(image_id, image_id + len(records)))
+        np.savez(create_annotation._store_columns(rd), **columns)
+        images = [create_annotation.json.dumps(create_annotation.get_image_info(r['file_name'], image_id + i, r['height'], r['width']))
+                  for i, r in enumerate(records)]
+        annotations = [create_annotation.json.dumps(dict(r['annotation'], id=annotation_id + i, image_id=image_id + i))
+                       for i, r in enumerate(records)]
+        for path, items in zip(create_annotation._store_parts(rd), [images, annotations]):
+            with open(path, 'w') as f:
+                f.write(', '.join(items))
+        with open(create_annotation.STORE_INDEX, 'a') as f:
+            f.write(create_annotation.json.dumps({'rd': rd, 'image_id': image_id, 'annotation_id': annotation_id,
+                                                  'images': len(records), 'annotations': len(records)}) + '\n')
+        image_id += len(records)
+        annotation_id += len(records)
+    create_annotation._write_annotations(set(range(rounds)), rounds - 1)
+
+
+def worker(dataset, queue):
+    cats = 0
+    for i in range(len(dataset)):
+        data = dataset[i]
+        cats += data['annotations'][0]['category_id']
+        len(data['file_name'])
+    queue.put(memory_mb())
+
+
+def measure(name, load, workers):
+    rss0, _ = memory_mb()
+    start = time.time()
+    dataset = load()
+    load_s = time.time() - start
+    rss1, _ = memory_mb()
+    queue = multiprocessing.get_context('fork').Queue()
+    procs = [multiprocessing.get_context('fork').Process(target=worker, args=(dataset, queue)) for _ in range(workers)]
+    for p in procs:
+        p.start()
+    stats = [queue.get() for _ in procs]
+    for p in procs:
+        p.join()
+    print("{:>8} {:>9} {:>10.2f} {:>14.1f} {:>14.1f} {:>14.1f}".format(
+        name, len(dataset), load_s, rss1 - rss0,
+        np.mean([s[0] for s in stats]), np.mean([s[1] for s in stats])))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--per_round", type=int, default=4812)
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--image_root", default="/data3/objdet/lvis_feedback_sd3/raw")
+    args = parser.parse_args()
+
+    out_dir = tempfile.mkdtemp()
+    try:
+        build_pool(out_dir, args.rounds, args.per_round, args.size)
+        rd = args.rounds - 1
+        json_path = out_dir + '/rd{}_annotations.json'.format(rd)
+        print("json {:.1f} MB".format(os.path.getsize(json_path) / 2**20))
+        print("{:>8} {:>9} {:>10} {:>14} {:>14} {:>14}".format(
+            'format', 'objects', 'load s', 'parent +MB', 'worker RSS MB', 'worker priv MB'))
+        # columns first, the json loader leaves its garbage in the parent
+        measure('columns', lambda: SynColumns(out_dir + '/rd{}_columns'.format(rd), args.image_root), args.workers)
+        measure('json', lambda: load_coco_syn_json(json_path, args.image_root), args.workers)
+    finally:
+        shutil.rmtree(out_dir)
@@ -0,0 +1,89 @@
+"""
+Check that the one-pass compositor (INPUT.BATCHED_PASTE, and with --tile
+INPUT.TILE_PASTE) gives the same image, masks, boxes, labels,
+instance_source and file_name_list as placing objects with random_start_xy
+and pasting them one at a time with InstPoolFeed._copy_paste, under a fixed
+seed.
+
+    python tools/check_batched_paste.py --trials 200 --size 640 --tile
+"""
+import sys
+import copy
+import time
+import random
+import argparse
+from types import SimpleNamespace
+import numpy as np
+
+sys.path.insert(0, '.')
+from mrca.data.custom_build_copypaste_mapper import InstPoolFeed, random_start_xy, random_start_tile
+from mrca.data.transforms.custom_compositor import composite_instances
+from mrca.data.transforms.custom_mask_ops import get_bboxes
+
+
+def random_dst(rng, size, num):
+    masks = np.zeros((num, size, size), dtype=bool)
+    for i in range(num):
+        w, h = rng.integers(5, size // 2, size=2)
+        x, y = rng.integers(0, size - w), rng.integers(0, size - h)
+        masks[i, y:y + h, x:x + w] = rng.random((h, w)) < 0.9
+    # empty masks, as objects fully occluded by an earlier paste
+    masks[rng.random(num) < 0.1] = False
+    # annotation boxes are close to, not exactly, the mask boxes
+    boxes = get_bboxes(masks) + rng.integers(-3, 4, size=(num, 4))
+    return {'image': rng.integers(0, 255, (3, size, size), dtype=np.uint8),
+            'gt_bboxes': boxes.astype(np.float32), 'gt_labels': rng.integers(0, 1203, num),
+            'gt_masks': masks, 'instance_source': np.zeros(num, dtype=np.int64),
+            'file_name_list': np.array(['ori'] * num)}
+
+
+def random_object(rng, size, idx):
+    # what InstPoolFeed._load_RGBA returns: an HWC RGBA crop and its mask
+    h, w = rng.integers(5, size // 3, size=2)
+    segment = (rng.random((h, w)) < 0.85).astype(np.uint8)
+    image = rng.integers(0, 255, (h, w, 4), dtype=np.uint8)
+    image[..., 3] *= segment
+    return {'image': image, 'file_name': 'syn_{}.png'.format(idx),
+            'gt_bboxes': np.array([[0, 0, w, h]], dtype=np.float64),
+            'gt_labels': np.array([rng.integers(0, 1203)]), 'gt_masks': segment[..., None]}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trials", type=int, default=200)
+    parser.add_argument("--size", type=int, default=640)
+    parser.add_argument("--cp_method", nargs='+', default=['basic'])
+    parser.add_argument("--tile", action='store_true', help="place objects with random_start_tile")
+    args = parser.parse_args()
+
+    pool = SimpleNamespace(bbox_occluded_thr=10, mask_occluded_thr=300, cp_method=args.cp_method)
+    train_size = (args.size, args.size)
+    place = random_start_tile if args.tile else random_start_xy
+    rng = np.random.default_rng(0)
+    t_seq, t_batch = 0., 0.
+    for trial in range(args.trials):
+        dst = random_dst(rng, args.size, int(rng.integers(0, 40)))
+        objs = [random_object(rng, args.size, i) for i in range(int(rng.integers(1, 20)))]
+
+        np.random.seed(trial)
+        random.seed(trial)
+        start = time.perf_counter()
+        seq = copy.deepcopy(dst)
+        for x in [random_start_xy(copy.deepcopy(o), train_size) for o in objs]:
+            seq = InstPoolFeed._copy_paste(pool, seq, x)
+        t_seq += time.perf_counter() - start
+        seq_state = random.getstate()
+
+        np.random.seed(trial)
+        random.seed(trial)
+        start = time.perf_counter()
+        srcs = [place(copy.deepcopy(o), train_size) for o in objs]
+        batch = composite_instances(copy.deepcopy(dst), srcs, args.cp_method,
+            pool.bbox_occluded_thr, pool.mask_occluded_thr)
+        t_batch += time.perf_counter() - start
+
+        assert random.getstate() == seq_state, 'python RNG out of step'
+        for k in seq:
+            assert np.array_equal(seq[k], batch[k]), 'trial {}: {} differs'.format(trial, k)
+    print("{} trials identical, sequential {:.1f} ms/img, batched {:.1f} ms/img".format(
+        args.trials, 1000 * t_seq / args.trials, 1000 * t_batch / args.trials))
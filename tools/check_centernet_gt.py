@@ -0,0 +1,82 @@
+"""
+Check on CPU that the sparse ground-truth assignment of CenterNet
+(MODEL.CENTERNET.SPARSE_GT) gives exactly the regression targets and
+heatmaps of the dense M x N one, on crowded images like the ones copy-paste
+makes: many objects of all sizes, touching the borders, duplicated boxes
+(ties between objects) and integer boxes (centers on the grid). Also times
+both and counts the (location, object) pairs each evaluates.
+
+    python tools/check_centernet_gt.py --trials 20 --objects 300 --size 1024
+"""
+import sys
+import time
+import argparse
+import numpy as np
+import torch
+from torch import nn
+
+sys.path.insert(0, 'third_party/CenterNet2/')
+sys.path.insert(0, 'third_party/CenterNet2/projects/CenterNet2/')
+from detectron2.structures import Instances, Boxes
+from centernet.modeling.dense_heads.centernet import CenterNet
+
+
+def crowded_instances(rng, size, num_objects, num_classes):
+    wh = np.exp(rng.uniform(np.log(2), np.log(size), (num_objects, 2)))
+    x0y0 = rng.uniform(-0.1 * size, size, (num_objects, 2))
+    boxes = np.concatenate([x0y0, x0y0 + wh], axis=1).clip(0, size)
+    on_grid = rng.random(num_objects) < 0.3
+    boxes[on_grid] = boxes[on_grid].round()
+    dup = rng.integers(0, num_objects, num_objects // 10)
+    boxes[rng.integers(0, num_objects, len(dup))] = boxes[dup]
+    instances = Instances((size, size))
+    instances.gt_boxes = Boxes(torch.tensor(boxes, dtype=torch.float32))
+    instances.gt_classes = torch.tensor(rng.integers(0, num_classes, num_objects))
+    return instances
+
+
+def ground_truth(model, sparse, grids, shapes_per_level, gt_instances):
+    model.sparse_gt = sparse
+    start = time.time()
+    targets = model._get_ground_truth(grids, shapes_per_level, gt_instances)
+    return targets, time.time() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trials", type=int, default=20)
+    parser.add_argument("--objects", type=int, default=300)
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--classes", type=int, default=1203)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    for only_proposal in (True, False):
+        model = CenterNet(
+            num_classes=args.classes, only_proposal=only_proposal,
+            with_agn_hm=True, centernet_head=nn.Identity(), device='cpu')
+        strides = model.strides
+        features = [torch.zeros(1, 1, -(-args.size // s), -(-args.size // s)) for s in strides]
+        grids = model.compute_grids(features)
+        shapes_per_level = grids[0].new_tensor([(x.shape[2], x.shape[3]) for x in features])
+        M = sum(len(g) for g in grids)
+        dense_time = sparse_time = 0.
+        num_pairs = 0
+        for trial in range(args.trials):
+            # a crowded image and an empty one or one with a few objects
+            gt_instances = [crowded_instances(rng, args.size, n, args.classes)
+                            for n in (args.objects, [0, 1, 5][trial % 3])]
+            dense, seconds = ground_truth(model, False, grids, shapes_per_level, gt_instances)
+            dense_time += seconds
+            sparse, seconds = ground_truth(model, True, grids, shapes_per_level, gt_instances)
+            sparse_time += seconds
+            for name, a, b in zip(('pos_inds', 'labels', 'reg_targets', 'flattened_hms'), dense, sparse):
+                assert torch.equal(a, b), "{} differ in trial {}".format(name, trial)
+            crowd = gt_instances[0].gt_boxes
+            radius2 = torch.clamp(model.delta ** 2 * 2 * crowd.area(), min=model.min_radius ** 2)
+            num_pairs += len(model._get_candidates(crowd.tensor, radius2, shapes_per_level, [len(g) for g in grids])[0])
+        print("{}: {} trials equal, {:.0f} ms dense, {:.0f} ms sparse per batch; "
+              "{} x {} = {} dense pairs, {:.0f} sparse pairs per crowded image".format(
+                  'agnostic heatmap' if only_proposal else '{} class heatmaps'.format(args.classes),
+                  args.trials, 1000 * dense_time / args.trials, 1000 * sparse_time / args.trials,
+                  M, args.objects, M * args.objects, num_pairs / args.trials))
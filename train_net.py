@@ -56,6 +56,10 @@ from mrca.data.custom_build_augmentation import build_custom_augmentation
 from mrca.data.custom_dataset_dataloader import  build_custom_train_loader, build_prefetch_train_loader
 from mrca.data.custom_dataset_mapper import CustomDatasetMapper
 from mrca.data.custom_build_copypaste_mapper import InstPoolFeed
+from mrca.data.transforms.custom_mask_ops import unpack_instance_masks
+from mrca.data.copy_stats import counted_deepcopy, pop_copied_bytes
+from mrca.modeling.feedback_classifier import export_feedback_classifier
+from coordinator import Channel, mark_done
 from mrca.data.dataset_mapper_with_sem_seg import DatasetMapperWithSemSeg
 from mrca.data.dataset_mapper import DatasetMapper
 from mrca.custom_solver import build_custom_optimizer
@@ -443,7 +447,7 @@ def do_train(cfg, model, resume=False, model_ema=None):
                 if cid_to_freq[anno['category_id']] in ('c', 'r'):
                     new_anno.append(anno)
             if len(new_anno):
-                data = copy.deepcopy(data)
+                data = counted_deepcopy(data)
                 data['annotations'] = new_anno
                 new_dataset.append(data)
         loader_kwargs = {'dataset': new_dataset}
@@ -465,10 +469,12 @@ def do_train(cfg, model, resume=False, model_ema=None):
                 if anno['category_id'] in cats_list:
                     new_anno.append(anno)
             if len(new_anno):
-                data = copy.deepcopy(data)
+                data = counted_deepcopy(data)
                 data['annotations'] = new_anno
                 new_dataset.append(data)
         loader_kwargs = {'dataset': new_dataset}
+    if loader_kwargs:
+        logger.info("Copied {:.1f} MB of dataset dicts to filter annotations".format(pop_copied_bytes() / 2**20))
 
     if cfg.DATALOADER.SAMPLER_TRAIN in ['TrainingSampler', 'RepeatFactorTrainingSampler']:
         if cfg.DATALOADER.PREFETCH_FACTOR == 2:
@@ -479,7 +485,8 @@ def do_train(cfg, model, resume=False, model_ema=None):
     else:
         data_loader = build_custom_train_loader(cfg, mapper=mapper, **loader_kwargs)
     ### set_dataset
-    mapper.set_dataset(copy.deepcopy(data_loader.dataset.dataset.dataset._dataset))
+    # read-only, the mapper serializes its own shared copy
+    mapper.set_dataset(data_loader.dataset.dataset.dataset._dataset)
     if cfg.INPUT.ACTIVE_SELECT:
         test_dataset = None
         mapper.set_test_dataset(test_dataset)
@@ -500,9 +507,12 @@ def do_train(cfg, model, resume=False, model_ema=None):
                 continue
             data_time = data_timer.seconds()
             storage.put_scalars(data_time=data_time)
+            if 'copied_bytes' in data[0]:
+                storage.put_scalar('copied_mb', sum(x['copied_bytes'] for x in data) / len(data) / 2**20)
             step_timer.reset()
             iteration = iteration + 1
             storage.step()
+            data = unpack_instance_masks(data)
             loss_dict = model(data)
           
             extra_augment = {}
@@ -554,6 +564,31 @@ def do_train(cfg, model, resume=False, model_ema=None):
         logger.info(
             "Total training time: {}".format(
                 str(datetime.timedelta(seconds=int(total_time)))))
+    mapper.close()
+
+
+def export_feedback(model, model_ema, checkpointer):
+    """
+    Export the feedback classifier of the last checkpoint for the generator,
+    before the round marker it waits for is written.
+    """
+    if comm.is_main_process():
+        # the generator reads the EMA weights when there are some
+        model = model_ema.ema if model_ema is not None else model
+        feedback_path, _ = export_feedback_classifier(model, checkpointer.get_checkpoint_file())
+        print('Feedback classifier saved to {}'.format(feedback_path))
+    comm.synchronize()
+
+
+def fresh_batches(batches, rd):
+    """
+    Batches mapped with the instance pool of round `rd`: the ones the
+    dataloader workers prefetched before the round started are dropped.
+    """
+    for data in batches:
+        if any(x.get('inst_pool_rd', rd) != rd for x in data):
+            continue
+        yield data
 
 
 def do_train_feed(cfg, model, resume=False, model_ema=None):
@@ -583,6 +618,7 @@ def do_train_feed(cfg, model, resume=False, model_ema=None):
 
 
     cur_rd = int(start_iter / cfg.SOLVER.CHECKPOINT_PERIOD)
+    channel = Channel(cfg.INPUT.CHANNEL_PATH) if cfg.INPUT.CHANNEL_PATH else None
 
 
     periodic_checkpointer = PeriodicCheckpointer(
@@ -652,7 +688,7 @@ def do_train_feed(cfg, model, resume=False, model_ema=None):
                 if cid_to_freq[anno['category_id']] in ('c', 'r'):
                     new_anno.append(anno)
             if len(new_anno):
-                data = copy.deepcopy(data)
+                data = counted_deepcopy(data)
                 data['annotations'] = new_anno
                 new_dataset.append(data)
         loader_kwargs = {'dataset': new_dataset}
@@ -674,10 +710,12 @@ def do_train_feed(cfg, model, resume=False, model_ema=None):
                 if anno['category_id'] in cats_list:
                     new_anno.append(anno)
             if len(new_anno):
-                data = copy.deepcopy(data)
+                data = counted_deepcopy(data)
                 data['annotations'] = new_anno
                 new_dataset.append(data)
         loader_kwargs = {'dataset': new_dataset}
+    if loader_kwargs:
+        logger.info("Copied {:.1f} MB of dataset dicts to filter annotations".format(pop_copied_bytes() / 2**20))
 
 
 
@@ -690,7 +728,8 @@ def do_train_feed(cfg, model, resume=False, model_ema=None):
     else:
         data_loader = build_custom_train_loader(cfg, mapper=mapper, **loader_kwargs)
 
-    mapper.set_dataset(copy.deepcopy(data_loader.dataset.dataset.dataset._dataset))
+    # read-only, the mapper serializes its own shared copy
+    mapper.set_dataset(data_loader.dataset.dataset.dataset._dataset)
     
     if cfg.INPUT.ACTIVE_SELECT:
         test_dataset = None
@@ -703,6 +742,11 @@ def do_train_feed(cfg, model, resume=False, model_ema=None):
     else:
         save_init_checkpoint = False
 
+    # one process per round, or all rounds in this one with the same
+    # model, optimizer and dataloader workers
+    persistent = cfg.INPUT.PERSISTENT_ROUNDS
+    data_iter = iter(data_loader) if persistent else None
+
     logger.info("Starting training from iteration {}".format(start_iter))
     with EventStorage(start_iter) as storage:
         step_timer = Timer()
@@ -712,16 +756,28 @@ def do_train_feed(cfg, model, resume=False, model_ema=None):
         for rd in range(cur_rd,cfg.INPUT.NUM_ROUNDS):
             print("round: {}".format(rd))
 
-            for data, iteration in zip(data_loader, range(start_iter, start_iter + cfg.SOLVER.CHECKPOINT_PERIOD)):
+            if persistent:
+                if rd != cur_rd:
+                    # swap the instance pool, the workers pick it up before their next image
+                    mapper.set_round(rd)
+                iterations = range(start_iter, start_iter + cfg.SOLVER.CHECKPOINT_PERIOD)
+                batches = ((data, iteration) for iteration, data in zip(iterations, fresh_batches(data_iter, rd)))
+            else:
+                batches = zip(data_loader, range(start_iter, start_iter + cfg.SOLVER.CHECKPOINT_PERIOD))
+
+            for data, iteration in batches:
 
                 if cfg.TEST.GEN_DATASET :
                     print('iter', iteration)
                     continue
                 data_time = data_timer.seconds()
                 storage.put_scalars(data_time=data_time)
+                if 'copied_bytes' in data[0]:
+                    storage.put_scalar('copied_mb', sum(x['copied_bytes'] for x in data) / len(data) / 2**20)
                 step_timer.reset()
                 iteration = iteration + 1
                 storage.step()
+                data = unpack_instance_masks(data)
                 loss_dict = model(data)
 
                 extra_augment = {}
@@ -772,13 +828,15 @@ def do_train_feed(cfg, model, resume=False, model_ema=None):
                 if save_init_checkpoint:
                     periodic_checkpointer.save(0, **extra_augment)
                     save_init_checkpoint = False
+                    export_feedback(model, model_ema, checkpointer)
                     ckpt_done_path = cfg.OUTPUT_DIR + '/0' + 'done_ckpt.txt'
-                    open(ckpt_done_path, 'a').close()
+                    mark_done(ckpt_done_path, channel)
 
 
             # write checkpoint has been fully written
+            export_feedback(model, model_ema, checkpointer)
             ckpt_done_path = cfg.OUTPUT_DIR + '/rd' + str(rd) + 'done_ckpt.txt'
-            open(ckpt_done_path, 'a').close()
+            mark_done(ckpt_done_path, channel)
                   
             # modify mapper after round ends
             if rd == cfg.INPUT.NUM_ROUNDS-1:
@@ -786,13 +844,15 @@ def do_train_feed(cfg, model, resume=False, model_ema=None):
 
 
             start_iter += cfg.SOLVER.CHECKPOINT_PERIOD
-            break
+            if not persistent:
+                break
         
 
         total_time = time.perf_counter() - start_time
         logger.info(
             "Total training time: {}".format(
                 str(datetime.timedelta(seconds=int(total_time)))))
+    mapper.close()
 
         
 